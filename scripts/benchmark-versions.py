@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Compares the cost of parsing and comparing versions with auslib's version
+classes against the distutils based classes that they replaced.
+
+Usage: benchmark-versions.py [--number N]
+"""
+
+import argparse
+import re
+import timeit
+from distutils.version import LooseVersion as DistutilsLooseVersion
+from distutils.version import StrictVersion
+
+from auslib.util.versions import AncientMozillaVersion, LooseVersion, ModernMozillaVersion, MozillaVersion, PostModernMozillaVersion, version_key
+
+
+class LegacyPostModernMozillaVersion(StrictVersion):
+    version_re = re.compile(r"^(\d+) \. (\d+) (\. (\d+))? (a(\d+))?$", re.VERBOSE)
+
+
+class LegacyModernMozillaVersion(StrictVersion):
+    version_re = re.compile(r"^(\d+) \. (\d+) (\. (\d+))? ([a-zA-Z]+(\d+))?$", re.VERBOSE)
+
+
+class LegacyAncientMozillaVersion(StrictVersion):
+    version_re = re.compile(r"^(\d+) \. (\d+) \. \d (\. (\d+)) ([a-zA-Z]+(\d+))?$", re.VERBOSE)
+
+
+def LegacyMozillaVersion(version):
+    if version.count(".") in (1, 2):
+        if int(version[0]) > 4:
+            return LegacyPostModernMozillaVersion(version)
+        else:
+            return LegacyModernMozillaVersion(version)
+    else:
+        return LegacyAncientMozillaVersion(version)
+
+
+def UncachedMozillaVersion(version):
+    if version.count(".") in (1, 2):
+        if int(version[0]) > 4:
+            return PostModernMozillaVersion(version)
+        else:
+            return ModernMozillaVersion(version)
+    else:
+        return AncientMozillaVersion(version)
+
+
+VERSIONS = ("1.5.0.12", "3.6.3plugin1", "4.0b12", "52.0.2", "60.9.0", "68.0a1", "72.0")
+GUARDIAN_VERSIONS = ("0.4.0.0", "0.5.1", "1.0.10")
+
+
+def bench(label, func, number):
+    elapsed = timeit.timeit(func, number=number)
+    print("%-45s %8.3f us/op" % (label, elapsed / number * 1000000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000, help="number of iterations of each benchmark")
+    args = parser.parse_args()
+    n = args.number
+
+    print("Parsing (%d versions per op)" % len(VERSIONS))
+    bench("distutils StrictVersion subclasses", lambda: [LegacyMozillaVersion(v) for v in VERSIONS], n)
+    bench("MozillaVersion classes, uncached", lambda: [UncachedMozillaVersion(v) for v in VERSIONS], n)
+    bench("MozillaVersion, interned", lambda: [MozillaVersion(v) for v in VERSIONS], n)
+    bench("version_key, interned", lambda: [version_key(v) for v in VERSIONS], n)
+    bench("distutils LooseVersion", lambda: [DistutilsLooseVersion(v) for v in GUARDIAN_VERSIONS], n)
+    bench("LooseVersion, uncached", lambda: [LooseVersion(v) for v in GUARDIAN_VERSIONS], n)
+
+    print("Comparing (%d pairs per op)" % (len(VERSIONS) ** 2))
+    legacy = [LegacyMozillaVersion(v) for v in VERSIONS]
+    new = [MozillaVersion(v) for v in VERSIONS]
+    keys = [version_key(v) for v in VERSIONS]
+    bench("distutils StrictVersion subclasses", lambda: [a < b for a in legacy for b in legacy], n)
+    bench("MozillaVersion", lambda: [a < b for a in new for b in new], n)
+    bench("version_key", lambda: [a < b for a in keys for b in keys], n)
+
+
+if __name__ == "__main__":
+    main()
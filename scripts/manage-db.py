@@ -6,6 +6,7 @@ import sys
 from os import path
 from subprocess import run
 
+from sqlalchemy import text
 from sqlalchemy.engine.url import make_url
 
 from auslib.blobs.base import createBlob  # noqa: E402
@@ -53,6 +54,17 @@ def chunk_list(list_object, n):
         yield list_object[i : i + n]
 
 
+def fetch_in_batches(result, n=100):
+    """
+    Yield the rows of result, fetching n of them at a time.
+    """
+    while True:
+        rows = result.fetchmany(n)
+        if not rows:
+            break
+        yield from rows
+
+
 def mysql_command(host, user, password, db, cmd):
     # --protocol=tcp prevent's a socket from being used, so that balrogdb
     # in docker can be called from localhost (via port forwarding for instance)
@@ -104,9 +116,12 @@ def extract_active_data(trans, url, dump_location="dump.sql"):
                 releases.name IN (rules_scheduled_changes.base_mapping, rules_scheduled_changes.base_fallbackMapping))
             """
 
-        result = trans.execute(query_release_mapping).fetchall()
+        # The data column of each release can be hundreds of KB, so rather than
+        # fetching all of them at once, they're streamed from a server side
+        # cursor, and we only keep their names.
+        result = trans.execute(text(query_release_mapping).execution_options(stream_results=True))
         release_names = set()
-        for row in result:
+        for row in fetch_in_batches(result):
             try:
                 release_names.add(str(row["name"]))
                 release_blob = createBlob(row["data"])
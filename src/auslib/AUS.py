@@ -2,7 +2,7 @@ import functools
 import logging
 from random import randint
 
-from auslib.global_state import cache, dbo
+from auslib.global_state import dbo
 
 try:
     from urlparse import urlparse
@@ -56,36 +56,23 @@ class AUS:
         self.log = logging.getLogger(self.__class__.__name__)
 
     def updates_are_disabled(self, product, channel, transaction=None):
-        cache_key = (product, channel)
-        v = cache.get("updates_disabled", cache_key)
-        if v is not None:
-            return v
-
-        where = dict(product=product, channel=channel)
-        emergency_shutoffs = dbo.emergencyShutoffs.select(where=where, transaction=transaction)
-        v = bool(emergency_shutoffs)
-        cache.put("updates_disabled", cache_key, v)
-        return v
-
-    def evaluateRules(self, updateQuery, transaction=None):
+        return (product, channel) in dbo.emergencyShutoffs.getShutoffs(transaction=transaction)
+
+    def evaluateRules(self, updateQuery, transaction=None, trace=None):
         self.log.debug("Looking for rules that apply to:")
         self.log.debug(updateQuery)
 
-        if self.updates_are_disabled(updateQuery["product"], updateQuery["channel"], transaction) or self.updates_are_disabled(
-            updateQuery["product"], getFallbackChannel(updateQuery["channel"]), transaction
-        ):
+        shutoffs = dbo.emergencyShutoffs.getShutoffs(transaction=transaction)
+        if (updateQuery["product"], updateQuery["channel"]) in shutoffs or (updateQuery["product"], getFallbackChannel(updateQuery["channel"])) in shutoffs:
             log_message = "Updates are disabled for {}/{}.".format(updateQuery["product"], updateQuery["channel"])
             self.log.debug(log_message)
             return None, None
 
-        rules = dbo.rules.getRulesMatchingQuery(updateQuery, fallbackChannel=getFallbackChannel(updateQuery["channel"]), transaction=transaction)
-
         # TODO: throw any N->N update rules and keep the highest priority remaining one?
-        if len(rules) < 1:
+        rule = dbo.rules.getBestRuleMatchingQuery(updateQuery, fallbackChannel=getFallbackChannel(updateQuery["channel"]), transaction=transaction, trace=trace)
+        if rule is None:
             return None, None
 
-        rules = sorted(rules, key=lambda rule: rule["priority"], reverse=True)
-        rule = rules[0]
         self.log.debug("Matching rule: %s" % rule)
 
         # There's a few cases where we have a matching rule but don't want
@@ -104,7 +91,7 @@ class AUS:
             if updateQuery["force"] == FORCE_FALLBACK_MAPPING or self.rand() >= rule["backgroundRate"]:
                 fallbackReleaseName = rule["fallbackMapping"]
                 if fallbackReleaseName:
-                    release = dbo.releases.getReleases(name=fallbackReleaseName, limit=1, transaction=transaction)[0]
+                    release = dbo.releases.getReleasesByName([fallbackReleaseName], transaction=transaction)[fallbackReleaseName]
                     blob = release["data"]
                     if not blob.shouldServeUpdate(updateQuery):
                         return None, None
@@ -117,7 +104,7 @@ class AUS:
         # 3) Incoming release is older than the one in the mapping, defined as one of:
         #    * version decreases
         #    * version is the same and buildID doesn't increase
-        release = dbo.releases.getReleases(name=rule["mapping"], limit=1, transaction=transaction)[0]
+        release = dbo.releases.getReleasesByName([rule["mapping"]], transaction=transaction)[rule["mapping"]]
         blob = release["data"]
         if not blob.shouldServeUpdate(updateQuery):
             return None, None
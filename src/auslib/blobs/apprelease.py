@@ -1,12 +1,12 @@
 import itertools
 
 from auslib.AUS import getFallbackChannel, isForbiddenUrl, isSpecialURL
-from auslib.blobs.base import BlobValidationError, XMLBlob
+from auslib.blobs.base import BlobValidationError, XMLBlob, escapeAmpersands
 from auslib.errors import BadDataError
-from auslib.global_state import dbo
+from auslib.global_state import cache, dbo
 from auslib.util.comparison import has_operator, strip_operator
 from auslib.util.rulematching import matchBuildID, matchChannel, matchVersion
-from auslib.util.versions import MozillaVersion, decrement_version, increment_version
+from auslib.util.versions import MozillaVersion, decrement_version, increment_version, version_key
 
 
 class ReleaseBlobBase(XMLBlob):
@@ -81,6 +81,47 @@ class ReleaseBlobBase(XMLBlob):
                 raise BadDataError("No buildID for platform '%s'" % (platform))
             return self["platforms"][platform]["buildID"]
 
+    def getBuildIDIndex(self):
+        """Returns a dict of {(platform, locale): buildID} for every platform
+        (including aliases) and locale in the blob that has a buildID. This is
+        everything that matchesUpdateQuery looks at, which lets callers that
+        only need to know whether or not a query matches this release keep
+        this around instead of the whole blob."""
+        index = {}
+        for platform in self.get("platforms", {}):
+            try:
+                locales = self.getPlatformData(platform).get("locales", {})
+            except BadDataError:
+                continue
+            for locale in locales:
+                try:
+                    index[(platform, locale)] = self.getBuildID(platform, locale)
+                except BadDataError:
+                    continue
+        return index
+
+    def _matchesFromRelease(self, patch, updateQuery):
+        """Returns True if the update query is for the release that patch is
+        from. This is equivalent to calling matchesUpdateQuery on the blob
+        that _getFromRelease returns, but is answered from the "from" release's
+        buildID index (see Releases.getReleaseBuildIDs), so it doesn't need to
+        load the entire blob if the index is already cached. Without the
+        "release_buildids" cache there'd be nothing to gain from building the
+        index, so we just use matchesUpdateQuery."""
+        # "*" is a special case for the "from" field that means "any release".
+        if patch["from"] == "*":
+            return True
+        if "release_buildids" not in cache:
+            fromRelease = self._getFromRelease(patch)
+            return bool(fromRelease and fromRelease.matchesUpdateQuery(updateQuery))
+        try:
+            buildIDs = dbo.releases.getReleaseBuildIDs(name=patch["from"])
+        except KeyError:
+            # Release doesn't exist
+            return False
+        key = (updateQuery["buildTarget"], updateQuery["locale"])
+        return key in buildIDs and buildIDs[key] == updateQuery["buildID"]
+
     def _getFromRelease(self, patch):
         # "*" is a special case for the "from" field that means "any release".
         # Because we know it doesn't exist in the database it's wasteful to
@@ -97,17 +138,26 @@ class ReleaseBlobBase(XMLBlob):
     def _getAdditionalPatchAttributes(self, patch):
         return {}
 
-    def _getSpecificPatchXML(self, patchKey, patchType, patch, updateQuery, whitelistedDomains, specialForceHosts):
-        fromRelease = self._getFromRelease(patch)
-        # don't return an update if we don't match the from restriction
-        if fromRelease and not fromRelease.matchesUpdateQuery(updateQuery):
-            return None
-        # don't return an update if an older release isn't in the DB for some reason
-        if patch["from"] != "*" and fromRelease is None:
-            return None
+    def _getPatchFragments(self, patchKey, patchType, patch, updateQuery):
+        """Returns the URL for patch (before any forcing is applied to it),
+        and the parts of its <patch> line that come before and after the URL,
+        both as-is and with ampersands escaped. None of these depend on
+        anything in the query other than its buildTarget, locale, and
+        channel, so when memoization is enabled they're only built once per
+        blob for each combination of those. The parts of the line that can
+        differ from one request to the next (forcing, and whether or not the
+        URL is allowed) are handled by _getSpecificPatchXML."""
+        memo = self.getMemo("patch_fragments")
+        if memo is not None:
+            key = (patchKey, patchType, id(patch), updateQuery["buildTarget"], updateQuery["locale"], updateQuery["channel"])
+            cached = memo.get(key)
+            # The patch itself is stored alongside the fragments to make sure
+            # that an id that's been reused can never match.
+            if cached is not None and cached[0] is patch:
+                return cached[1]
 
         try:
-            url = self._getUrl(updateQuery, patchKey, patch, specialForceHosts)
+            url = self._getPatchUrl(updateQuery, patchKey, patch)
         except ValueError:
             # Sometimes we may not be able to find a partial update even though
             # we've told to. Because there should be a complete to fall back on,
@@ -121,6 +171,33 @@ class ReleaseBlobBase(XMLBlob):
             # and we need to re-raise the exception.
             else:
                 raise
+
+        prefix = '        <patch type="%s" URL="' % patchType
+        suffix = '" hashFunction="%s" hashValue="%s" size="%s"' % (self["hashFunction"], patch["hashValue"], patch["filesize"])
+        additionalPatchAttributes = self._getAdditionalPatchAttributes(patch)
+        for attribute in additionalPatchAttributes:
+            suffix += ' %s="%s"' % (attribute, additionalPatchAttributes[attribute])
+        suffix += "/>"
+
+        fragments = (url, prefix, suffix, escapeAmpersands(prefix), escapeAmpersands(suffix))
+        if memo is not None:
+            memo[key] = (patch, fragments)
+        return fragments
+
+    def _getSpecificPatchXML(self, patchKey, patchType, patch, updateQuery, whitelistedDomains, specialForceHosts, escaped=False):
+        # don't return an update if we don't match the from restriction, or
+        # if an older release isn't in the DB for some reason
+        if not self._matchesFromRelease(patch, updateQuery):
+            return None
+
+        fragments = self._getPatchFragments(patchKey, patchType, patch, updateQuery)
+        if fragments is None:
+            return None
+        url, prefix, suffix, escapedPrefix, escapedSuffix = fragments
+
+        # pass on forcing for special hosts (eg download.m.o for mozilla metrics)
+        if updateQuery["force"]:
+            url = self.processSpecialForceHosts(url, specialForceHosts, updateQuery["force"])
         # TODO: should be raising a bigger alarm here, or aborting
         # the update entirely? Right now, another patch type could still
         # return an update. Eg, the partial could contain a forbidden domain
@@ -128,19 +205,9 @@ class ReleaseBlobBase(XMLBlob):
         if isForbiddenUrl(url, updateQuery["product"], whitelistedDomains):
             return None
 
-        patchXML = '        <patch type="%s" URL="%s" hashFunction="%s" hashValue="%s" size="%s"' % (
-            patchType,
-            url,
-            self["hashFunction"],
-            patch["hashValue"],
-            patch["filesize"],
-        )
-        additionalPatchAttributes = self._getAdditionalPatchAttributes(patch)
-        for attribute in additionalPatchAttributes:
-            patchXML += ' %s="%s"' % (attribute, additionalPatchAttributes[attribute])
-        patchXML += "/>"
-
-        return patchXML
+        if escaped:
+            return escapedPrefix + escapeAmpersands(url) + escapedSuffix
+        return prefix + url + suffix
 
     def getInnerHeaderXML(self, updateQuery, update_type, whitelistedDomains, specialForceHosts):
         return self._getUpdateLineXML(updateQuery, update_type)
@@ -149,6 +216,12 @@ class ReleaseBlobBase(XMLBlob):
         return "    </update>"
 
     def getInnerXML(self, updateQuery, update_type, whitelistedDomains, specialForceHosts):
+        return self._getInnerXML(updateQuery, update_type, whitelistedDomains, specialForceHosts)
+
+    def getEscapedInnerXML(self, updateQuery, update_type, whitelistedDomains, specialForceHosts):
+        return self._getInnerXML(updateQuery, update_type, whitelistedDomains, specialForceHosts, escaped=True)
+
+    def _getInnerXML(self, updateQuery, update_type, whitelistedDomains, specialForceHosts, escaped=False):
         """This method, along with getHeaderXML and getFooterXML are the entry point
            for update XML creation for all Gecko app blobs. However, the XML and
            underlying data has changed over time, so there is a lot of indirection
@@ -158,8 +231,8 @@ class ReleaseBlobBase(XMLBlob):
            be easily shared. Inner methods that only apply to a single blob
            version live on concrete blob classes (but should be moved if they
            need to be shared in the future).
-           * getInnerXML, getFooterXML and getHeaderXML called by web layer,
-             live on this base class. The V1 blob class override them to
+           * getInnerXML (or getEscapedInnerXML), getFooterXML and getHeaderXML
+             called by web layer, live on this base class. The V1 blob class override them to
              support bug 1113475, but still calls the base class one to do most of the work.
            ** _getUpdateLineXML() called to get information that is independent
               of specific MARs. Most notably, version information changed
@@ -169,8 +242,11 @@ class ReleaseBlobBase(XMLBlob):
               changed significantly starting with V3 blobs.
            *** _getSpecificPatchXML() called to translate MAR information into
                XML. This transformation in blob version independent, so it
-               lives on the base class to avoid duplication.
-           **** _getUrl() called to figure out what the MAR URL is for a
+               lives on the base class to avoid duplication. Everything that
+               doesn't vary between requests for the same platform, locale
+               and channel comes from _getPatchFragments(), which memoizes it
+               when the blob cache is enabled.
+           **** _getPatchUrl() called to figure out what the MAR URL is for a
                 specific patch. This changed starting with V4 blobs. V3 and
                 earlier use SeparatedFileUrlsMixin, V4 and later use
                 UnifiedFileUrlsMixin.
@@ -185,9 +261,29 @@ class ReleaseBlobBase(XMLBlob):
         locale = updateQuery["locale"]
         localeData = self.getLocaleData(buildTarget, locale)
 
-        patches = self._getPatchesXML(localeData, updateQuery, whitelistedDomains, specialForceHosts)
+        self._prefetchFromReleases(localeData)
+        patches = self._getPatchesXML(localeData, updateQuery, whitelistedDomains, specialForceHosts, escaped)
         return patches
 
+    def _prefetchFromReleases(self, localeData):
+        """Loads all of the releases that patches for this locale may be from
+        into the blob cache at once, rather than letting _matchesFromRelease
+        look them up one at a time. This is only worth doing if there's a cache
+        for _matchesFromRelease to find them in. When buildID indexes are
+        cached, _matchesFromRelease doesn't need the blobs at all, and loading
+        them here would fill the blob cache with releases that are only ever
+        patched from."""
+        if "blob" not in cache or "release_buildids" in cache:
+            return
+        names = set()
+        for patchKey in ("partial", "complete", "partials", "completes"):
+            patches = localeData.get(patchKey) or []
+            if isinstance(patches, dict):
+                patches = [patches]
+            names.update(patch["from"] for patch in patches if patch.get("from", "*") != "*")
+        if names:
+            dbo.releases.getReleaseBlobs(names)
+
     def shouldServeUpdate(self, updateQuery):
         buildTarget = updateQuery["buildTarget"]
         locale = updateQuery["locale"]
@@ -195,8 +291,8 @@ class ReleaseBlobBase(XMLBlob):
         if not releaseVersion:
             self.log.debug("Matching rule has no application version, will not serve update.")
             return False
-        releaseVersion = MozillaVersion(releaseVersion)
-        queryVersion = MozillaVersion(updateQuery["version"])
+        releaseVersion = version_key(releaseVersion)
+        queryVersion = version_key(updateQuery["version"])
         if queryVersion > releaseVersion:
             self.log.debug("Matching rule has older version than request, will not serve update.")
             return False
@@ -249,6 +345,13 @@ class SeparatedFileUrlsMixin(object):
         return self.get("bouncerProducts", {}).get(patchKey, "")
 
     def _getUrl(self, updateQuery, patchKey, patch, specialForceHosts):
+        url = self._getPatchUrl(updateQuery, patchKey, patch)
+        # pass on forcing for special hosts (eg download.m.o for mozilla metrics)
+        if updateQuery["force"]:
+            url = self.processSpecialForceHosts(url, specialForceHosts, updateQuery["force"])
+        return url
+
+    def _getPatchUrl(self, updateQuery, patchKey, patch):
         platformData = self.getPlatformData(updateQuery["buildTarget"])
         if "fileUrl" in patch:
             url = patch["fileUrl"]
@@ -279,22 +382,19 @@ class SeparatedFileUrlsMixin(object):
             url = url.replace("%filename%", ftpFilename)
             url = url.replace("%product%", bouncerProduct)
             url = url.replace("%os_bouncer%", platformData["OS_BOUNCER"])
-        # pass on forcing for special hosts (eg download.m.o for mozilla metrics)
-        if updateQuery["force"]:
-            url = self.processSpecialForceHosts(url, specialForceHosts, updateQuery["force"])
 
         return url
 
 
 class SingleUpdateXMLMixin(object):
-    def _getPatchesXML(self, localeData, updateQuery, whitelistedDomains, specialForceHosts):
+    def _getPatchesXML(self, localeData, updateQuery, whitelistedDomains, specialForceHosts, escaped=False):
         patches = []
         for patchKey in ("complete", "partial"):
             patch = localeData.get(patchKey)
             if not patch:
                 continue
 
-            xml = self._getSpecificPatchXML(patchKey, patchKey, patch, updateQuery, whitelistedDomains, specialForceHosts)
+            xml = self._getSpecificPatchXML(patchKey, patchKey, patch, updateQuery, whitelistedDomains, specialForceHosts, escaped)
             if xml:
                 patches.append(xml)
 
@@ -458,9 +558,20 @@ class NewStyleVersionsMixin(object):
         return self.getAppVersion(platform, locale)
 
     def _getUpdateLineXML(self, updateQuery, update_type):
-        buildTarget = updateQuery["buildTarget"]
-        locale = updateQuery["locale"]
+        # The update line only depends on the blob, buildTarget, locale, and
+        # update_type, so it only needs to be built once for each of those.
+        # Blobs get replaced when they're changed (which is when their
+        # data_version changes), and the memo goes with them.
+        memo = self.getMemo("update_line")
+        if memo is None:
+            return self._buildUpdateLineXML(updateQuery["buildTarget"], updateQuery["locale"], update_type)
+        key = (updateQuery["buildTarget"], updateQuery["locale"], update_type)
+        updateLine = memo.get(key)
+        if updateLine is None:
+            updateLine = memo[key] = self._buildUpdateLineXML(*key)
+        return updateLine
 
+    def _buildUpdateLineXML(self, buildTarget, locale, update_type):
         displayVersion = self.getDisplayVersion(buildTarget, locale)
         appVersion = self.getAppVersion(buildTarget, locale)
         platformVersion = self.getPlatformVersion(buildTarget, locale)
@@ -602,11 +713,11 @@ class ReleaseBlobV2(ReleaseBlobBase, NewStyleVersionsMixin, SingleUpdateXMLMixin
 
 
 class MultipleUpdatesXMLMixin(object):
-    def _getPatchesXML(self, localeData, updateQuery, whitelistedDomains, specialForceHosts):
+    def _getPatchesXML(self, localeData, updateQuery, whitelistedDomains, specialForceHosts, escaped=False):
         patches = []
         for patchKey, patchType in (("completes", "complete"), ("partials", "partial")):
             for patch in localeData.get(patchKey, {}):
-                xml = self._getSpecificPatchXML(patchKey, patchType, patch, updateQuery, whitelistedDomains, specialForceHosts)
+                xml = self._getSpecificPatchXML(patchKey, patchType, patch, updateQuery, whitelistedDomains, specialForceHosts, escaped)
                 if xml:
                     patches.append(xml)
                     break
@@ -663,6 +774,13 @@ class ReleaseBlobV3(ReleaseBlobBase, NewStyleVersionsMixin, MultipleUpdatesXMLMi
 
 class UnifiedFileUrlsMixin(object):
     def _getUrl(self, updateQuery, patchKey, patch, specialForceHosts):
+        url = self._getPatchUrl(updateQuery, patchKey, patch)
+        # pass on forcing for special hosts (eg download.m.o for mozilla metrics)
+        if updateQuery["force"]:
+            url = self.processSpecialForceHosts(url, specialForceHosts, updateQuery["force"])
+        return url
+
+    def _getPatchUrl(self, updateQuery, patchKey, patch):
         platformData = self.getPlatformData(updateQuery["buildTarget"])
         from_ = patch["from"]
         # A fileUrl in the deep-down patch section takes priority over anything
@@ -697,10 +815,6 @@ class UnifiedFileUrlsMixin(object):
             url = url.replace("%os_ftp%", platformData["OS_FTP"])
             url = url.replace("%os_bouncer%", platformData["OS_BOUNCER"])
 
-        # pass on forcing for special hosts (eg download.m.o for mozilla metrics)
-        if updateQuery["force"]:
-            url = self.processSpecialForceHosts(url, specialForceHosts, updateQuery["force"])
-
         return url
 
 
@@ -1,5 +1,7 @@
 import json
 import logging
+import re
+from copy import deepcopy
 from os import path
 
 import jsonschema
@@ -8,6 +10,7 @@ import yaml
 # To enable shared jsonschema validators
 import auslib.util.jsonschema_validators  # noqa
 from auslib.global_state import cache
+from auslib.util.frozen import freeze, frozenError
 
 
 class BlobValidationError(ValueError):
@@ -73,11 +76,21 @@ def merge_lists(*lists):
     result = []
     for l in lists:
         for i in l:
-            if i not in result or not isinstance(i, type(result[result.index(i)])):
+            if i not in result or not isinstance(i, _mergeType(result[result.index(i)])):
                 result.append(i)
     return result
 
 
+def _mergeType(value):
+    # Frozen values (eg: from the cache) are subclasses of dict and list, and
+    # merge just like them.
+    if isinstance(value, dict):
+        return dict
+    if isinstance(value, list):
+        return list
+    return type(value)
+
+
 def merge_dicts(ancestor, left, right):
     """Perform a 3-way merge on dictonaries. We used to use an external library
     for this, but we replaced it with this because our merge can be a bit more
@@ -97,7 +110,7 @@ def merge_dicts(ancestor, left, right):
             log.warning("Ancestor is: %s", ancestor.get(key))
             log.warning("Left is: %s", left.get(key))
             log.warning("Right is: %s", right.get(key))
-        key_types = set([type(d.get(key)) for d in dicts])
+        key_types = set([_mergeType(d.get(key)) for d in dicts])
         key_types.discard(type(None))
         encoded_str_key = str(key.encode("ascii", "replace"), "utf-8")
         if len(key_types) > 1 and key_types != set([str]):
@@ -136,8 +149,23 @@ def merge_dicts(ancestor, left, right):
     return result
 
 
+_bareAmpersand = re.compile("&(?!amp;)")
+
+
+def escapeAmpersands(xml):
+    """Replaces any bare "&" in xml with "&amp;", which is all of the escaping
+    that update XML has ever had done to it. This is idempotent, so escaping
+    a fragment that has already been escaped is harmless."""
+    return _bareAmpersand.sub("&amp;", xml)
+
+
+def _unpickleBlob(cls, data):
+    return cls(**data)
+
+
 class Blob(dict):
     jsonschema = None
+    _frozen = False
 
     def __init__(self, *args, **kwargs):
         super(Blob, self).__init__(self, *args, **kwargs)
@@ -149,6 +177,99 @@ class Blob(dict):
         logger_name = "{0}.{1}".format(self.__class__.__module__, self.__class__.__name__)
         self.__class__.log = logging.getLogger(logger_name)
 
+    def __reduce__(self):
+        # Unpickled Blobs must go through __init__, otherwise the class level
+        # Logger won't exist in processes that haven't created a Blob of the
+        # same type themselves (eg: ones reading from a SharedFileCache).
+        # Memos are derived from the contents, and are rebuilt as needed, so
+        # there's no point in pickling (or copying) them.
+        state = {k: v for k, v in self.__dict__.items() if k != "_memos"}
+        return (_unpickleBlob, (self.__class__, dict(self)), state or None)
+
+    def __deepcopy__(self, memo):
+        # Deep copies are always modifiable, even if this blob is frozen.
+        state = {k: v for k, v in self.__dict__.items() if k not in ("_memos", "_frozen")}
+        blob = _unpickleBlob(self.__class__, deepcopy(dict(self), memo))
+        blob.__dict__.update(deepcopy(state, memo))
+        return blob
+
+    def freeze(self):
+        """Returns a copy of this blob that can't be modified (see
+        auslib.util.frozen), or this blob if it's already frozen. Frozen blobs
+        are what the cache hands out when make_copies is enabled, so that they
+        can be shared without being copied every time. Code that wants to
+        change one has to work on a mutableCopy instead."""
+        if self._frozen:
+            return self
+        state = {k: v for k, v in self.__dict__.items() if k != "_memos"}
+        blob = _unpickleBlob(self.__class__, {k: freeze(v) for k, v in self.items()})
+        blob.__dict__.update(state)
+        blob._frozen = True
+        return blob
+
+    def mutableCopy(self):
+        """Returns a shallow copy of this blob that can be modified. Nested
+        values are shared with this blob (and may be frozen), so they should
+        be replaced with modified copies rather than changed in place."""
+        state = {k: v for k, v in self.__dict__.items() if k not in ("_memos", "_frozen")}
+        blob = _unpickleBlob(self.__class__, dict(self))
+        blob.__dict__.update(state)
+        return blob
+
+    def _checkNotFrozen(self):
+        if self._frozen:
+            raise frozenError(self)
+
+    def __setitem__(self, key, value):
+        self._checkNotFrozen()
+        super(Blob, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._checkNotFrozen()
+        super(Blob, self).__delitem__(key)
+
+    def __ior__(self, other):
+        self._checkNotFrozen()
+        return super(Blob, self).__ior__(other)
+
+    def clear(self):
+        self._checkNotFrozen()
+        super(Blob, self).clear()
+
+    def pop(self, *args):
+        self._checkNotFrozen()
+        return super(Blob, self).pop(*args)
+
+    def popitem(self):
+        self._checkNotFrozen()
+        return super(Blob, self).popitem()
+
+    def setdefault(self, *args):
+        self._checkNotFrozen()
+        return super(Blob, self).setdefault(*args)
+
+    def update(self, *args, **kwargs):
+        self._checkNotFrozen()
+        super(Blob, self).update(*args, **kwargs)
+
+    def getMemo(self, name, maxsize=10000):
+        """Returns a dict, private to this blob object, that can be used to
+        remember things derived from the blob's contents (eg: rendered XML
+        fragments), or None if memoization isn't enabled.
+
+        Memos aren't invalidated when the blob is modified, so they're only
+        enabled when the blob cache is. Blobs that come from it are shared
+        between requests and never modified. To keep memos from growing
+        without bound, they are emptied once they have more than maxsize
+        entries."""
+        if "blob" not in cache:
+            return None
+        memos = self.__dict__.setdefault("_memos", {})
+        memo = memos.get(name)
+        if memo is None or len(memo) > maxsize:
+            memo = memos[name] = {}
+        return memo
+
     def validate(self, product, whitelistedDomains):
         """Raises a BlobValidationError if the blob is invalid."""
         self.log.debug("Validating blob %s" % self)
@@ -231,6 +352,14 @@ class XMLBlob(Blob):
     def getInnerXML(self, updateQuery, update_type, whitelistedDomains, specialForceHosts):
         raise NotImplementedError()
 
+    def getEscapedInnerXML(self, updateQuery, update_type, whitelistedDomains, specialForceHosts):
+        """
+        :return: The same fragments as getInnerXML, with ampersands already escaped, ready to be put in the
+                 response. Blobs that can produce escaped fragments more cheaply than escaping them after
+                 the fact should override this.
+        """
+        return [escapeAmpersands(x) for x in self.getInnerXML(updateQuery, update_type, whitelistedDomains, specialForceHosts)]
+
     def getHeaderXML(self):
         """
         :return: Returns the outer most header. Returns the outer most header
@@ -1,8 +1,10 @@
+import hashlib
 import itertools
 import json
 import logging
 import pprint
 import re
+import threading
 import time
 from collections import defaultdict
 from copy import copy
@@ -11,14 +13,18 @@ from os import path
 import migrate.versioning.api
 import migrate.versioning.schema
 import sqlalchemy.types
-from sqlalchemy import BigInteger, Boolean, Column, Integer, MetaData, String, Table, Text, create_engine, func, join, select
+from sqlalchemy import BigInteger, Boolean, Column, Integer, MetaData, String, Table, Text, and_, case, create_engine, func, join, or_, select, type_coerce
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.interfaces import PoolListener
-from sqlalchemy.sql.expression import null
+from sqlalchemy.sql.expression import TextClause, null
 from sqlalchemy.sql.functions import max as sql_max
+from sqlalchemy.sql.visitors import iterate
 
 from auslib.blobs.base import createBlob, merge_dicts
-from auslib.global_state import cache
+from auslib.global_state import cache, metrics, request_memo
+from auslib.util.frozen import freeze
+from auslib.util.metrics import metric_name
+from auslib.util.ruleindex import RuleIndex
 from auslib.util.rulematching import (
     matchBoolean,
     matchBuildID,
@@ -45,6 +51,87 @@ def rows_to_dicts(rows):
     return [dict(row) for row in rows]
 
 
+class Row(object):
+    """A read-only, dict-like result row, which is much cheaper to create
+    and keep around than a dict. The values are kept in a tuple, and the
+    mapping of column names to positions in it is shared by every row from
+    the same result.
+
+    Rows can be read (and compared to dicts) like dicts, but not modified.
+    Use asDict (or copy) to get a plain dict, eg: to modify it, or to
+    serialize it to JSON."""
+
+    __slots__ = ("_positions", "_values")
+
+    def __init__(self, positions, values):
+        self._positions = positions
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._positions[key]]
+
+    def get(self, key, default=None):
+        position = self._positions.get(key)
+        if position is None:
+            return default
+        return self._values[position]
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def keys(self):
+        return self._positions.keys()
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._positions, self._values)
+
+    def asDict(self):
+        return dict(zip(self._positions, self._values))
+
+    copy = asDict
+
+    def freeze(self):
+        # Rows are read-only already, but their values may not be (see
+        # auslib.util.frozen).
+        values = tuple(freeze(v) for v in self._values)
+        if all(new is old for new, old in zip(values, self._values)):
+            return self
+        return Row(self._positions, values)
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.asDict()
+        if isinstance(other, dict):
+            return self.asDict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.asDict())
+
+    def __reduce__(self):
+        return (Row, (self._positions, self._values))
+
+
+def rows_to_lightweight_rows(rows):
+    """Converts SQL Alchemy result rows to Rows, which are cheaper than
+    dicts (see rows_to_dicts), but can't be modified."""
+    if not rows:
+        return []
+    positions = {key: i for i, key in enumerate(rows[0].keys())}
+    return [Row(positions, tuple(row)) for row in rows]
+
+
 class AlreadySetupError(Exception):
     def __str__(self):
         return "Can't connect to new database, still connected to previous one"
@@ -194,6 +281,9 @@ class AUSTransaction(object):
         self.conn = self.engine.connect()
         self.trans = self.conn.begin()
         self.log = logging.getLogger(self.__class__.__name__)
+        # Rows waiting to be inserted, keyed by the Table they belong in.
+        # See queueInsert.
+        self._queued_inserts = {}
 
     def __enter__(self):
         return self
@@ -223,20 +313,66 @@ class AUSTransaction(object):
         if not self.conn.closed:
             self.conn.close()
 
-    def execute(self, statement):
+    def execute(self, statement, *multiparams):
+        if self._queued_inserts and self._usesQueuedTables(statement):
+            self.flush()
+        statement_type = type(statement).__name__.lower()
+        start = time.perf_counter()
         try:
             self.log.debug("Attempting to execute %s" % statement)
-            return self.conn.execute(statement)
+            return self.conn.execute(statement, *multiparams)
         except Exception as exc:
             self.log.debug("Caught exception")
+            metrics.incr(metric_name("db_query_errors_total", statement=statement_type))
             # We want to raise our own Exception, so that errors are easily
             # caught by consumers. The dance below lets us do that without
             # losing the original Traceback, which will be much more
             # informative than one starting from this point.
             self.rollback()
             raise TransactionError() from exc
+        finally:
+            metrics.observe(metric_name("db_query_seconds", statement=statement_type), time.perf_counter() - start)
+
+    def queueInsert(self, table, row):
+        """Queues up row (a dict of column names and values) to be inserted
+        into table. Queued rows are inserted with as few statements as
+        possible, either when the transaction is committed, or as soon as
+        another statement that uses table is executed, so that they're never
+        missing from anything that this transaction reads. This is meant for
+        history tables, which get new rows for every change, but are rarely
+        read by the transactions that make them."""
+        self._queued_inserts.setdefault(table, []).append(row)
+
+    def _usesQueuedTables(self, statement):
+        # There's no telling what tables are used by textual statements.
+        if isinstance(statement, (str, TextClause)):
+            return True
+        tables = set(element for element in iterate(statement, {}) if isinstance(element, Table))
+        # INSERT, UPDATE, and DELETE statements don't iterate over their own table.
+        tables.add(getattr(statement, "table", None))
+        return any(table in self._queued_inserts for table in tables)
+
+    def flush(self):
+        """Inserts all of the queued rows, in the order they were queued."""
+        queued_inserts, self._queued_inserts = self._queued_inserts, {}
+        for table, rows in queued_inserts.items():
+            # Each executemany needs the same columns in every row. Rows
+            # usually leave out different columns, so we fill them in with
+            # what the database would have used.
+            defaults = {}
+            for column in table.columns:
+                if column.primary_key:
+                    continue
+                if column.default is None:
+                    defaults[column.name] = None
+                elif column.default.is_scalar:
+                    defaults[column.name] = column.default.arg
+            rows = [dict(defaults, **row) for row in rows]
+            for _, batch in itertools.groupby(rows, key=lambda row: frozenset(row)):
+                self.execute(table.insert(), list(batch))
 
     def commit(self):
+        self.flush()
         try:
             self.trans.commit()
         except Exception as exc:
@@ -244,6 +380,7 @@ class AUSTransaction(object):
             raise TransactionError() from exc
 
     def rollback(self):
+        self._queued_inserts = {}
         self.trans.rollback()
 
 
@@ -365,7 +502,7 @@ class AUSTable(object):
                 query = query.where(cond)
         return query
 
-    def select(self, where=None, transaction=None, **kwargs):
+    def select(self, where=None, transaction=None, lightweight=False, **kwargs):
         """Perform a SELECT statement on this table.
            See AUSTable._selectStatement for possible arguments.
 
@@ -376,6 +513,11 @@ class AUSTable(object):
                                If provided, you must commit the transaction yourself. If None, they will
                                be added to a locally-scoped transaction and committed.
 
+           @param lightweight: Whether to return read-only Rows instead of dicts. They're cheaper to
+                               create and to keep around (eg: in a cache), so this is best for rows that
+                               are only read.
+           @type lightweight: bool
+
            @rtype: sqlalchemy.engine.base.ResultProxy
         """
 
@@ -392,8 +534,56 @@ class AUSTable(object):
             with AUSTransaction(self.getEngine()) as trans:
                 result = trans.execute(query).fetchall()
 
+        if lightweight:
+            return rows_to_lightweight_rows(result)
         return rows_to_dicts(result)
 
+    def iterSelect(self, where=None, transaction=None, lightweight=False, batch_size=100, **kwargs):
+        """Like select, but returns an iterator that fetches rows from the
+           database batch_size at a time, rather than a list of every row.
+           Where the database supports it (eg: MySQL), the query uses a server
+           side cursor, so rows that haven't been fetched yet aren't held in
+           memory either. This is meant for selects that may return a lot of
+           rows, or very large ones (eg: the data column of releases).
+
+           If no transaction is given, the one that this creates stays open
+           until the iterator is exhausted (or closed). MySQL can't run other
+           queries on a connection while it's streaming results from it, so
+           don't use the transaction for anything else until then, either.
+
+           @param batch_size: How many rows to fetch from the database at a time.
+           @type batch_size: int
+        """
+        if hasattr(where, "keys"):
+            where = [getattr(self, k) == v for k, v in where.items()]
+
+        query = self._selectStatement(where=where, **kwargs).execution_options(stream_results=True)
+
+        if transaction:
+            yield from self._iterResult(transaction.execute(query), lightweight, batch_size)
+        else:
+            with AUSTransaction(self.getEngine()) as trans:
+                yield from self._iterResult(trans.execute(query), lightweight, batch_size)
+
+    @staticmethod
+    def _iterResult(result, lightweight, batch_size):
+        try:
+            positions = None
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                if not lightweight:
+                    for row in rows:
+                        yield dict(row)
+                else:
+                    if positions is None:
+                        positions = {key: i for i, key in enumerate(rows[0].keys())}
+                    for row in rows:
+                        yield Row(positions, tuple(row))
+        finally:
+            result.close()
+
     def _insertStatement(self, **columns):
         """Create an INSERT statement for this table
 
@@ -758,9 +948,63 @@ class HistoryTable(AUSTable):
                 # unless they have been explicitely set to True or False.
                 newcol.unique = None
             self.table.append_column(newcol)
+        # Rows that have no non-primary key data represent deleted rows.
+        self.non_primary_key_columns = [col.name for col in self.baseTable.t.get_children() if not col.primary_key]
+        self._checkpoint_lock = threading.Lock()
+        self._checkpoints_scheduled = 0
         AUSTable.__init__(self, db, dialect, historyClass=None, versioned=False)
 
+    # How far below the latest change_id getChangesVersion looks for changes
+    # that were committed late.
+    late_commit_window = 1000
+
+    def getChangesVersion(self, transaction=None):
+        """Returns a value that changes whenever a row is added to this table,
+           which happens whenever anything in the base table changes.
+
+           The latest change_id alone isn't enough, because change_ids are
+           handed out when rows are inserted, not when they're committed. If
+           two transactions commit out of order, the higher change_id becomes
+           visible first, and the lower one becomes visible later without
+           changing the latest change_id. To catch those late commits, we also
+           count the changes with change_ids close to the latest one."""
+        latest = select([sql_max(self.change_id)]).correlate(None).as_scalar()
+        row = self.select(
+            columns=[sql_max(self.change_id).label("change_id"), func.count().label("count")],
+            where=[self.change_id > latest - self.late_commit_window],
+            transaction=transaction,
+        )[0]
+        return (row["change_id"], row["count"])
+
+    # If the "history_checkpoints" cache exists, point in time queries start
+    # from a checkpoint of what the base table looked like after a given
+    # change, and only replay the history that came after it. A checkpoint is
+    # made every checkpoint_interval changes, but only once those changes
+    # are checkpoint_delay seconds old, so that changes from transactions
+    # that were still in progress can't be left out of one. Checkpoints are
+    # made in a background thread (see updateCheckpoints), never while a
+    # request waits for them.
+    checkpoint_interval = 1000
+    checkpoint_delay = 300
+
+    def _isLive(self, row):
+        return any([row[col] for col in self.non_primary_key_columns])
+
+    def _primaryKeyOf(self, row):
+        return tuple(row[col] for col in self.base_primary_key)
+
     def getPointInTime(self, timestamp, transaction=None):
+        """Returns every row of the base table as it was at the given
+        timestamp, ordered by change_id."""
+        if "history_checkpoints" in cache:
+            if transaction:
+                rows = self._getPointInTimeFromCheckpoint(int(timestamp), transaction)
+            else:
+                with AUSTransaction(self.getEngine()) as trans:
+                    rows = self._getPointInTimeFromCheckpoint(int(timestamp), trans)
+            if rows is not None:
+                return rows
+
         # The inner query here gets one change id for every unique object in
         # the base table. Filtering by timestamp < provided timestamp means
         # we won't get any results most recent than the requested timestamp.
@@ -780,21 +1024,118 @@ class HistoryTable(AUSTable):
              )
         ))
         # fmt: on
+        q = q.execution_options(stream_results=True)
+
+        # Filter out any rows that have been deleted. Rows are streamed from
+        # the database so that deleted ones are never all held in memory at
+        # once.
+        def liveRows(result):
+            return [row for row in self._iterResult(result, False, 100) if self._isLive(row)]
+
         if transaction:
-            result = transaction.execute(q).fetchall()
+            return liveRows(transaction.execute(q))
         else:
             with AUSTransaction(self.getEngine()) as trans:
-                result = trans.execute(q).fetchall()
+                return liveRows(trans.execute(q))
+
+    def _getPointInTimeFromCheckpoint(self, timestamp, trans):
+        """Returns the same thing as getPointInTime, starting from the newest
+        checkpoint that has no changes newer than timestamp in it, or None if
+        there isn't one."""
+        checkpoints = cache.get("history_checkpoints", self.t.name) or ()
+        if not checkpoints:
+            self._scheduleCheckpointUpdate()
+            return None
 
-        rows = []
-        # Filter out any rows who have no non-primary key data, because this
-        # means the row has been deleted.
-        non_primary_key_columns = [col.name for col in self.baseTable.t.get_children() if not col.primary_key]
-        for row in result:
-            if any([row[col] for col in non_primary_key_columns]):
-                rows.append(row)
+        for checkpoint in reversed(checkpoints):
+            if checkpoint[1] <= timestamp:
+                break
+        else:
+            return None
+
+        # Timestamps aren't strictly in change_id order, so there may be
+        # changes after the checkpoint that are older than timestamp, too.
+        change_id, _, rows = checkpoint
+        q = select(self.table.get_children()).where(self.change_id > change_id).where(self.timestamp <= timestamp).order_by(self.change_id)
+        rows = dict(rows)
+        replayed = 0
+        for row in self._iterResult(trans.execute(q.execution_options(stream_results=True)), False, 100):
+            rows[self._primaryKeyOf(row)] = row
+            replayed += 1
+
+        if checkpoint is checkpoints[-1] and replayed >= self.checkpoint_interval:
+            self._scheduleCheckpointUpdate()
+        return sorted((dict(row) for row in rows.values() if self._isLive(row)), key=lambda row: row["change_id"])
+
+    def _scheduleCheckpointUpdate(self):
+        # New checkpoints can only be made once changes are checkpoint_delay
+        # seconds old, so there's no point in looking for them more often.
+        now = time.time()
+        if now - self._checkpoints_scheduled < self.checkpoint_delay or not self._checkpoint_lock.acquire(blocking=False):
+            return
+        self._checkpoints_scheduled = now
+
+        def update():
+            try:
+                self.updateCheckpoints()
+            except Exception:
+                self.log.exception("Failed to update history checkpoints for %s", self.t.name)
+            finally:
+                self._checkpoint_lock.release()
+
+        threading.Thread(target=update, name="history-checkpoints-%s" % self.t.name, daemon=True).start()
+
+    def updateCheckpoints(self):
+        """Makes checkpoints (see getPointInTime) for any history that's old
+        enough and hasn't been checkpointed yet, and returns all of the
+        checkpoints for this table.
+
+        Each checkpoint is a tuple of the last change_id in it, the newest
+        timestamp in it, and a dict of the rows that existed after that change
+        (keyed by primary key)."""
+        checkpoints = cache.get("history_checkpoints", self.t.name) or ()
+        if checkpoints:
+            change_id, max_timestamp, rows = checkpoints[-1]
+        else:
+            change_id, max_timestamp, rows = 0, 0, {}
+
+        cutoff = getMillisecondTimestamp() - self.checkpoint_delay * 1000
+        with AUSTransaction(self.getEngine()) as trans:
+            # Most of the time there isn't enough new history for another
+            # checkpoint, which is much cheaper to find out than going through it.
+            if self.count(where=[self.change_id > change_id, self.timestamp <= cutoff], transaction=trans) < self.checkpoint_interval:
+                return checkpoints
+
+            q = select(self.table.get_children()).where(self.change_id > change_id).order_by(self.change_id)
+            new_checkpoints = []
+            changes = []
+            for row in self._iterResult(trans.execute(q.execution_options(stream_results=True)), False, 100):
+                changes.append(row)
+                max_timestamp = max(max_timestamp, row["timestamp"])
+                if len(changes) < self.checkpoint_interval:
+                    continue
+                if max_timestamp > cutoff:
+                    break
+                rows = dict(rows)
+                for change in changes:
+                    pk = self._primaryKeyOf(change)
+                    if self._isLive(change):
+                        rows[pk] = change
+                    else:
+                        rows.pop(pk, None)
+                new_checkpoints.append((changes[-1]["change_id"], max_timestamp, rows))
+                changes = []
+
+        if new_checkpoints:
+            checkpoints = tuple(checkpoints) + tuple(new_checkpoints)
+            cache.put("history_checkpoints", self.t.name, checkpoints)
+        return checkpoints
 
-        return rows_to_dicts(rows)
+    def _queueInsert(self, trans, **columns):
+        # History rows are inserted in batches, when the transaction is
+        # committed (or before then, if it needs them). Their timestamps are
+        # still those of the changes they record.
+        trans.queueInsert(self.t, {k: columns[k] for k in columns.keys() if k in self.table.c})
 
     def forInsert(self, insertedKeys, columns, changed_by, trans):
         """Inserts cause two rows in the History table to be created. The first
@@ -811,10 +1152,8 @@ class HistoryTable(AUSTable):
             columns[name] = insertedKeys[i]
 
         ts = getMillisecondTimestamp()
-        query, _ = self._insertStatement(changed_by=changed_by, timestamp=ts - 1, **primary_key_data)
-        trans.execute(query)
-        query, _ = self._insertStatement(changed_by=changed_by, timestamp=ts, **columns)
-        trans.execute(query)
+        self._queueInsert(trans, changed_by=changed_by, timestamp=ts - 1, **primary_key_data)
+        self._queueInsert(trans, changed_by=changed_by, timestamp=ts, **columns)
 
     def forDelete(self, rowData, changed_by, trans):
         """Deletes cause a single row to be created, which only contains the
@@ -826,8 +1165,7 @@ class HistoryTable(AUSTable):
         # Tack on history table information to the row
         row["changed_by"] = changed_by
         row["timestamp"] = getMillisecondTimestamp()
-        query, _ = self._insertStatement(**row)
-        trans.execute(query)
+        self._queueInsert(trans, **row)
 
     def forUpdate(self, rowData, changed_by, trans):
         """Updates cause a single row to be created, which contains the full,
@@ -838,8 +1176,7 @@ class HistoryTable(AUSTable):
             row[str(k)] = table_row_data[k]
         row["changed_by"] = changed_by
         row["timestamp"] = getMillisecondTimestamp()
-        query, _ = self._insertStatement(**row)
-        trans.execute(query)
+        self._queueInsert(trans, **row)
 
     def getChange(self, change_id=None, column_values=None, data_version=None, transaction=None):
         """ Returns the unique change that matches the give change_id or
@@ -1526,6 +1863,9 @@ class Rules(AUSTable):
         )
 
         AUSTable.__init__(self, db, dialect, scheduled_changes=True, historyClass=HistoryTable)
+        # The most recently built RuleIndex, if the "rules_index" cache is
+        # enabled. See getRuleIndex for details.
+        self._rule_index = None
 
     def getPotentialRequiredSignoffs(self, affected_rows, transaction=None):
         potential_required_signoffs = {}
@@ -1590,10 +1930,64 @@ class Rules(AUSTable):
         """Returns all of the rules, sorted in ascending order"""
         return self.select(where=where, order_by=(self.priority, self.version, self.mapping), transaction=transaction)
 
-    def getRulesMatchingQuery(self, updateQuery, fallbackChannel, transaction=None):
+    def getRuleIndex(self, transaction=None):
+        """Returns a RuleIndex for the current state of the rules table, or
+           None if the "rules_index" cache isn't enabled.
+
+           The index is expensive to build, so the cache is only used to
+           decide how often we check whether it's out of date. When it has
+           expired, we look up the latest version of the rules table (see
+           HistoryTable.getChangesVersion), and only rebuild the index if that
+           has changed. New indexes are built from
+           scratch and swapped in at once, so a request never sees a partially
+           updated index."""
+        if "rules_index" not in cache:
+            return None
+
+        def getIndex():
+            version = self.history.getChangesVersion(transaction=transaction)
+            index = self._rule_index
+            if index is None or index.version != version:
+                self.log.debug("Building rule index for version %s", version)
+                index = RuleIndex(self.select(transaction=transaction, lightweight=True), version=version)
+                self._rule_index = index
+            return index
+
+        return request_memo.get("rules_index", "rules", lambda: cache.get("rules_index", "rules", getIndex))
+
+    def getBestRuleMatchingQuery(self, updateQuery, fallbackChannel, transaction=None, trace=None):
+        """Returns the highest priority rule that matches the given update
+           query, or None if no rules match."""
+        index = self.getRuleIndex(transaction=transaction)
+        if index is not None:
+            rule = index.getBestMatch(updateQuery, fallbackChannel, trace=trace)
+            self.log.debug("Best match: %s", rule)
+            return rule
+
+        rules = self.getRulesMatchingQuery(updateQuery, fallbackChannel=fallbackChannel, transaction=transaction, trace=trace)
+        if not rules:
+            return None
+        # max() returns the first of the highest priority rules, which is
+        # consistent with sorting them and taking the first one.
+        return max(rules, key=lambda rule: rule["priority"])
+
+    def getRulesMatchingQuery(self, updateQuery, fallbackChannel, transaction=None, trace=None):
         """Returns all of the rules that match the given update query.
            For cases where a particular updateQuery channel has no
-           fallback, fallbackChannel should match the channel from the query."""
+           fallback, fallbackChannel should match the channel from the query.
+           If a RuleTrace is given, the time spent in, and rules rejected by,
+           each stage of matching are recorded in it."""
+
+        index = self.getRuleIndex(transaction=transaction)
+        if index is not None:
+            # The index returns rules in priority order, but callers of this
+            # method have always received them in table order.
+            return sorted(index.getMatchingRules(updateQuery, fallbackChannel, trace=trace), key=lambda rule: rule["rule_id"])
+
+        def check(stage, matcher, *args):
+            if trace is None:
+                return matcher(*args)
+            return trace.check(stage, matcher, *args)
 
         def getRawMatches():
             where = [
@@ -1612,7 +2006,7 @@ class Rules(AUSTable):
                 where.extend([(self.distVersion == null())])
 
             self.log.debug("where: %s", where)
-            return self.select(where=where, transaction=transaction)
+            return self.select(where=where, transaction=transaction, lightweight=True)
 
         # This cache key is constructed from all parts of the updateQuery that
         # are used in the select() to get the "raw" rule matches. For the most
@@ -1626,51 +2020,59 @@ class Rules(AUSTable):
             updateQuery.get("distVersion"),
             updateQuery.get("force"),
         )
-        rules = cache.get("rules", cache_key, getRawMatches)
+        if trace is None:
+            rules = request_memo.get("rules", cache_key, lambda: cache.get("rules", cache_key, getRawMatches))
+        else:
+            with trace.timed("select"):
+                rules = request_memo.get("rules", cache_key, lambda: cache.get("rules", cache_key, getRawMatches))
 
         self.log.debug("Raw matches:")
 
         matchingRules = []
         for rule in rules:
             self.log.debug(rule)
+            if trace is not None:
+                trace.candidates += 1
 
             # Resolve special means for channel, version, and buildID - dropping
             # rules that don't match after resolution.
-            if not matchChannel(rule["channel"], updateQuery["channel"], fallbackChannel):
+            if not check("channel", matchChannel, rule["channel"], updateQuery["channel"], fallbackChannel):
                 self.log.debug("%s doesn't match %s", rule["channel"], updateQuery["channel"])
                 continue
-            if not matchVersion(rule["version"], updateQuery["version"], get_version_class(updateQuery["product"])):
+            if not check("version", matchVersion, rule["version"], updateQuery["version"], get_version_class(updateQuery["product"])):
                 self.log.debug("%s doesn't match %s", rule["version"], updateQuery["version"])
                 continue
-            if not matchBuildID(rule["buildID"], updateQuery.get("buildID", "")):
+            if not check("buildID", matchBuildID, rule["buildID"], updateQuery.get("buildID", "")):
                 self.log.debug("%s doesn't match %s", rule["buildID"], updateQuery["buildID"])
                 continue
-            if not matchMemory(rule["memory"], updateQuery.get("memory", "")):
+            if not check("memory", matchMemory, rule["memory"], updateQuery.get("memory", "")):
                 self.log.debug("%s doesn't match %s", rule["memory"], updateQuery.get("memory"))
                 continue
             # To help keep the rules table compact, multiple OS versions may be
             # specified in a single rule. They are comma delimited, so we need to
             # break them out and create clauses for each one.
-            if not matchSimpleExpression(rule["osVersion"], updateQuery.get("osVersion", "")):
+            if not check("osVersion", matchSimpleExpression, rule["osVersion"], updateQuery.get("osVersion", "")):
                 self.log.debug("%s doesn't match %s", rule["osVersion"], updateQuery["osVersion"])
                 continue
-            if not matchCsv(rule["instructionSet"], updateQuery.get("instructionSet", ""), substring=False):
+            if not check("instructionSet", matchCsv, rule["instructionSet"], updateQuery.get("instructionSet", ""), False):
                 self.log.debug("%s doesn't match %s", rule["instructionSet"], updateQuery.get("instructionSet"))
                 continue
-            if not matchCsv(rule["distribution"], updateQuery.get("distribution", ""), substring=False):
+            if not check("distribution", matchCsv, rule["distribution"], updateQuery.get("distribution", ""), False):
                 self.log.debug("%s doesn't match %s", rule["distribution"], updateQuery.get("distribution"))
                 continue
             # Locales may be a comma delimited rule too, exact matches only
-            if not matchLocale(rule["locale"], updateQuery.get("locale", "")):
+            if not check("locale", matchLocale, rule["locale"], updateQuery.get("locale", "")):
                 self.log.debug("%s doesn't match %s", rule["locale"], updateQuery["locale"])
                 continue
-            if not matchBoolean(rule["mig64"], updateQuery.get("mig64")):
+            if not check("mig64", matchBoolean, rule["mig64"], updateQuery.get("mig64")):
                 self.log.debug("%s doesn't match %s", rule["mig64"], updateQuery.get("mig64"))
                 continue
-            if not matchBoolean(rule["jaws"], updateQuery.get("jaws")):
+            if not check("jaws", matchBoolean, rule["jaws"], updateQuery.get("jaws")):
                 self.log.debug("%s doesn't match %s", rule["jaws"], updateQuery.get("jaws"))
                 continue
 
+            if trace is not None:
+                trace.matched += 1
             matchingRules.append(rule)
 
         self.log.debug("Reduced matches:")
@@ -1835,30 +2237,36 @@ class Releases(AUSTable):
         else:
             column = [self.name, self.product, self.data_version, self.read_only]
 
-        rows = self.select(where=where, columns=column, limit=limit, transaction=transaction)
+        if nameOnly:
+            return self.select(where=where, columns=column, limit=limit, transaction=transaction)
 
-        if not nameOnly:
-            j = join(
-                self.db.releases.t,
-                self.db.rules.t,
-                ((self.db.releases.name == self.db.rules.mapping) | (self.db.releases.name == self.db.rules.fallbackMapping)),
+        j = join(
+            self.db.releases.t,
+            self.db.rules.t,
+            ((self.db.releases.name == self.db.rules.mapping) | (self.db.releases.name == self.db.rules.fallbackMapping)),
+        )
+        if transaction:
+            ref_list = transaction.execute(
+                select([self.db.releases.name, self.db.rules.rule_id, self.db.rules.product, self.db.rules.channel]).select_from(j)
+            ).fetchall()
+        else:
+            ref_list = (
+                self.getEngine()
+                .execute(select([self.db.releases.name, self.db.rules.rule_id, self.db.rules.product, self.db.rules.channel]).select_from(j))
+                .fetchall()
             )
-            if transaction:
-                ref_list = transaction.execute(
-                    select([self.db.releases.name, self.db.rules.rule_id, self.db.rules.product, self.db.rules.channel]).select_from(j)
-                ).fetchall()
-            else:
-                ref_list = (
-                    self.getEngine()
-                    .execute(select([self.db.releases.name, self.db.rules.rule_id, self.db.rules.product, self.db.rules.channel]).select_from(j))
-                    .fetchall()
-                )
+        refs_by_name = defaultdict(list)
+        for ref in ref_list:
+            refs_by_name[ref[0]].append(ref)
 
-            for row in rows:
-                refs = [ref for ref in ref_list if ref[0] == row["name"]]
-                ref_list = [ref for ref in ref_list if ref[0] != row["name"]]
-                row["rule_ids"] = [ref[1] for ref in refs]
-                row["rule_info"] = {str(ref[1]): {"product": ref[2], "channel": ref[3]} for ref in refs}
+        # There can be a lot of releases, so rather than fetching all of them
+        # before adding their rule references, we add them as they're fetched.
+        rows = []
+        for row in self.iterSelect(where=where, columns=column, limit=limit, transaction=transaction):
+            refs = refs_by_name.get(row["name"], [])
+            row["rule_ids"] = [ref[1] for ref in refs]
+            row["rule_info"] = {str(ref[1]): {"product": ref[2], "channel": ref[3]} for ref in refs}
+            rows.append(row)
 
         return rows
 
@@ -1866,23 +2274,31 @@ class Releases(AUSTable):
         return self.getReleaseInfo(nameOnly=True, **kwargs)
 
     def getReleaseBlob(self, name, transaction=None):
+        return request_memo.get("release_blob", name, lambda: self._getReleaseBlob(name, transaction=transaction))
+
+    def _selectDataVersion(self, name, transaction=None):
+        try:
+            return self.select(where=[self.name == name], columns=[self.data_version], limit=1, transaction=transaction, lightweight=True)[0]
+        except IndexError:
+            raise KeyError("Couldn't find release with name '%s'" % name)
+
+    def getReleaseDataVersion(self, name, transaction=None):
+        """Returns the current data_version of the named release, or raises a
+           KeyError if it doesn't exist. The blob version cache is used if
+           possible, so this is much cheaper than loading the release."""
+        return self._getDataVersion(cache.get("blob_version", name, lambda: self._selectDataVersion(name, transaction=transaction)))
+
+    def _getReleaseBlob(self, name, transaction=None):
         # Putting the data_version and blob getters into these methods lets us
         # delegate the decision about whether or not to use the cached values
         # to the cache class. It will either return as a cached value, or use
         # the getter to return a fresh value (and cache it).
-        def getDataVersion():
-            try:
-                return self.select(where=[self.name == name], columns=[self.data_version], limit=1, transaction=transaction)[0]
-            except IndexError:
-                raise KeyError("Couldn't find release with name '%s'" % name)
-
-        data_version = cache.get("blob_version", name, getDataVersion)
+        data_version = cache.get("blob_version", name, lambda: self._selectDataVersion(name, transaction=transaction))
 
-        def getBlob():
+        def getBlob(previous=None):
             try:
-                row = self.select(where=[self.name == name], columns=[self.data], limit=1, transaction=transaction)[0]
-                blob = row["data"]
-                return {"data_version": data_version, "blob": blob}
+                row = self.select(where=[self.name == name], columns=[self._rawData()], limit=1, transaction=transaction)[0]
+                return self._loadBlob(data_version, row["data"], previous)
             except IndexError:
                 raise KeyError("Couldn't find release with name '%s'" % name)
 
@@ -1898,7 +2314,7 @@ class Releases(AUSTable):
         # of the cached blob and the latest data version don't match, we need
         # to update the cache with the latest blob.
         if get_data_version(data_version) > get_data_version(cached_blob["data_version"]):
-            blob_info = getBlob()
+            blob_info = getBlob(previous=cached_blob)
             cache.put("blob", name, blob_info)
             blob = blob_info["blob"]
         else:
@@ -1917,6 +2333,141 @@ class Releases(AUSTable):
 
         return blob
 
+    def getReleaseBuildIDs(self, name, transaction=None):
+        """Returns the buildID index (see ReleaseBlobBase.getBuildIDIndex) of
+           the named release, or raises a KeyError if it doesn't exist.
+
+           Indexes are cached separately from blobs, and are much smaller, so
+           they can outlive the blobs they were built from in the cache. This
+           matters most for releases that are only referenced as the "from"
+           release of partials, which would otherwise have to be loaded in
+           full just to compare a buildID. Like blobs, a cached index is only
+           used if it's at least as new as the release's current data_version.
+           Blobs that are loaded to build an index aren't cached."""
+        return request_memo.get("release_buildids", name, lambda: self._getReleaseBuildIDs(name, transaction=transaction))
+
+    def _getReleaseBuildIDs(self, name, transaction=None):
+        if "release_buildids" not in cache:
+            return self.getReleaseBlob(name, transaction=transaction).getBuildIDIndex()
+
+        data_version = self.getReleaseDataVersion(name, transaction=transaction)
+        cached = cache.get("release_buildids", name)
+        if cached and cached["data_version"] >= data_version:
+            return cached["index"]
+
+        cached_blob = cache.get("blob", name)
+        if cached_blob and self._getDataVersion(cached_blob["data_version"]) >= data_version:
+            blob = cached_blob["blob"]
+        else:
+            # Releases that we only need the index of are usually just the
+            # "from" release of partials, so they aren't put in the blob
+            # cache, where they'd push out releases that are served.
+            try:
+                row = self.select(where=[self.name == name], columns=[self.data_version, self._rawData()], limit=1, transaction=transaction)[0]
+            except IndexError:
+                raise KeyError("Couldn't find release with name '%s'" % name)
+            blob_info = self._loadBlob(row["data_version"], row["data"])
+            data_version, blob = blob_info["data_version"], blob_info["blob"]
+
+        index = blob.getBuildIDIndex()
+        cache.put("release_buildids", name, {"data_version": data_version, "index": index})
+        return index
+
+    def _rawData(self):
+        # The data column, without the conversion to a Blob. See _loadBlob.
+        return type_coerce(self.data, Text).label("data")
+
+    def _loadBlob(self, data_version, data, previous=None):
+        """Returns a blob cache entry for the raw JSON from the data column.
+           A hash of the JSON is stored in the entry, and if previous (an
+           older cache entry for the same release) has the same hash, its
+           blob is reused rather than parsing the JSON again. This is common
+           when a release gets a new data_version without its contents
+           actually changing."""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        data_hash = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        if previous and previous.get("hash") == data_hash:
+            metrics.incr("blob_reparses_avoided")
+            blob = previous["blob"]
+        else:
+            metrics.incr("blob_parses")
+            blob = createBlob(data)
+        return {"data_version": self._getDataVersion(data_version), "blob": blob, "hash": data_hash}
+
+    @staticmethod
+    def _getDataVersion(obj):
+        # Cached data versions may be either plain ints, or rows from the
+        # data_version column.
+        if isinstance(obj, int):
+            return obj
+        return obj["data_version"]
+
+    def getReleasesByName(self, names, transaction=None):
+        """Returns a dict of the name, product, data_version, and data of each
+           of the given releases (keyed by name), fetched in a single query.
+           Releases that don't exist are left out.
+
+           The data column is only transferred for releases whose blob isn't
+           already cached at the current data_version. Either way, the blob and
+           blob version caches are brought up to date with the results."""
+        return request_memo.get_many("release", tuple(set(names)), lambda names: self._getReleasesByName(names, transaction=transaction))
+
+    def _getReleasesByName(self, names, transaction=None):
+        names = tuple(names)
+        if not names:
+            return {}
+
+        cached = {}
+        for name in names:
+            cached_blob = cache.get("blob", name)
+            if cached_blob:
+                cached[name] = cached_blob
+
+        if cached:
+            unchanged = or_(
+                *[and_(self.name == name, self.data_version == self._getDataVersion(cached_blob["data_version"])) for name, cached_blob in cached.items()]
+            )
+            data = type_coerce(case([(unchanged, null())], else_=self.data), Text).label("data")
+        else:
+            data = self._rawData()
+
+        releases = {}
+        for row in self.select(columns=[self.name, self.product, self.data_version, data], where=[self.name.in_(names)], transaction=transaction):
+            name = row["name"]
+            if row["data"] is None:
+                row["data"] = cached[name]["blob"]
+            else:
+                blob_info = self._loadBlob(row["data_version"], row["data"], cached.get(name))
+                row["data"] = blob_info["blob"]
+                cache.put("blob", name, blob_info)
+            cache.put("blob_version", name, row["data_version"])
+            releases[name] = row
+
+        return releases
+
+    def getReleaseBlobs(self, names, transaction=None):
+        """Like getReleaseBlob, but for many releases at once. Returns a dict
+           of blobs keyed by release name. Blobs that are cached, and not
+           outdated according to the blob version cache, are returned from the
+           cache. The rest are looked up with a single call to getReleasesByName.
+           Releases that don't exist are left out."""
+        blobs = {}
+        uncached = []
+        for name in set(names):
+            data_version = cache.get("blob_version", name)
+            cached_blob = cache.get("blob", name)
+            if data_version is not None and cached_blob and self._getDataVersion(data_version) <= self._getDataVersion(cached_blob["data_version"]):
+                blobs[name] = cached_blob["blob"]
+            else:
+                uncached.append(name)
+
+        if uncached:
+            for name, release in self.getReleasesByName(uncached, transaction=transaction).items():
+                blobs[name] = release["data"]
+
+        return blobs
+
     def insert(self, changed_by, transaction=None, dryrun=False, signoffs=None, **columns):
         if "name" not in columns or "product" not in columns or "data" not in columns:
             raise ValueError("name, product, and data are all required")
@@ -2036,7 +2587,8 @@ class Releases(AUSTable):
                     new_data_version = tip_data_version + 1
 
             if not dryrun:
-                cache.put("blob", name, {"data_version": new_data_version, "blob": blob})
+                # If the update was merged, what["data"] is the merged blob.
+                cache.put("blob", name, {"data_version": new_data_version, "blob": what.get("data")})
                 cache.put("blob_version", name, new_data_version)
 
     def addLocaleToRelease(self, name, product, platform, locale, data, old_data_version, changed_by, transaction=None, alias=None):
@@ -2052,29 +2604,28 @@ class Releases(AUSTable):
         if not self.db.hasPermission(changed_by, "release_locale", "modify", product, transaction):
             raise PermissionDeniedError("%s is not allowed to add builds for product %s" % (changed_by, product))
 
-        releaseBlob = self.getReleaseBlob(name, transaction=transaction)
-        if "platforms" not in releaseBlob:
-            releaseBlob["platforms"] = {}
+        # The blob we get back may be shared with the cache (and frozen), so
+        # rather than modifying it in place, we copy it, and each part of it
+        # that we change along the way. Everything else is shared between the
+        # old blob and the new one.
+        releaseBlob = self.getReleaseBlob(name, transaction=transaction).mutableCopy()
+        platforms = releaseBlob["platforms"] = dict(releaseBlob.get("platforms", {}))
 
-        if platform in releaseBlob["platforms"]:
+        if platform in platforms:
             # If the platform we're given is aliased to another one, we need
             # to resolve that before doing any updating. If we don't, the data
             # will go into an aliased platform and be ignored!
             platform = releaseBlob.getResolvedPlatform(platform)
 
-        if platform not in releaseBlob["platforms"]:
-            releaseBlob["platforms"][platform] = {}
-
-        if "locales" not in releaseBlob["platforms"][platform]:
-            releaseBlob["platforms"][platform]["locales"] = {}
-
-        releaseBlob["platforms"][platform]["locales"][locale] = data
+        platformData = platforms[platform] = dict(platforms.get(platform, {}))
+        locales = platformData["locales"] = dict(platformData.get("locales", {}))
+        locales[locale] = data
 
         # we don't allow modification of existing platforms (aliased or not)
         if alias:
             for a in alias:
-                if a not in releaseBlob["platforms"]:
-                    releaseBlob["platforms"][a] = {"alias": platform}
+                if a not in platforms:
+                    platforms[a] = {"alias": platform}
 
         releaseBlob.validate(product, self.domainWhitelist)
         what = dict(data=releaseBlob)
@@ -2423,6 +2974,10 @@ class Dockerflow(AUSTable):
 
 
 class EmergencyShutoffs(AUSTable):
+    # Shutoffs are too important to rely on the version alone, so snapshots
+    # are reloaded at least this often (in seconds), even if it hasn't changed.
+    snapshot_max_age = 300
+
     def __init__(self, db, metadata, dialect):
         self.table = Table(
             "emergency_shutoffs",
@@ -2431,6 +2986,38 @@ class EmergencyShutoffs(AUSTable):
             Column("channel", String(75), nullable=False, primary_key=True),
         )
         AUSTable.__init__(self, db, dialect, scheduled_changes=True, scheduled_changes_kwargs={"conditions": ["time"]}, historyClass=HistoryTable)
+        # (version, load time, frozenset of (product, channel)) of the last
+        # snapshot loaded by getShutoffs.
+        self._snapshot = None
+
+    def _loadShutoffs(self, transaction=None):
+        return frozenset(
+            (row["product"], row["channel"]) for row in self.select(columns=[self.product, self.channel], transaction=transaction, lightweight=True)
+        )
+
+    def getShutoffs(self, transaction=None):
+        """Returns a frozenset of all of the (product, channel) pairs that
+           updates are shut off for.
+
+           The table is tiny, so it is always loaded in its entirety. If the
+           "updates_disabled" cache is enabled, the snapshot is cached, and
+           when it expires we only reload the table if its version (see
+           HistoryTable.getChangesVersion) has changed, or if the snapshot is
+           more than snapshot_max_age seconds old."""
+        if "updates_disabled" not in cache:
+            return request_memo.get("shutoffs", "shutoffs", lambda: self._loadShutoffs(transaction=transaction))
+
+        def getSnapshot():
+            version = self.history.getChangesVersion(transaction=transaction)
+            now = time.time()
+            snapshot = self._snapshot
+            if snapshot is None or snapshot[0] != version or now - snapshot[1] > self.snapshot_max_age:
+                self.log.debug("Loading emergency shutoffs for version %s", version)
+                snapshot = (version, now, self._loadShutoffs(transaction=transaction))
+                self._snapshot = snapshot
+            return snapshot[2]
+
+        return request_memo.get("shutoffs", "shutoffs", lambda: cache.get("updates_disabled", "shutoffs", getSnapshot))
 
     def insert(self, changed_by, transaction=None, dryrun=False, **columns):
         if not self.db.hasPermission(changed_by, "emergency_shutoff", "create", columns.get("product"), transaction):
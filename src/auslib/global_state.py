@@ -1,4 +1,6 @@
 from auslib.util.cache import MaybeCacher
+from auslib.util.metrics import Metrics, metric_name
+from auslib.util.requestmemo import RequestMemo
 
 # auslib is a library that contains two different webapps. Both of them share
 # a single database model, and some code (release blobs, for example), need
@@ -35,3 +37,23 @@ dbo = DbWrapper()
 # wrapper that does nothing if caching is disabled, and uses a 3rd party
 # caching library if it is enabled.
 cache = MaybeCacher()
+
+# Counters for things that are interesting to keep track of, but aren't worth
+# logging every time they happen.
+metrics = Metrics()
+
+# Lookups that are done more than once while handling a single request (eg:
+# by SuperBlobs) are remembered for the rest of it. Outside of a request's
+# memo scope, this does nothing.
+request_memo = RequestMemo()
+
+
+def _cache_metrics():
+    values = {}
+    for name, stats in cache.stats().items():
+        for stat, value in stats.items():
+            values[metric_name("cache_%s_total" % stat, cache=name)] = value
+    return values
+
+
+metrics.add_collector(_cache_metrics)
@@ -1,7 +1,174 @@
-from copy import deepcopy
+import hashlib
+import math
+import mmap
+import os
+import pickle
+import random
+import stat
+import tempfile
+import time
+from collections import OrderedDict
 
 from repoze.lru import ExpiringLRUCache
 
+from auslib.util.frozen import freeze
+from auslib.util.singleflight import SingleFlight
+
+
+class SharedFileCache(object):
+    """A cache that stores pickled values as files in a directory, which
+    allows multiple processes (eg: uwsgi workers) to share a single copy of
+    each entry. Pointing it at a memory backed filesystem (like /dev/shm)
+    makes it a shared memory cache, and means that newly started workers
+    begin with a warm cache.
+
+    Entries are written to a temporary file and renamed into place, so
+    readers will only ever see complete entries. Files are memory mapped to
+    read them. Each process also keeps the unpickled values of the
+    local_size entries that it used most recently, which are reused for as
+    long as the files on disk haven't been replaced. This is kept small,
+    because the point of sharing the cache is to not have a copy of every
+    entry in every process. The cost is that entries outside of it are
+    unpickled again each time they're used.
+
+    This class implements the parts of the ExpiringLRUCache interface that
+    MaybeCacher uses. The modification time of each file is set to the
+    expiry time of its entry, and when the cache is full, expired entries are
+    evicted first, followed by the ones that expire soonest. (Which, unless
+    timeouts vary, are the least recently *written* ones.) To avoid scanning
+    the directory on every put, it's only checked every size / 10 puts, so
+    the cache may briefly hold a little more than size entries.
+
+    Entries are pickled, so the directory must be owned by the current user
+    and must not be writable by anybody else."""
+
+    def __init__(self, directory, size, default_timeout, local_size=8):
+        size = int(size)
+        if size < 1:
+            raise ValueError("size must be >0")
+        self.directory = directory
+        self.size = size
+        self.default_timeout = default_timeout
+        self.local_size = local_size
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # makedirs doesn't change the mode of a directory that already exists.
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise ValueError("%s must be a directory that is owned by the current user, and not writable by anybody else" % directory)
+        self._local = OrderedDict()
+        self._evict_interval = max(1, size // 10)
+        self._puts_since_evict = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+
+    def _iter_entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                yield entry
+
+    def clear(self):
+        for entry in self._iter_entries():
+            self._remove(entry.path)
+        self._local.clear()
+        self._puts_since_evict = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        try:
+            with open(self._path(key), "rb") as f:
+                stat = os.fstat(f.fileno())
+                # The modification time of each entry is set to its expiry time.
+                if stat.st_mtime <= time.time() or stat.st_size == 0:
+                    self.misses += 1
+                    return default
+                stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                local = self._local.get(key)
+                if local and local[0] == stamp:
+                    value = local[1]
+                    self._local.move_to_end(key)
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        value = pickle.loads(m)
+                    self._local[key] = (stamp, value)
+                    self._local.move_to_end(key)
+                    while len(self._local) > self.local_size:
+                        self._local.popitem(last=False)
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def put(self, key, val, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(val, f, protocol=pickle.HIGHEST_PROTOCOL)
+            expires = time.time() + timeout
+            os.utime(tmp, (expires, expires))
+            os.replace(tmp, self._path(key))
+        except Exception:
+            self._remove(tmp)
+            raise
+
+        self._local.pop(key, None)
+        self._puts_since_evict += 1
+        if self._puts_since_evict >= self._evict_interval:
+            self._evict()
+
+    def invalidate(self, key):
+        self._remove(self._path(key))
+        self._local.pop(key, None)
+
+    def _evict(self):
+        self._puts_since_evict = 0
+        entries = []
+        for entry in self._iter_entries():
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                # Another process removed it after we listed the directory.
+                continue
+        if len(entries) <= self.size:
+            return
+        entries.sort()
+        for _, path in entries[: len(entries) - self.size]:
+            self._remove(path)
+            self.evictions += 1
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _Entry(object):
+    """A value in a cache that needs to know more about its values than the
+    underlying cache does (see MaybeCacher.make_cache). fresh_until is when
+    the value expires, which may be before the underlying cache drops it, and
+    delta is how long it took to get, in seconds."""
+
+    __slots__ = ("value", "fresh_until", "delta")
+
+    def __init__(self, value, fresh_until, delta=0):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.delta = delta
+
 
 class MaybeCacher(object):
     """MaybeCacher is a very simple wrapper to work around the fact that we
@@ -11,17 +178,33 @@ class MaybeCacher(object):
     blob versions can change frequently). This class is intended to be
     instantiated as a global object, and then have caches created by consumers
     through calls to make_cache. Consumers that make changes (ie: the admin
-    app) generally also set make_copies to True to get the cache to copy values
-    on get/put to avoid the possibility of accidental cache pollution. For
-    performance reasons, this should be disabled when not necessary.
+    app) generally also set make_copies to True to avoid the possibility of
+    accidental cache pollution. Values are frozen (see auslib.util.frozen) as
+    they're put into the cache, and handed out as they are, so it's only the
+    code that changes them that pays for copying them. For performance
+    reasons, this should be disabled when not necessary.
 
     If the cache given to get/put/clear/invalidate doesn't exist, these methods
     are essentially no-ops. In a world where bug 1109295 is fixed, we might
-    only need to handle the caching case."""
+    only need to handle the caching case.
+
+    When many threads miss the same key at once (eg: right after a popular
+    entry expires), only one of them calls its value_getter, and the others
+    wait for, and share, its result. The cache is checked again before the
+    value_getter is called, so that callers that missed just before another
+    caller's value was cached use that value instead of getting their own."""
 
     def __init__(self):
         self.caches = {}
         self._make_copies = False
+        self._timeouts = {}
+        self._stale_while_revalidate = {}
+        self._timeout_jitter = {}
+        self._early_refresh = {}
+        self._flights = SingleFlight()
+        self._coalesced = {}
+        self._stale = {}
+        self._early_refreshes = {}
 
     @property
     def make_copies(self):
@@ -33,13 +216,62 @@ class MaybeCacher(object):
             raise TypeError("make_copies must be True or False")
         self._make_copies = value
 
-    def make_cache(self, name, maxsize, timeout):
+    def __contains__(self, name):
+        return name in self.caches
+
+    def make_cache(self, name, maxsize, timeout, shared_dir=None, stale_while_revalidate=0, timeout_jitter=0, early_refresh=0):
+        """Creates a new cache. If shared_dir is given, the cache is stored
+        in a subdirectory of it (named after the cache), and shared with any
+        other process that uses the same directory (see SharedFileCache).
+        Otherwise it is private to this process.
+
+        If stale_while_revalidate is given, values are kept for that many
+        seconds after they expire. When an expired value is asked for, one
+        caller refreshes it, and any others that ask for it in the meantime
+        are given the expired value instead of waiting.
+
+        timeout_jitter (0.0 - 1.0) shortens the timeout of each value by a
+        random amount, up to that fraction of it, so that values that were
+        cached at the same time (eg: right after a deploy) don't all expire
+        at the same time, too.
+
+        If early_refresh is given, values are refreshed a little before they
+        expire, with a probability that grows as they get closer to expiring,
+        and the longer they took to get ("XFetch", from "Optimal Probabilistic
+        Cache Stampede Prevention"). Higher values refresh earlier; 1.0 is a
+        good default. Only values that are cached by get are refreshed early,
+        because we don't know how long values passed to put took to get."""
         if name in self.caches:
             raise Exception()
-        self.caches[name] = ExpiringLRUCache(maxsize, timeout)
+        if not 0 <= timeout_jitter < 1:
+            raise ValueError("timeout_jitter must be >=0 and <1")
+        self._timeouts[name] = timeout
+        if stale_while_revalidate:
+            self._stale_while_revalidate[name] = stale_while_revalidate
+        if timeout_jitter:
+            self._timeout_jitter[name] = timeout_jitter
+        if early_refresh:
+            self._early_refresh[name] = early_refresh
+        self._coalesced[name] = 0
+        self._stale[name] = 0
+        self._early_refreshes[name] = 0
+        if shared_dir:
+            self.caches[name] = SharedFileCache(os.path.join(shared_dir, name), maxsize, timeout + stale_while_revalidate)
+        else:
+            self.caches[name] = ExpiringLRUCache(maxsize, timeout + stale_while_revalidate)
 
     def reset(self):
         self.caches.clear()
+        self._timeouts.clear()
+        self._stale_while_revalidate.clear()
+        self._timeout_jitter.clear()
+        self._early_refresh.clear()
+        self._coalesced.clear()
+        self._stale.clear()
+        self._early_refreshes.clear()
+
+    def _usesEntries(self, name):
+        return name in self._stale_while_revalidate or name in self._early_refresh
 
     def get(self, name, key, value_getter=None):
         """Returns the value of the specified key from the named cache.
@@ -54,25 +286,104 @@ class MaybeCacher(object):
                 return None
 
         value = self.caches[name].get(key)
+        fetched = False
+        if self._usesEntries(name) and value is not None:
+            entry = value
+            value = entry.value
+            now = time.time()
+            if entry.fresh_until <= now:
+                value = None
+                if callable(value_getter):
+                    value, fetched = self._flights.try_do((name, key), lambda: self._load(name, key, value_getter))
+                    if not fetched:
+                        # Somebody else is already refreshing it, so we can
+                        # serve the stale value in the meantime.
+                        self._stale[name] += 1
+                        return self._copy(entry.value)
+            elif callable(value_getter) and self._shouldRefreshEarly(name, entry, now):
+                # If somebody else is already refreshing it, the value we have
+                # is still good to use.
+                refreshed, fetched = self._flights.try_do((name, key), lambda: self._load(name, key, value_getter))
+                if fetched:
+                    self._early_refreshes[name] += 1
+                    value = refreshed
+
         # "if value is None" is important here (instead of "if not value")
         # because it allows us to cache results of potentially expensive
         # calls that may end up returning nothing.
-        if value is None and callable(value_getter):
-            value = value_getter()
-            self.put(name, key, value)
+        if value is None and not fetched and callable(value_getter):
+            (value, rechecked), shared = self._flights.do((name, key), lambda: self._loadMissing(name, key, value_getter))
+            if shared or rechecked:
+                self._coalesced[name] += 1
+
+        return self._copy(value)
 
+    def _shouldRefreshEarly(self, name, entry, now):
+        beta = self._early_refresh.get(name)
+        if not beta or not entry.delta:
+            return False
+        # log() of a number in (0, 1] is <= 0, so this looks ahead by a random
+        # amount that is usually small, but occasionally larger.
+        return now - entry.delta * beta * math.log(1.0 - random.random()) >= entry.fresh_until
+
+    def _copy(self, value):
+        # Values that were put into the cache while make_copies was enabled
+        # are already frozen, so this is only a copy for ones that weren't.
         if self.make_copies:
-            return deepcopy(value)
+            return freeze(value)
         else:
             return value
 
+    def _recheck(self, name, key):
+        # The caller has already counted its lookup (as a miss), so this one
+        # is taken back out of the stats.
+        c = self.caches[name]
+        value = c.get(key)
+        c.lookups -= 1
+        if value is None:
+            c.misses -= 1
+        else:
+            c.hits -= 1
+        if value is not None and self._usesEntries(name):
+            if value.fresh_until <= time.time():
+                return None
+            value = value.value
+        return value
+
+    def _loadMissing(self, name, key, value_getter):
+        """Like _load, but first checks the cache again, because another
+        caller's load may have finished between our miss and this one
+        starting. Returns a tuple of the value, and whether or not it was
+        found in the cache."""
+        value = self._recheck(name, key)
+        if value is not None:
+            return value, True
+        return self._load(name, key, value_getter), False
+
+    def _load(self, name, key, value_getter):
+        start = time.time()
+        value = value_getter()
+        # Whatever we cache is shared with anyone else waiting for this
+        # value, so that's what we return, too.
+        return self._put(name, key, value, delta=time.time() - start)
+
     def put(self, name, key, value):
         if name not in self.caches:
             return
 
-        if self.make_copies:
-            value = deepcopy(value)
-        return self.caches[name].put(key, value)
+        self._put(name, key, value)
+
+    def _put(self, name, key, value, delta=0):
+        """Caches value, and returns it (frozen, if make_copies is enabled)."""
+        value = self._copy(value)
+        timeout = self._timeouts[name]
+        if name in self._timeout_jitter:
+            timeout -= timeout * self._timeout_jitter[name] * random.random()
+        if self._usesEntries(name):
+            self.caches[name].put(key, _Entry(value, time.time() + timeout, delta), timeout + self._stale_while_revalidate.get(name, 0))
+        else:
+            self.caches[name].put(key, value, timeout)
+        return value
 
     def clear(self, name=None):
         if name and name not in self.caches:
@@ -89,3 +400,21 @@ class MaybeCacher(object):
             return
 
         self.caches[name].invalidate(key)
+
+    def stats(self):
+        """Returns the lookup, hit, miss, and eviction counts of each cache,
+        as well as how many misses shared another caller's value_getter, how
+        many stale values were served, and how many values were refreshed
+        early, keyed by cache name."""
+        return {
+            name: {
+                "lookups": c.lookups,
+                "hits": c.hits,
+                "misses": c.misses,
+                "evictions": c.evictions,
+                "coalesced": self._coalesced[name],
+                "stale": self._stale[name],
+                "early_refreshes": self._early_refreshes[name],
+            }
+            for name, c in self.caches.items()
+        }
@@ -1,10 +1,15 @@
 import operator
 import re
+from functools import lru_cache
 
-from auslib.util.versions import MozillaVersion
+from auslib.util.versions import MozillaVersion, version_key
 
 operators = {">=": operator.ge, ">": operator.gt, "<": operator.lt, "<=": operator.le}
 
+# Longer operators come first so that eg: "<=" isn't taken to be "<".
+_no_operator_re = re.compile(r"\w+")
+_operator_re = re.compile(r"(>=|<=|>|<)([\.\w]+)")
+
 
 def strip_operator(value):
     return value.lstrip("<>=")
@@ -14,15 +19,15 @@ def has_operator(value):
     return value.startswith(("<", ">"))
 
 
+@lru_cache(maxsize=4096)
 def get_op(pattern):
     # only alphanumeric characters means no operator
-    if re.match(r"\w+", pattern):
+    if _no_operator_re.match(pattern):
         return operator.eq, pattern
-    for op in operators:
-        m = re.match(r"(%s)([\.\w]+)" % op, pattern)
-        if m:
-            op, operand = m.groups()
-            return operators[op], operand
+    m = _operator_re.match(pattern)
+    if m:
+        op, operand = m.groups()
+        return operators[op], operand
 
 
 def string_compare(value, compstr):
@@ -50,6 +55,48 @@ def version_compare(value, compstr, versionClass=MozillaVersion):
       eg version_compare('1.1', '>1.0') is True
     """
     opfunc, operand = get_op(compstr)
-    value = versionClass(value)
-    operand = versionClass(operand)
-    return opfunc(value, operand)
+    return opfunc(version_key(value, versionClass), version_key(operand, versionClass))
+
+
+def compile_comparison(compstr, convert=None):
+    """Returns a callable that takes a bare value and is equivalent to
+    string_compare(value, compstr), or int_compare(value, compstr) when
+    convert is int.
+    The operator and operand are parsed on first use rather than up front
+    so that a malformed compstr raises the same errors, at the same time, as
+    the uncompiled version would."""
+    parsed = []
+
+    def comparator(value):
+        if not parsed:
+            opfunc, operand = get_op(compstr)
+            if convert:
+                operand = convert(operand)
+            parsed.append((opfunc, operand))
+        opfunc, operand = parsed[0]
+        return opfunc(value, operand)
+
+    return comparator
+
+
+@lru_cache(maxsize=4096)
+def compile_version_comparator(compstr, versionClass=MozillaVersion):
+    """Returns a callable that takes a version string and returns True if it
+    satisfies any of the comma separated comparisons in compstr.
+      eg compile_version_comparator('<72.0,>=68.0b3')('70.0') is True
+    Each operand is only parsed once, and callables are cached, so the same
+    compstr always returns the same comparator."""
+    comparisons = []
+    for part in compstr.split(","):
+        opfunc, operand = get_op(part)
+        comparisons.append((opfunc, version_key(operand, versionClass)))
+    comparisons = tuple(comparisons)
+
+    def comparator(value):
+        value = version_key(value, versionClass)
+        for opfunc, operand in comparisons:
+            if opfunc(value, operand):
+                return True
+        return False
+
+    return comparator
@@ -0,0 +1,70 @@
+from copy import deepcopy
+
+# Values that can't be modified, and can therefore be shared as they are.
+_IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+def frozenError(obj):
+    return TypeError("'%s' object is frozen and cannot be modified" % type(obj).__name__)
+
+
+class FrozenDict(dict):
+    """A dict that can't be modified. Because it's still a dict, it can be
+    used anywhere a dict is read (eg: json.dumps, jsonschema), without
+    converting it first. Copying one (with copy.copy or copy.deepcopy) gives
+    you a plain, modifiable dict."""
+
+    def _readonly(self, *args, **kwargs):
+        raise frozenError(self)
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {deepcopy(k, memo): deepcopy(v, memo) for k, v in self.items()}
+
+    def __reduce__(self):
+        # The default pickling of dict subclasses uses __setitem__.
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """A list that can't be modified. See FrozenDict."""
+
+    def _readonly(self, *args, **kwargs):
+        raise frozenError(self)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = clear = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def freeze(value):
+    """Returns a version of value that can't be modified, and can therefore
+    be shared (eg: by many users of a cache) without being copied each time.
+    dicts and lists are copied into FrozenDicts and FrozenLists, objects with
+    a freeze method (eg: Blobs) are frozen by it, and immutable values are
+    returned as they are. Anything already frozen is reused rather than
+    copied, so freezing a value that's made up of parts of other frozen
+    values is cheap. Anything else is deep copied, because we have no way of
+    making it read only."""
+    if isinstance(value, _IMMUTABLE_TYPES) or isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if hasattr(value, "freeze"):
+        return value.freeze()
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    if isinstance(value, tuple):
+        return tuple(freeze(v) for v in value)
+    return deepcopy(value)
@@ -6,7 +6,7 @@ import jsonschema
 from jsonschema.compat import str_types
 
 from auslib.util.comparison import get_op, strip_operator
-from auslib.util.versions import MozillaVersion
+from auslib.util.versions import version_key
 
 logger = logging.getLogger(__name__)
 
@@ -49,16 +49,13 @@ def version_validator(field_value):
                 raise jsonschema.ValidationError(
                     "Invalid input for %s .Relational Operators are not allowed" " when providing a list of versions." % field_value
                 )
-            version = MozillaVersion(operand)
+            version_key(operand)
         except jsonschema.ValidationError:
             raise
         except ValueError:
             raise jsonschema.ValidationError("ValueError. Couldn't parse version for %s. Invalid '%s' input value" % (field_value, field_value))
         except Exception:
             raise jsonschema.ValidationError("Invalid input for %s . No Operator or Match found." % field_value)
-        # MozillaVersion doesn't error on empty strings
-        if not hasattr(version, "version"):
-            raise jsonschema.ValidationError("Couldn't parse the version for %s. No attribute 'version' was detected." % field_value)
     return True
 
 
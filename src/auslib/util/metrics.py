@@ -0,0 +1,265 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+# The uwsgi module only exists inside of uwsgi. (Outside of it, "uwsgi" may
+# be the directory of the same name in the repo.)
+try:
+    from uwsgi import worker_id as uwsgi_worker_id
+except ImportError:
+    uwsgi_worker_id = None
+
+# Upper bounds (in seconds) of the buckets that histograms are broken into,
+# unless others are given. Most of what we time is in the sub-millisecond to
+# tens-of-milliseconds range.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def metric_name(name, **labels):
+    """Returns the name that a metric with the given labels is stored under,
+    in Prometheus' name{label="value"} format.
+      eg metric_name('rule_trace_rejected', stage='version') is 'rule_trace_rejected{stage="version"}'
+    """
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in sorted(labels.items())))
+
+
+def _split_name(name):
+    if "{" in name:
+        base, labels = name.split("{", 1)
+        return base, labels[:-1]
+    return name, ""
+
+
+def _format_value(value):
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Histogram(object):
+    """Counts how many observed values fell into each bucket, as well as the
+    sum and count of all observed values."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last entry is for values larger than the largest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        """Adds the observations from other, which must have the same buckets,
+        to this histogram."""
+        if self.buckets != other.buckets:
+            raise ValueError("Can't merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative_counts(self):
+        """Returns (upper bound, count) pairs for each bucket, where count is
+        the number of values less than or equal to the upper bound."""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data["buckets"])
+        histogram.counts = list(data["counts"])
+        histogram.sum = data["sum"]
+        histogram.count = data["count"]
+        return histogram
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to somebody else.
+        return True
+    return True
+
+
+class Metrics(object):
+    """A very simple registry of named counters and histograms. Code that
+    wants to keep track of how often something happens (or how long it takes)
+    can record it here, and it can be read back (eg: by tests, or a metrics
+    endpoint) later.
+
+    Values are recorded in-process. Because we run many worker processes,
+    share() can be used to point all of them at a directory: each process
+    periodically writes a snapshot of its own metrics there, and render()
+    reports the sum of all of the snapshots. No other service is needed to
+    aggregate them.
+
+    Collectors (see add_collector) can be used to include counts that are
+    already kept elsewhere (eg: cache statistics) without double booking them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.collectors = []
+        self.shared_dir = None
+        self.worker_id = None
+        self.flush_interval = None
+        self._last_flush = 0
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get_histogram(self, name):
+        return self.histograms.get(name)
+
+    def add_collector(self, collector):
+        """Registers a callable that returns a dict of counter names to
+        values, which are included whenever the metrics are rendered or
+        written to the shared directory."""
+        self.collectors.append(collector)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def share(self, directory, worker_id=None, flush_interval=5):
+        """Shares this process' metrics with any others that use the same
+        directory. Snapshots are written to a file named after worker_id, at
+        most once every flush_interval seconds. worker_id defaults to the
+        uwsgi worker id, so that a worker that replaces another one takes
+        over its file, rather than leaving it behind. Outside of uwsgi, it
+        defaults to the pid of the process at the time of writing, and the
+        files of processes that no longer exist are removed when the
+        metrics are aggregated."""
+        os.makedirs(directory, exist_ok=True)
+        self.shared_dir = directory
+        self.worker_id = worker_id
+        self.flush_interval = flush_interval
+
+    def snapshot(self):
+        """Returns this process' counters and histograms."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: h.to_dict() for name, h in self.histograms.items()}
+        for collector in self.collectors:
+            for name, value in collector().items():
+                counters[name] = counters.get(name, 0) + value
+        return {"counters": counters, "histograms": histograms}
+
+    def flush(self, force=False):
+        """Writes a snapshot of this process' metrics to the shared
+        directory, if there is one and the last write was long enough ago."""
+        if not self.shared_dir:
+            return
+        now = time.time()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+
+        fd, tmp = tempfile.mkstemp(dir=self.shared_dir, prefix=".")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, os.path.join(self.shared_dir, "%s.json" % self._get_worker_id()))
+        except Exception:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _get_worker_id(self):
+        if self.worker_id is not None:
+            return self.worker_id
+        # worker_id() is 0 in the master process.
+        if uwsgi_worker_id is not None and uwsgi_worker_id():
+            return "worker-%s" % uwsgi_worker_id()
+        return "pid-%s" % os.getpid()
+
+    def _iter_shared_snapshots(self):
+        for entry in os.scandir(self.shared_dir):
+            if entry.name.startswith(".") or not entry.name.endswith(".json"):
+                continue
+            pid = entry.name[4:-5]
+            if entry.name.startswith("pid-") and pid.isdigit() and not _pid_exists(int(pid)):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(entry.path) as f:
+                    yield json.load(f)
+            # Snapshots are replaced atomically, but their process may have
+            # been cleaned up between listing the directory and opening it.
+            except (FileNotFoundError, ValueError):
+                continue
+
+    def aggregate(self):
+        """Returns the counters and Histograms of every process that shares
+        this one's directory (or just this process, if it's not shared)."""
+        if self.shared_dir:
+            self.flush(force=True)
+            snapshots = list(self._iter_shared_snapshots())
+        else:
+            snapshots = [self.snapshot()]
+
+        counters = defaultdict(int)
+        histograms = {}
+        for snapshot in snapshots:
+            for name, value in snapshot["counters"].items():
+                counters[name] += value
+            for name, data in snapshot["histograms"].items():
+                histogram = Histogram.from_dict(data)
+                if name in histograms:
+                    histograms[name].merge(histogram)
+                else:
+                    histograms[name] = histogram
+        return counters, histograms
+
+    def render(self):
+        """Returns all of the metrics in Prometheus' text exposition format."""
+        counters, histograms = self.aggregate()
+        lines = []
+        for name in sorted(counters):
+            lines.append("%s %s" % (name, _format_value(counters[name])))
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            base, labels = _split_name(name)
+            prefix = labels + "," if labels else ""
+            for bound, count in histogram.cumulative_counts():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_bucket{%sle="%s"} %d' % (base, prefix, le, count))
+            suffix = "{%s}" % labels if labels else ""
+            lines.append("%s_sum%s %s" % (base, suffix, _format_value(histogram.sum)))
+            lines.append("%s_count%s %d" % (base, suffix, histogram.count))
+        return "\n".join(lines) + "\n"
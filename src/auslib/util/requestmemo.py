@@ -0,0 +1,108 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Buckets for the number of memoized lookups done by a single request.
+LOOKUP_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_missing = object()
+
+
+class MemoScope(object):
+    """The values remembered for, and lookup counts of, a single request.
+    Threads that a request hands work off to share its scope, so the counts
+    are only ever updated through count()."""
+
+    def __init__(self):
+        self.values = {}
+        self.lookups = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def count(self, lookups, hits):
+        with self._lock:
+            self.lookups += lookups
+            self.hits += hits
+
+    @property
+    def misses(self):
+        return self.lookups - self.hits
+
+
+class RequestMemo(object):
+    """Remembers the results of lookups (rules, releases, emergency shutoffs,
+    etc.) for the duration of a single request, so that a request that needs
+    the same thing more than once (eg: a SuperBlob, which evaluates rules for
+    each of its products) only has to go to the cache or database for it once.
+
+    Memoization only happens inside of a scope (see
+    auslib.web.public.base.with_transaction). Outside of one, every lookup
+    calls through to its getter, which means that nothing that can modify
+    the database (eg: the admin app) ever sees memoized values. Scopes are
+    tracked with a ContextVar, so concurrent requests never share one, but
+    work that a request hands off to other threads shares its scope if it's
+    run in a copy of the request's context (see
+    auslib.web.public.client.evaluateResponseProducts)."""
+
+    def __init__(self):
+        self._scope = ContextVar("request_memo_scope", default=None)
+
+    @contextmanager
+    def scope(self):
+        scope = MemoScope()
+        token = self._scope.set(scope)
+        try:
+            yield scope
+        finally:
+            self._scope.reset(token)
+
+    @property
+    def current(self):
+        """The MemoScope for the current request, or None if there isn't one."""
+        return self._scope.get()
+
+    def get(self, namespace, key, value_getter):
+        """Returns the value of key in namespace, calling value_getter to get
+        it if it hasn't been looked up yet in the current scope. Exceptions
+        raised by value_getter are not remembered."""
+        scope = self._scope.get()
+        if scope is None:
+            return value_getter()
+        value = scope.values.get((namespace, key), _missing)
+        if value is _missing:
+            scope.count(1, 0)
+            value = scope.values[(namespace, key)] = value_getter()
+        else:
+            scope.count(1, 1)
+        return value
+
+    def get_many(self, namespace, keys, values_getter):
+        """Like get, but for many keys at once. values_getter is called (at
+        most once) with the keys that haven't been looked up yet in the
+        current scope, and must return a dict of their values. Keys that it
+        leaves out are remembered as missing, and are left out of the dict
+        that is returned."""
+        scope = self._scope.get()
+        if scope is None:
+            return values_getter(keys)
+        values = {}
+        remaining = []
+        for key in keys:
+            value = scope.values.get((namespace, key), _missing)
+            if value is _missing:
+                remaining.append(key)
+            elif value is not None:
+                values[key] = value
+        scope.count(len(keys), len(keys) - len(remaining))
+        if remaining:
+            fetched = values_getter(remaining)
+            for key in remaining:
+                scope.values[(namespace, key)] = fetched.get(key)
+            values.update(fetched)
+        return values
+
+    def record(self, scope, metrics):
+        """Adds the lookup counts of a finished scope to the aggregate metrics."""
+        metrics.observe("request_memo_lookups", scope.lookups, buckets=LOOKUP_BUCKETS)
+        metrics.incr("request_memo_hits_total", scope.hits)
+        metrics.incr("request_memo_misses_total", scope.misses)
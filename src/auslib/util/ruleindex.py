@@ -0,0 +1,162 @@
+import heapq
+import logging
+
+from auslib.util.rulematching import compileBuildID, compileChannel, compileCsv, compileMemory, compileSimpleExpression, compileVersion
+from auslib.util.versions import get_version_class
+
+
+def _isExactChannel(channel):
+    # Rule channels are only treated as globs when they end with a "*" (see
+    # matchRegex), so anything else must match the query (or fallback)
+    # channel exactly, which means we can bucket on it.
+    return channel is not None and not channel.endswith("*")
+
+
+def _sortKey(rule):
+    # Highest priority first. Rules without a priority sort after all others,
+    # and rule_id is used to make the order deterministic for equal priorities.
+    priority = rule["priority"]
+    if priority is None:
+        return (1, 0, rule["rule_id"])
+    return (0, -priority, rule["rule_id"])
+
+
+def _compileRule(rule):
+    """Returns a callable that takes an updateQuery, fallbackChannel,
+    versionClass, and optional RuleTrace, and returns True if the rule
+    matches. Product, buildTarget, and exact channel matches are handled by
+    RuleIndex's buckets, everything else that Rules.getRulesMatchingQuery
+    filters on is checked here."""
+    checks = []
+
+    # These two are filtered on in SQL when the index isn't being used. If they
+    # are set in the rule they must be present in, and equal to, the query.
+    for column in ("headerArchitecture", "distVersion"):
+        value = rule[column]
+        if value is not None:
+            checks.append((column, lambda q, fc, vc, column=column, value=value: column in q and q[column] == value))
+
+    if not _isExactChannel(rule["channel"]):
+        channel = compileChannel(rule["channel"])
+        if channel:
+            checks.append(("channel", lambda q, fc, vc: channel(q["channel"], fc)))
+
+    version = compileVersion(rule["version"])
+    if version:
+        checks.append(("version", lambda q, fc, vc: version(q["version"], vc)))
+
+    buildID = compileBuildID(rule["buildID"])
+    if buildID:
+        checks.append(("buildID", lambda q, fc, vc: buildID(q.get("buildID", ""))))
+
+    memory = compileMemory(rule["memory"])
+    if memory:
+        checks.append(("memory", lambda q, fc, vc: memory(q.get("memory", ""))))
+
+    for column, compiler, kwargs in (
+        ("osVersion", compileSimpleExpression, {}),
+        ("instructionSet", compileCsv, {"substring": False}),
+        ("distribution", compileCsv, {"substring": False}),
+        ("locale", compileCsv, {"substring": False}),
+    ):
+        matcher = compiler(rule[column], **kwargs)
+        if matcher:
+            checks.append((column, lambda q, fc, vc, column=column, matcher=matcher: matcher(q.get(column, ""))))
+
+    for column in ("mig64", "jaws"):
+        value = rule[column]
+        if value is not None:
+            checks.append((column, lambda q, fc, vc, column=column, value=value: q.get(column) is not None and q[column] == value))
+
+    checks = tuple(checks)
+
+    def matcher(updateQuery, fallbackChannel, versionClass, trace=None):
+        if trace is None:
+            for _, check in checks:
+                if not check(updateQuery, fallbackChannel, versionClass):
+                    return False
+        else:
+            for stage, check in checks:
+                if not trace.check(stage, check, updateQuery, fallbackChannel, versionClass):
+                    return False
+        return True
+
+    return matcher
+
+
+class RuleIndex(object):
+    """An immutable, in-memory index of the entire rules table that can
+    answer the same questions as Rules.getRulesMatchingQuery without going
+    to the database or re-parsing rule columns on every request.
+
+    Rules are bucketed by (product, buildTarget, channel), where each part of
+    the key is None for rules that don't specify it (or, in the case of
+    channel, that use a glob). Each bucket is pre-sorted by priority, so
+    finding the best matching rule only requires walking the handful of
+    buckets that could apply to a query until the first match is found.
+
+    `version` identifies the state of the rules table the index was built
+    from, and is used by callers to decide when it needs to be rebuilt."""
+
+    def __init__(self, rules, version=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.version = version
+        buckets = {}
+        for rule in sorted(rules, key=_sortKey):
+            channel = rule["channel"] if _isExactChannel(rule["channel"]) else None
+            key = (rule["product"], rule["buildTarget"], channel)
+            buckets.setdefault(key, []).append((_sortKey(rule), rule, _compileRule(rule)))
+        self._buckets = {key: tuple(entries) for key, entries in buckets.items()}
+
+    def __len__(self):
+        return sum(len(b) for b in self._buckets.values())
+
+    def _iterCandidates(self, updateQuery, fallbackChannel):
+        products = {updateQuery["product"], None}
+        buildTargets = {updateQuery["buildTarget"], None}
+        channels = {updateQuery["channel"], fallbackChannel, None}
+        buckets = []
+        for product in products:
+            for buildTarget in buildTargets:
+                for channel in channels:
+                    bucket = self._buckets.get((product, buildTarget, channel))
+                    if bucket:
+                        buckets.append(bucket)
+        if len(buckets) == 1:
+            return iter(buckets[0])
+        return heapq.merge(*buckets, key=lambda entry: entry[0])
+
+    def iterMatchingRules(self, updateQuery, fallbackChannel, trace=None):
+        """Yields the rules that match the given update query, highest
+        priority first. If a RuleTrace is given, the time spent in, and
+        rules rejected by, each matcher are recorded in it."""
+        versionClass = get_version_class(updateQuery["product"])
+        if trace is None:
+            for _, rule, matcher in self._iterCandidates(updateQuery, fallbackChannel):
+                if matcher(updateQuery, fallbackChannel, versionClass):
+                    yield rule
+            return
+
+        # Candidates are found lazily, so it's getting each of them that we
+        # time, rather than creating the iterator.
+        candidates = self._iterCandidates(updateQuery, fallbackChannel)
+        while True:
+            with trace.timed("candidates"):
+                candidate = next(candidates, None)
+            if candidate is None:
+                return
+            _, rule, matcher = candidate
+            trace.candidates += 1
+            if matcher(updateQuery, fallbackChannel, versionClass, trace):
+                trace.matched += 1
+                yield rule
+
+    def getMatchingRules(self, updateQuery, fallbackChannel, trace=None):
+        return list(self.iterMatchingRules(updateQuery, fallbackChannel, trace))
+
+    def getBestMatch(self, updateQuery, fallbackChannel, trace=None):
+        """Returns the highest priority rule that matches the given update
+        query, or None if there are no matches."""
+        for rule in self.iterMatchingRules(updateQuery, fallbackChannel, trace):
+            return rule
+        return None
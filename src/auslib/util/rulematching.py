@@ -1,7 +1,7 @@
 import logging
 import re
 
-from auslib.util.comparison import int_compare, string_compare, version_compare
+from auslib.util.comparison import compile_comparison, compile_version_comparator, int_compare, string_compare
 from auslib.util.versions import MozillaVersion
 
 
@@ -101,11 +101,7 @@ def matchVersion(ruleVersion, queryVersion, versionClass=MozillaVersion):
     logging.debug("ruleVersion: %s, queryVersion: %s", ruleVersion, queryVersion)
     if ruleVersion is None:
         return True
-    rulesVersionList = ruleVersion.split(",")
-    for rule in rulesVersionList:
-        if version_compare(queryVersion, rule, versionClass):
-            return True
-    return False
+    return compile_version_comparator(ruleVersion, versionClass)(queryVersion)
 
 
 def matchLocale(ruleLocales, queryLocale):
@@ -158,3 +154,99 @@ def matchBoolean(ruleValue, queryValue):
         if queryValue is None or ruleValue != queryValue:
             return False
     return True
+
+
+# The compile* functions below are equivalent to the match* functions above,
+# but do all of the parsing of the rule side up front. They return callables
+# that only need the query side, which lets callers that evaluate the same
+# rules over and over (eg: auslib.util.ruleindex.RuleIndex) avoid re-parsing
+# globs, operators, and lists on every request.
+
+
+def _never(*args):
+    return False
+
+
+def compileRegex(foo):
+    """Returns a callable that takes a single string and is equivalent to
+       matchRegex(foo, <string>)."""
+    if foo.endswith("*"):
+        if len(foo) >= 3:
+            test = foo.replace(".", r"\.").replace("*", r"\*", foo.count("*") - 1)
+            regex = re.compile("^{}.*$".format(test[:-1]))
+            return lambda bar: regex.match(bar) is not None
+        else:
+            return _never
+    else:
+        return lambda bar: foo == bar
+
+
+def compileCsv(csvString, substring=True):
+    """Returns a callable that is equivalent to matchCsv(csvString, <queryString>, substring)."""
+    if csvString is None:
+        return None
+    parts = tuple(csvString.split(","))
+    if substring:
+        return lambda queryString: any(part in queryString for part in parts)
+    else:
+        parts = frozenset(parts)
+        return lambda queryString: queryString in parts
+
+
+def compileSimpleExpression(ruleString, substring=True):
+    """Returns a callable that is equivalent to matchSimpleExpression(ruleString, <queryString>, substring)."""
+    if ruleString is None:
+        return None
+
+    decomposedRules = tuple(tuple(rule.strip() for rule in subRule.split("&&")) for subRule in ruleString.split(","))
+
+    def matcher(queryString):
+        if not substring:
+            queryString = queryString.split(",")
+        for subRule in decomposedRules:
+            if all(rule in queryString for rule in subRule):
+                return True
+        return False
+
+    return matcher
+
+
+def compileChannel(ruleChannel):
+    """Returns a callable that is equivalent to matchChannel(ruleChannel, <queryChannel>, <fallbackChannel>)."""
+    if ruleChannel is None:
+        return None
+    regex = compileRegex(ruleChannel)
+    return lambda queryChannel, fallbackChannel: regex(queryChannel) or regex(fallbackChannel)
+
+
+def compileVersion(ruleVersion):
+    """Returns a callable that is equivalent to matchVersion(ruleVersion, <queryVersion>, <versionClass>).
+       Unlike matchVersion, the version class must always be passed explicitly."""
+    if ruleVersion is None:
+        return None
+
+    # Rules that don't specify a product can be matched by queries from
+    # products that use different version classes, so the comparator is
+    # looked up per version class, on first use.
+    parsed = {}
+
+    def matcher(queryVersion, versionClass):
+        if versionClass not in parsed:
+            parsed[versionClass] = compile_version_comparator(ruleVersion, versionClass)
+        return parsed[versionClass](queryVersion)
+
+    return matcher
+
+
+def compileBuildID(ruleBuildID):
+    """Returns a callable that is equivalent to matchBuildID(ruleBuildID, <queryBuildID>)."""
+    if ruleBuildID is None:
+        return None
+    return compile_comparison(ruleBuildID)
+
+
+def compileMemory(ruleMemory):
+    """Returns a callable that is equivalent to matchMemory(ruleMemory, <queryMemory>)."""
+    if ruleMemory is None:
+        return None
+    return compile_comparison(ruleMemory, int)
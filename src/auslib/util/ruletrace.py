@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+
+from auslib.util.metrics import metric_name
+
+
+class RuleTrace(object):
+    """Records how long each stage of rule evaluation takes, and how many
+    rules each stage rejects, for a single request. Stages are things like
+    the select of candidate rules, or one of the per-column matchers (channel,
+    version, osVersion, etc.).
+
+    Tracing is opt-in (see auslib.web.public.base.get_rule_trace), because
+    timing every matcher call isn't free. Callers that evaluate rules accept
+    an optional trace, and only do the extra bookkeeping when one is given."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.elapsed = None
+        self.stages = OrderedDict()
+        self.candidates = 0
+        self.matched = 0
+
+    def _stage(self, stage):
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = {"seconds": 0.0, "evaluated": 0, "rejected": 0}
+        return stats
+
+    @contextmanager
+    def timed(self, stage):
+        """Times the body of the with statement as the given stage."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            stats = self._stage(stage)
+            stats["seconds"] += perf_counter() - start
+            stats["evaluated"] += 1
+
+    def check(self, stage, matcher, *args):
+        """Calls matcher with args, and records how long it took, and whether
+        or not it rejected the rule, against the given stage. Returns whatever
+        the matcher did."""
+        start = perf_counter()
+        result = matcher(*args)
+        stats = self._stage(stage)
+        stats["seconds"] += perf_counter() - start
+        stats["evaluated"] += 1
+        if not result:
+            stats["rejected"] += 1
+        return result
+
+    def finish(self):
+        if self.elapsed is None:
+            self.elapsed = perf_counter() - self.started
+
+    def fields(self):
+        """Returns the trace as a dict that can be passed as `extra` to a
+        logger, which JsonLogFormatter will include in the log's Fields."""
+        self.finish()
+        stages = OrderedDict()
+        for stage, stats in self.stages.items():
+            stages[stage] = {"ms": round(stats["seconds"] * 1000, 3), "evaluated": stats["evaluated"], "rejected": stats["rejected"]}
+        return {"rule_trace": {"total_ms": round(self.elapsed * 1000, 3), "candidates": self.candidates, "matched": self.matched, "stages": stages}}
+
+    def record(self, metrics):
+        """Adds this trace to the aggregate rule trace metrics."""
+        self.finish()
+        metrics.incr("rule_traces_total")
+        metrics.observe("rule_trace_seconds", self.elapsed)
+        for stage, stats in self.stages.items():
+            metrics.observe(metric_name("rule_trace_stage_seconds", stage=stage), stats["seconds"])
+            metrics.incr(metric_name("rule_trace_evaluated_total", stage=stage), stats["evaluated"])
+            metrics.incr(metric_name("rule_trace_rejected_total", stage=stage), stats["rejected"])
@@ -0,0 +1,64 @@
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Makes concurrent calls for the same key share a single call. The first
+    thread to ask for a key calls the function, and any others that ask for
+    the same key before it returns wait for it and get its result (or its
+    exception) instead of making their own call.
+
+    Nothing is remembered once a call returns, so this only helps with things
+    that are expensive and likely to be asked for many times at once, like
+    loading a blob that isn't cached yet while lots of requests for it are in
+    flight."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Returns a tuple of fn's return value, and whether or not it was
+        shared with a call that was already in flight for key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        return self._call(key, call, fn), False
+
+    def try_do(self, key, fn):
+        """Like do, but if a call for key is already in flight, returns
+        straight away instead of waiting for it. Returns a tuple of fn's
+        return value (or None), and whether or not fn was called."""
+        with self._lock:
+            if key in self._calls:
+                return None, False
+            call = self._calls[key] = _Call()
+
+        return self._call(key, call, fn), True
+
+    def _call(self, key, call, fn):
+        try:
+            call.value = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
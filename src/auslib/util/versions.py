@@ -1,34 +1,104 @@
 import re
-from distutils.version import LooseVersion, StrictVersion
+from functools import lru_cache
 
 from auslib.errors import BadDataError
 
 
-class PostModernMozillaVersion(StrictVersion):
+class _MozillaVersionBase(object):
+    """A fast, immutable replacement for distutils' StrictVersion. Versions
+       are parsed once, into the same "version" and "prerelease" attributes
+       that StrictVersion has, and a tuple key that all comparisons are done
+       with. Subclasses only need to provide version_re, whose groups must be
+       laid out the same way as StrictVersion's."""
+
+    __slots__ = ("version", "prerelease", "_key")
+    version_re = None
+
+    def __init__(self, vstring):
+        match = self.version_re.match(vstring)
+        if not match:
+            raise ValueError("invalid version number '%s'" % vstring)
+
+        major, minor, patch, prerelease, prerelease_num = match.group(1, 2, 4, 5, 6)
+        if patch:
+            self.version = (int(major), int(minor), int(patch))
+        else:
+            self.version = (int(major), int(minor), 0)
+
+        # Like StrictVersion, versions with a prerelease tag sort before the
+        # same version without one (eg: 1.0b1 < 1.0).
+        if prerelease:
+            self.prerelease = (prerelease[0], int(prerelease_num))
+            self._key = (self.version, (0,) + self.prerelease)
+        else:
+            self.prerelease = None
+            self._key = (self.version, (1,))
+
+    def __str__(self):
+        if self.version[2] == 0:
+            vstring = "%d.%d" % self.version[0:2]
+        else:
+            vstring = "%d.%d.%d" % self.version
+        if self.prerelease:
+            vstring += "%s%d" % self.prerelease
+        return vstring
+
+    def __repr__(self):
+        return "%s('%s')" % (self.__class__.__name__, self)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        if not isinstance(other, _MozillaVersionBase):
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        if not isinstance(other, _MozillaVersionBase):
+            return NotImplemented
+        return self._key != other._key
+
+    def __lt__(self, other):
+        if not isinstance(other, _MozillaVersionBase):
+            return NotImplemented
+        return self._key < other._key
+
+    def __le__(self, other):
+        if not isinstance(other, _MozillaVersionBase):
+            return NotImplemented
+        return self._key <= other._key
+
+    def __gt__(self, other):
+        if not isinstance(other, _MozillaVersionBase):
+            return NotImplemented
+        return self._key > other._key
+
+    def __ge__(self, other):
+        if not isinstance(other, _MozillaVersionBase):
+            return NotImplemented
+        return self._key >= other._key
+
+
+class PostModernMozillaVersion(_MozillaVersionBase):
     """A version class that supports Firefox versions 5.0 and up, which
        may have "a1" but not "b2" tags in them"""
 
-    version_re = re.compile(
-        r"""^(\d+) \. (\d+) (\. (\d+))?
-                                (a(\d+))?$""",
-        re.VERBOSE,
-    )
+    __slots__ = ()
+    version_re = re.compile(r"^(\d+)\.(\d+)(\.(\d+))?(a(\d+))?$")
 
 
-class ModernMozillaVersion(StrictVersion):
+class ModernMozillaVersion(_MozillaVersionBase):
     """A version class that is slightly less restrictive than StrictVersion.
        Instead of just allowing "a" or "b" as prerelease tags, it allows any
        alpha. This allows us to support the once-shipped "3.6.3plugin1" and
        similar versions."""
 
-    version_re = re.compile(
-        r"""^(\d+) \. (\d+) (\. (\d+))?
-                                ([a-zA-Z]+(\d+))?$""",
-        re.VERBOSE,
-    )
+    __slots__ = ()
+    version_re = re.compile(r"^(\d+)\.(\d+)(\.(\d+))?([a-zA-Z]+(\d+))?$")
 
 
-class AncientMozillaVersion(StrictVersion):
+class AncientMozillaVersion(_MozillaVersionBase):
     """A version class that is slightly less restrictive than StrictVersion.
        Instead of just allowing "a" or "b" as prerelease tags, it allows any
        alpha. This allows us to support the once-shipped "3.6.3plugin1" and
@@ -36,14 +106,15 @@ class AncientMozillaVersion(StrictVersion):
        It also supports versions w.x.y.z by transmuting to w.x.z, which
        is useful for versions like 1.5.0.x and 2.0.0.y"""
 
-    version_re = re.compile(
-        r"""^(\d+) \. (\d+) \. \d (\. (\d+))
-                                ([a-zA-Z]+(\d+))?$""",
-        re.VERBOSE,
-    )
+    __slots__ = ()
+    version_re = re.compile(r"^(\d+)\.(\d+)\.\d(\.(\d+))([a-zA-Z]+(\d+))?$")
 
 
+@lru_cache(maxsize=16384)
 def MozillaVersion(version):
+    """Parses version with whichever of the classes above applies to it.
+       Results are cached, so the same version string always returns the
+       same (immutable) object."""
     try:
         if version.count(".") in (1, 2):
             if int(version[0]) > 4:
@@ -56,6 +127,74 @@ def MozillaVersion(version):
         raise BadDataError("Version number %s is invalid." % version)
 
 
+class LooseVersion(object):
+    """Equivalent to distutils' LooseVersion, which Guardian versions are
+       compared with: versions are split into runs of digits and letters,
+       and compared part by part."""
+
+    __slots__ = ("vstring", "version", "_key")
+    component_re = re.compile(r"(\d+|[a-z]+|\.)")
+
+    def __init__(self, vstring):
+        self.vstring = vstring
+        components = [x for x in self.component_re.split(vstring) if x and x != "."]
+        for i, obj in enumerate(components):
+            try:
+                components[i] = int(obj)
+            except ValueError:
+                pass
+        self.version = components
+        self._key = tuple(components)
+
+    def __str__(self):
+        return self.vstring
+
+    def __repr__(self):
+        return "LooseVersion('%s')" % self.vstring
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        if not isinstance(other, LooseVersion):
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        if not isinstance(other, LooseVersion):
+            return NotImplemented
+        return self._key != other._key
+
+    def __lt__(self, other):
+        if not isinstance(other, LooseVersion):
+            return NotImplemented
+        return self._key < other._key
+
+    def __le__(self, other):
+        if not isinstance(other, LooseVersion):
+            return NotImplemented
+        return self._key <= other._key
+
+    def __gt__(self, other):
+        if not isinstance(other, LooseVersion):
+            return NotImplemented
+        return self._key > other._key
+
+    def __ge__(self, other):
+        if not isinstance(other, LooseVersion):
+            return NotImplemented
+        return self._key >= other._key
+
+
+@lru_cache(maxsize=16384)
+def version_key(version, versionClass=MozillaVersion):
+    """Returns a tuple that compares the same way as versionClass(version)
+       does against other versions of the same class. Keys are cached, so
+       repeated lookups of the same version return the same object without
+       re-parsing it."""
+    return versionClass(version)._key
+
+
 def get_version_parts(version):
     return [int(v) for v in version.split(".")]
 
@@ -0,0 +1,88 @@
+import logging
+import time
+from collections import deque
+
+from auslib.global_state import cache, dbo
+
+log = logging.getLogger(__name__)
+
+
+def warm_caches(time_budget, max_releases=None, batch_size=50):
+    """Fills the caches that the public app needs for nearly every request,
+    so that a newly started worker doesn't have to query the database for
+    all of them while it serves its first requests. This builds the rule
+    index, and loads the releases that rules map to (mapping and
+    fallbackMapping, highest priority rules first), then the buildID indexes
+    of the releases that those reference as the "from" release of partials.
+
+    Releases are loaded batch_size at a time. No more batches are started
+    after time_budget seconds, or once max_releases releases have been
+    loaded. There's no point in loading more releases than fit in the blob
+    cache, because the later ones would just push the earlier ones out.
+    Referenced releases aren't put in the blob cache, so they don't count
+    towards max_releases.
+
+    Returns a dict describing what was loaded, which is also logged."""
+    start = time.time()
+    summary = {"rules": 0, "releases": 0, "referenced_releases": 0, "complete": True}
+
+    index = dbo.rules.getRuleIndex()
+    if index is not None:
+        summary["rules"] = len(index)
+
+    if "blob" in cache:
+        rules = dbo.rules.select(columns=[dbo.rules.mapping, dbo.rules.fallbackMapping], order_by=[dbo.rules.priority.desc(), dbo.rules.rule_id])
+        seen = set()
+        pending = deque()
+        for rule in rules:
+            for name in (rule["mapping"], rule["fallbackMapping"]):
+                if name and name not in seen:
+                    seen.add(name)
+                    pending.append(name)
+
+        referenced = []
+        while pending:
+            if time.time() - start >= time_budget or (max_releases is not None and summary["releases"] >= max_releases):
+                summary["complete"] = False
+                break
+
+            count = batch_size
+            if max_releases is not None:
+                count = min(count, max_releases - summary["releases"])
+            batch = [pending.popleft() for _ in range(min(count, len(pending)))]
+            releases = dbo.releases.getReleasesByName(batch)
+            for name in batch:
+                if name not in releases:
+                    continue
+                summary["releases"] += 1
+                for ref in releases[name]["data"].getReferencedReleases():
+                    if ref not in seen:
+                        seen.add(ref)
+                        referenced.append(ref)
+
+        # Partials only need the buildIDs of the releases they reference,
+        # which are cached separately (and without their blobs), so these
+        # don't push mapped releases out of the blob cache or count towards
+        # max_releases.
+        if "release_buildids" in cache:
+            for name in referenced:
+                if time.time() - start >= time_budget:
+                    summary["complete"] = False
+                    break
+                try:
+                    dbo.releases.getReleaseBuildIDs(name)
+                except KeyError:
+                    continue
+                summary["referenced_releases"] += 1
+
+    summary["seconds"] = time.time() - start
+    log.info(
+        "Warmed caches in %.2fs: rule index with %d rules, %d releases (%d referenced by partials)",
+        summary["seconds"],
+        summary["rules"],
+        summary["releases"],
+        summary["referenced_releases"],
+    )
+    if not summary["complete"]:
+        log.warning("Cache warm-up stopped before loading every release, because it ran out of time or hit the release limit")
+    return summary
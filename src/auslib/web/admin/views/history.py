@@ -3,6 +3,7 @@ from flask import Response, jsonify
 
 from auslib.web.admin.views.base import AdminView
 from auslib.web.admin.views.problem import problem
+from auslib.web.common.history import get_history_page
 
 
 class HistoryView(AdminView):
@@ -41,7 +42,9 @@ class HistoryView(AdminView):
         according to the requested AUS object.
         @type process_revisions_callback: callable
 
-        @param revisions_order_by: Fields list to sort history.
+        @param revisions_order_by: Fields list to sort history. This must be
+        timestamp and change_id, descending, for cursor pagination to work.
+        See auslib.web.common.history.get_history_page.
         @type revisions_order_by: list
 
         @param obj_not_found_msg: Error message for not found AUS object.
@@ -50,26 +53,18 @@ class HistoryView(AdminView):
         @param response_key: Dictionary key to wrap returned revisions.
         @type response_key: string
         """
-        page = int(connexion.request.args.get("page", 1))
-        limit = int(connexion.request.args.get("limit", 10))
-
         obj = get_object_callback()
         if not obj:
             return problem(status=404, title="Not Found", detail=obj_not_found_msg)
 
-        offset = limit * (page - 1)
-
         filters = history_filters_callback(obj)
-        total_count = self.history_table.count(where=filters)
-
-        revisions = self.history_table.select(where=filters, limit=limit, offset=offset, order_by=revisions_order_by)
+        ret = get_history_page(self.history_table, filters, revisions_order_by)
 
+        revisions = ret.pop("revisions")
         if process_revisions_callback:
             revisions = process_revisions_callback(revisions)
 
-        ret = dict()
         ret[response_key] = revisions
-        ret["count"] = total_count
         return jsonify(ret)
 
     def revert_to_revision(
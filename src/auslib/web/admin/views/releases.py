@@ -267,8 +267,10 @@ class SingleReleaseView(AdminView):
             return False
 
         def commit(rel, product, newReleaseData, releaseData, old_data_version, extraArgs):
-            releaseData.update(newReleaseData)
-            blob = createBlob(releaseData)
+            # releaseData may be shared with the cache, so we mustn't modify it.
+            data = dict(releaseData)
+            data.update(newReleaseData)
+            blob = createBlob(data)
             return dbo.releases.update(
                 where={"name": rel}, what={"data": blob, "product": product}, changed_by=changed_by, old_data_version=old_data_version, transaction=transaction
             )
@@ -264,7 +264,7 @@ class ScheduledChangeHistoryView(HistoryView):
                 get_object_callback=lambda: self._get_sc(sc_id),
                 history_filters_callback=self._get_filters,
                 process_revisions_callback=self._process_revisions,
-                revisions_order_by=[self.history_table.timestamp.desc()],
+                revisions_order_by=[self.history_table.timestamp.desc(), self.history_table.change_id.desc()],
                 obj_not_found_msg="Scheduled change does not exist",
             )
         except (ValueError, AssertionError) as msg:
@@ -277,7 +277,7 @@ class ScheduledChangeHistoryView(HistoryView):
                 get_object_callback=lambda: ScheduledChangesView.get,
                 history_filters_callback=self._get_filters_all,
                 process_revisions_callback=self._process_revisions,
-                revisions_order_by=[self.history_table.timestamp.desc()],
+                revisions_order_by=[self.history_table.timestamp.desc(), self.history_table.change_id.desc()],
                 obj_not_found_msg="Scheduled change does not exist",
             )
         except (ValueError, AssertionError) as msg:
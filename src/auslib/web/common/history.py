@@ -1,8 +1,87 @@
+import base64
+import binascii
 import json
 
 import arrow
 from connexion import request
 from flask import Response, jsonify
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(revision, count=None):
+    """Returns an opaque continuation token that points just past the given
+    history row. The total count from the first page is carried along in it,
+    so that later pages don't have to count the whole table again."""
+    position = [revision["timestamp"], revision["change_id"], count]
+    return base64.urlsafe_b64encode(json.dumps(position).encode("ascii")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Returns the timestamp, change_id, and count that were encoded in a
+    continuation token. Raises ValueError if it isn't one of ours."""
+    try:
+        timestamp, change_id, count = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    if not isinstance(timestamp, int) or not isinstance(change_id, int) or not (count is None or isinstance(count, int)):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    return timestamp, change_id, count
+
+
+def get_history_page(hist_table, filters, order_by):
+    """Returns one page of the history rows that match filters, as a dict
+    with a "revisions" key, and "count" and "next_cursor" keys if there's a
+    count or a next page.
+
+    Pages are requested with the "limit" query arg and either "page" or
+    "cursor". "page" uses LIMIT/OFFSET, which gets slower the further back
+    in history it goes, because the database has to walk over every row
+    that it skips. "cursor" should be set to the "next_cursor" of the
+    previous page instead, which picks up after the last row that was
+    returned (newest first, by timestamp and change_id) without looking at
+    any of the rows before it. There's no next_cursor once there are no
+    more rows. Callers using cursors must order by timestamp and change_id,
+    descending.
+
+    Counting every matching row is just as slow as a large offset, so it's
+    only done for the first page: the count is carried along in the cursor
+    rather than recounted, and may therefore be out of date if history has
+    been added since. Setting the "count" query arg to false skips it
+    altogether."""
+    limit = int(request.args.get("limit", 10))
+    page = int(request.args.get("page", 1))
+    cursor = request.args.get("cursor")
+    with_count = request.args.get("count", "true").lower() != "false"
+    assert limit >= 1
+    assert page >= 1
+
+    filters = list(filters)
+    if cursor:
+        if "page" in request.args:
+            raise ValueError("page and cursor cannot be used together")
+        timestamp, change_id, count = decode_cursor(cursor)
+        if not with_count:
+            count = None
+        filters.append(or_(hist_table.timestamp < timestamp, and_(hist_table.timestamp == timestamp, hist_table.change_id < change_id)))
+        offset = 0
+    else:
+        count = hist_table.count(where=filters) if with_count else None
+        offset = limit * (page - 1)
+
+    # Asking for one more row than we need tells us whether there's another
+    # page, without having to count.
+    revisions = hist_table.select(where=filters, limit=limit + 1, offset=offset, order_by=order_by)
+    next_cursor = None
+    if len(revisions) > limit:
+        revisions = revisions[:limit]
+        next_cursor = encode_cursor(revisions[-1], count)
+
+    ret = {"revisions": revisions}
+    if count is not None:
+        ret["count"] = count
+    if next_cursor is not None:
+        ret["next_cursor"] = next_cursor
+    return ret
 
 
 class HistoryHelper:
@@ -23,32 +102,23 @@ class HistoryHelper:
         self.obj_not_found_msg = obj_not_found_msg
 
     def get_history(self, response_key="revisions"):
-        page = int(request.args.get("page", 1))
-        limit = int(request.args.get("limit", 10))
-        assert page >= 1
-
         obj = self.fn_get_object()
         if not obj:
             return Response(status=404, response=self.obj_not_found_msg)
 
-        offset = limit * (page - 1)
-
         filters = self.fn_history_filters(obj, self.hist_table)
-        total_count = self.hist_table.count(where=filters)
-
-        revisions = self.hist_table.select(where=filters, limit=limit, offset=offset, order_by=self.order_by)
+        ret = get_history_page(self.hist_table, filters, self.order_by)
 
+        revisions = ret.pop("revisions")
         if self.fn_process_revisions:
             revisions = self.fn_process_revisions(revisions)
 
-        ret = {}
         ret[response_key] = revisions
-        ret["count"] = total_count
         return jsonify(ret)
 
 
 def get_input_dict():
-    reserved_filter_params = ["limit", "product", "channel", "page", "timestamp_from", "timestamp_to"]
+    reserved_filter_params = ["limit", "product", "channel", "page", "cursor", "count", "timestamp_from", "timestamp_to"]
     args = request.args
     query_keys = []
     query = {}
@@ -41,7 +41,7 @@ def _get_filters(obj, history_table):
 
 def _get_histories(table, obj, process_revisions_callback=None):
     history_table = table
-    order_by = [history_table.timestamp.desc()]
+    order_by = [history_table.timestamp.desc(), history_table.change_id.desc()]
     history_helper = HistoryHelper(
         hist_table=history_table,
         order_by=order_by,
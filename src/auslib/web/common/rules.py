@@ -50,7 +50,7 @@ def _get_filters(rule, history_table):
 
 def get_rule_history(rule_id):
     history_table = dbo.rules.history
-    order_by = [history_table.timestamp.desc()]
+    order_by = [history_table.timestamp.desc(), history_table.change_id.desc()]
     history_helper = HistoryHelper(
         hist_table=history_table,
         order_by=order_by,
@@ -0,0 +1,20 @@
+from a2wsgi import WSGIMiddleware
+
+
+def create_asgi_app(wsgi_app, workers=8):
+    """Returns an ASGI application that serves the public app (or any other
+    WSGI application), for use with an ASGI server (eg: uvicorn or hypercorn)
+    instead of uwsgi. See uwsgi/public_asgi.py.
+
+    Connections are accepted, read, and written by the event loop, which can
+    hold far more of them open than uwsgi has workers, and bodies are
+    streamed between it and the WSGI application. Requests are handled in a
+    pool of up to `workers` threads. The database layer is synchronous (our
+    version of SQLAlchemy has no asyncio support), so that's where requests
+    that miss the cache wait for it, and it limits how many can be talking to
+    the database at once. Concurrent requests that miss the same cache entry
+    share a single load of it (see auslib.util.cache.MaybeCacher).
+
+    uwsgi/public.wsgi is still the default way to run the public app, and
+    both serve exactly the same responses."""
+    return WSGIMiddleware(wsgi_app, workers=workers)
@@ -1,5 +1,8 @@
+import hmac
 import logging
+import random
 import re
+import time
 from functools import wraps
 from os import path
 
@@ -12,7 +15,9 @@ from specsynthase.specbuilder import SpecBuilder
 import auslib.web
 from auslib.AUS import AUS
 from auslib.errors import BadDataError
-from auslib.global_state import dbo
+from auslib.global_state import dbo, metrics, request_memo
+from auslib.util.metrics import metric_name
+from auslib.util.ruletrace import RuleTrace
 from auslib.web.admin.views.problem import problem
 
 try:
@@ -22,14 +27,68 @@ except ImportError:  # pragma: no cover
 
 
 def with_transaction(f):
+    """Runs the decorated view in a transaction, and a request memo scope
+    (see auslib.util.requestmemo), which lasts exactly as long as the
+    transaction does."""
+
     @wraps(f)
     def wrapper(*args, **kwargs):
-        with dbo.begin() as transaction:
-            return f(*args, transaction=transaction, **kwargs)
+        with dbo.begin() as transaction, request_memo.scope() as scope:
+            try:
+                return f(*args, transaction=transaction, **kwargs)
+            finally:
+                log.debug("Request memo: %s lookups, %s hits", scope.lookups, scope.hits)
+                request_memo.record(scope, metrics)
 
     return wrapper
 
 
+def with_request_metrics(route):
+    """Records how long each call to the decorated view takes in the
+    request_seconds histogram, labelled with the given route name."""
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                metrics.observe(metric_name("request_seconds", route=route), time.perf_counter() - start)
+                metrics.flush()
+
+        return wrapper
+
+    return decorator
+
+
+def get_rule_trace():
+    """Returns a RuleTrace if rule evaluation for the current request should
+    be traced, or None if it shouldn't. Requests are traced if they carry the
+    header named by the RULE_TRACE_HEADER config option, set to the value of
+    the RULE_TRACE_SECRET option, or if they are picked at random, at the rate
+    given by RULE_TRACE_SAMPLE_RATE (0.0 - 1.0). Tracing isn't free, so the
+    header is ignored unless a secret is configured, to keep anybody else from
+    turning it on for all of their requests."""
+    header = app.config.get("RULE_TRACE_HEADER")
+    secret = app.config.get("RULE_TRACE_SECRET")
+    if header and secret and hmac.compare_digest(request.headers.get(header, "").encode("utf-8"), secret.encode("utf-8")):
+        return RuleTrace()
+    sample_rate = app.config.get("RULE_TRACE_SAMPLE_RATE")
+    if sample_rate and random.random() < sample_rate:
+        return RuleTrace()
+    return None
+
+
+def log_rule_trace(trace, query):
+    """Logs a finished RuleTrace, and adds it to the aggregate metrics."""
+    trace.record(metrics)
+    extra = trace.fields()
+    for field in ("product", "channel", "buildTarget", "version"):
+        extra[field] = query.get(field)
+    log.info("Rule evaluation trace", extra=extra)
+
+
 log = logging.getLogger(__name__)
 AUS = AUS()
 sentry = Sentry()
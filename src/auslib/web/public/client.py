@@ -1,14 +1,18 @@
 import logging
 import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 
 from connexion import request
 from flask import current_app as app
 from flask import make_response
 
 from auslib.AUS import FORCE_FALLBACK_MAPPING, FORCE_MAIN_MAPPING
-from auslib.global_state import dbo
-from auslib.web.public.base import AUS, with_transaction
+from auslib.blobs.base import escapeAmpersands
+from auslib.global_state import cache, dbo
+from auslib.web.public.base import AUS, get_rule_trace, log_rule_trace, with_request_metrics, with_transaction
 
 try:
     from urllib import unquote
@@ -124,6 +128,175 @@ def extract_query_version(request_url):
     return version
 
 
+# Fields that may be present in a query, but never affect the response.
+RESPONSE_CACHE_IGNORED_FIELDS = ("avast",)
+
+
+def getResponseCacheKey(query, release, update_type, response_blobs):
+    """Returns the key that responses for the given query are cached under.
+    The release that the rules pointed at is part of the key, so that requests
+    that roll a different result on the backgroundRate dice (and get served the
+    fallback release) have their own cache entry."""
+    query_items = tuple(sorted((k, v) for k, v in query.items() if k not in RESPONSE_CACHE_IGNORED_FIELDS))
+    # SuperBlobs evaluate rules for each of their products, which may end up
+    # with a different product or update type than the top level release.
+    response_items = tuple((b["product_query"]["product"], b["response_update_type"]) for b in response_blobs)
+    return (release["name"], update_type, query_items, response_items)
+
+
+def getResponseDependencies(release, response_blobs, transaction):
+    """Returns the data_version of every release that went into the response
+    for release, keyed by name. A cached response is only valid if these
+    haven't changed since it was rendered. The data_versions come from the
+    blob version cache where possible, so checking them doesn't load any of
+    the releases that partials point at. Releases that don't exist have a
+    data_version of None."""
+    names = {release["name"]}
+    for response_blob in response_blobs:
+        response_release = response_blob["response_release"]
+        names.add(response_release["name"])
+        names.update(response_release.getReferencedReleases())
+
+    dependencies = {}
+    for name in names:
+        try:
+            dependencies[name] = dbo.releases.getReleaseDataVersion(name, transaction=transaction)
+        except KeyError:
+            dependencies[name] = None
+    return dependencies
+
+
+# The threads that SuperBlobs' response products are evaluated in, if
+# RESPONSE_PRODUCT_WORKERS is set. It's created the first time that it's
+# needed, so that each (forked) worker process gets its own.
+_response_product_executor = None
+_response_product_executor_lock = threading.Lock()
+
+
+def getResponseProductExecutor():
+    """Returns the executor that response products are evaluated in, or None
+    if they should be evaluated one after another."""
+    global _response_product_executor
+    workers = app.config.get("RESPONSE_PRODUCT_WORKERS")
+    if not workers or workers < 2:
+        return None
+
+    with _response_product_executor_lock:
+        if _response_product_executor is None or _response_product_executor[0] != workers:
+            if _response_product_executor is not None:
+                _response_product_executor[1].shutdown(wait=False)
+            _response_product_executor = (workers, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="response-products"))
+        return _response_product_executor[1]
+
+
+def evaluateResponseProducts(product_queries, transaction, trace=None):
+    """Evaluates the rules for each of a SuperBlob's response product queries,
+    and returns a list of their (release, update_type), in the same order.
+
+    If there is a response product executor, the products are evaluated
+    concurrently. Database connections can't be shared between threads, so
+    each product is evaluated in its own transaction, and in a copy of the
+    request's context, which means that they all share its request memo scope.
+    Traced requests are always evaluated one product at a time, because the
+    timings of overlapping stages wouldn't mean much."""
+    executor = getResponseProductExecutor()
+    if executor is None or trace is not None or len(product_queries) < 2:
+        return [AUS.evaluateRules(product_query, transaction=transaction, trace=trace) for product_query in product_queries]
+
+    def evaluate(product_query):
+        with dbo.begin() as product_transaction:
+            return AUS.evaluateRules(product_query, transaction=product_transaction)
+
+    futures = [executor.submit(copy_context().run, evaluate, product_query) for product_query in product_queries]
+    return [future.result() for future in futures]
+
+
+def getResponseBlobs(query, release, update_type, transaction, trace=None):
+    """Returns a list of the blobs (and the queries and update types to render
+    them with) that make up the response for release, and whether or not the
+    response needs to be squashed."""
+    # Bug 1517743 - two Firefox nightlies can't parse update.xml when it contains the usual newlines or indentations
+    squash_response = False
+    response_products = release.getResponseProducts()
+    response_blobs = []
+    response_blob_names = release.getResponseBlobs()
+    if response_products:
+        # if we have a SuperBlob of gmp, we process the response products and
+        # concatenate their inner XMLs
+        product_queries = []
+        for product in response_products:
+            product_query = query.copy()
+            product_query["product"] = product
+            product_queries.append(product_query)
+
+        results = evaluateResponseProducts(product_queries, transaction, trace=trace)
+        for product_query, (response_release, response_update_type) in zip(product_queries, results):
+            if not response_release:
+                continue
+
+            response_blobs.append({"product_query": product_query, "response_release": response_release, "response_update_type": response_update_type})
+    elif response_blob_names:
+        releases = dbo.releases.getReleasesByName(response_blob_names, transaction=transaction)
+        for blob_name in response_blob_names:
+            # if we have a SuperBlob of systemaddons, we process the response products and
+            # concatenate their inner XMLs
+            if blob_name not in releases:
+                LOG.warning("No release found with name: %s", blob_name)
+                continue
+
+            product_query = query.copy()
+            product_query["product"] = releases[blob_name]["product"]
+            response_blobs.append({"product_query": product_query, "response_release": releases[blob_name]["data"], "response_update_type": update_type})
+    else:
+        response_blobs.append({"product_query": query, "response_release": release, "response_update_type": update_type})
+        # Bug 1517743 - we want a cheap test because this will be run on each request
+        if release["name"] == "Firefox-mozilla-central-nightly-latest" and query["buildID"] in ("20190103220533", "20190104093221"):
+            squash_response = True
+            LOG.debug("Busted nightly detected, will squash xml response")
+
+    return response_blobs, squash_response
+
+
+def iterResponseXML(query, release, update_type, response_blobs):
+    """Yields the fragments that make up the response for release, with
+    ampersands already escaped. Blobs produce their own escaped fragments
+    (see XMLBlob.getEscapedInnerXML), which lets them escape the parts that
+    don't change from one request to the next ahead of time, instead of
+    escaping the entire document every time it's rendered."""
+    whitelistedDomains = app.config["WHITELISTED_DOMAINS"]
+    specialForceHosts = app.config["SPECIAL_FORCE_HOSTS"]
+    # getHeaderXML() returns outermost header for an update which
+    # is same for all release type
+    for fragment in release.getHeaderXML():
+        yield escapeAmpersands(fragment)
+    # we assume that all blobs will have similar ones. We might want to
+    # verify that all of them are indeed the same in the future.
+
+    # Appending Header
+    # In case of superblob Extracting Header form parent release
+    yield escapeAmpersands(release.getInnerHeaderXML(query, update_type, whitelistedDomains, specialForceHosts))
+    for response_blob in response_blobs:
+        for fragment in response_blob["response_release"].getEscapedInnerXML(
+            response_blob["product_query"], response_blob["response_update_type"], whitelistedDomains, specialForceHosts
+        ):
+            yield fragment
+    # Appending Footer
+    # In case of superblob Extracting Header form parent release
+    yield escapeAmpersands(release.getInnerFooterXML(query, update_type, whitelistedDomains, specialForceHosts))
+    yield escapeAmpersands(release.getFooterXML())
+
+
+def getResponseXML(query, release, update_type, response_blobs, squash_response):
+    xml = "\n".join(iterResponseXML(query, release, update_type, response_blobs))
+
+    # Bug 1517743 - remove newlines and 4 space indents
+    if squash_response:
+        xml = xml.replace("\n", "").replace("    ", "")
+
+    return xml
+
+
+@with_request_metrics("get_update_blob")
 @with_transaction
 def get_update_blob(transaction, **url):
     url["queryVersion"] = extract_query_version(request.url)
@@ -133,79 +306,39 @@ def get_update_blob(transaction, **url):
     # code support queries without it.
     if url["queryVersion"] == 1:
         url["osVersion"] = ""
-    # Bug 1517743 - two Firefox nightlies can't parse update.xml when it contains the usual newlines or indentations
-    squash_response = False
 
     query = getQueryFromURL(url)
     LOG.debug("Got query: %s", query)
-    release, update_type = AUS.evaluateRules(query, transaction=transaction)
+    # Rules are always evaluated, even if the response is cached, because
+    # they may point at a different release (eg: because of backgroundRate)
+    # from one request to the next.
+    trace = get_rule_trace()
+    release, update_type = AUS.evaluateRules(query, transaction=transaction, trace=trace)
 
     # passing {},None returns empty xml
     if release:
-        response_products = release.getResponseProducts()
-        response_blobs = []
-        response_blob_names = release.getResponseBlobs()
-        if response_products:
-            # if we have a SuperBlob of gmp, we process the response products and
-            # concatenate their inner XMLs
-            for product in response_products:
-                product_query = query.copy()
-                product_query["product"] = product
-                response_release, response_update_type = AUS.evaluateRules(product_query, transaction=transaction)
-                if not response_release:
-                    continue
-
-                response_blobs.append({"product_query": product_query, "response_release": response_release, "response_update_type": response_update_type})
-        elif response_blob_names:
-            for blob_name in response_blob_names:
-                # if we have a SuperBlob of systemaddons, we process the response products and
-                # concatenate their inner XMLs
-                product_query = query.copy()
-                product = dbo.releases.getReleases(name=blob_name, limit=1, transaction=transaction)[0]["product"]
-                product_query["product"] = product
-                response_release = dbo.releases.getReleaseBlob(name=blob_name, transaction=transaction)
-                if not response_release:
-                    LOG.warning("No release found with name: %s", blob_name)
-                    continue
-
-                response_blobs.append({"product_query": product_query, "response_release": response_release, "response_update_type": update_type})
+        response_blobs, squash_response = getResponseBlobs(query, release, update_type, transaction, trace=trace)
+        if "xml_responses" in cache:
+            cache_key = getResponseCacheKey(query, release, update_type, response_blobs)
+            cached = cache.get("xml_responses", cache_key)
+            if cached and cached["dependencies"] == getResponseDependencies(release, response_blobs, transaction):
+                xml = cached["xml"]
+            else:
+                # The dependencies are looked up before rendering, so that a
+                # release that changes while we render invalidates the entry.
+                dependencies = getResponseDependencies(release, response_blobs, transaction)
+                xml = getResponseXML(query, release, update_type, response_blobs, squash_response)
+                cache.put("xml_responses", cache_key, {"dependencies": dependencies, "xml": xml})
         else:
-            response_blobs.append({"product_query": query, "response_release": release, "response_update_type": update_type})
-            # Bug 1517743 - we want a cheap test because this will be run on each request
-            if release["name"] == "Firefox-mozilla-central-nightly-latest" and query["buildID"] in ("20190103220533", "20190104093221"):
-                squash_response = True
-                LOG.debug("Busted nightly detected, will squash xml response")
-
-        # getHeaderXML() returns outermost header for an update which
-        # is same for all release type
-        xml = release.getHeaderXML()
-        # we assume that all blobs will have similar ones. We might want to
-        # verify that all of them are indeed the same in the future.
-
-        # Appending Header
-        # In case of superblob Extracting Header form parent release
-        xml.append(release.getInnerHeaderXML(query, update_type, app.config["WHITELISTED_DOMAINS"], app.config["SPECIAL_FORCE_HOSTS"]))
-        for response_blob in response_blobs:
-            xml.extend(
-                response_blob["response_release"].getInnerXML(
-                    response_blob["product_query"], response_blob["response_update_type"], app.config["WHITELISTED_DOMAINS"], app.config["SPECIAL_FORCE_HOSTS"]
-                )
-            )
-        # Appending Footer
-        # In case of superblob Extracting Header form parent release
-        xml.append(release.getInnerFooterXML(query, update_type, app.config["WHITELISTED_DOMAINS"], app.config["SPECIAL_FORCE_HOSTS"]))
-        xml.append(release.getFooterXML())
-        # ensure valid xml by using the right entity for ampersand
-        xml = re.sub("&(?!amp;)", "&amp;", "\n".join(xml))
+            xml = getResponseXML(query, release, update_type, response_blobs, squash_response)
     else:
         xml = ['<?xml version="1.0"?>']
         xml.append("<updates>")
         xml.append("</updates>")
         xml = "\n".join(xml)
 
-    # Bug 1517743 - remove newlines and 4 space indents
-    if squash_response:
-        xml = xml.replace("\n", "").replace("    ", "")
+    if trace:
+        log_rule_trace(trace, query)
 
     LOG.debug("Sending XML: %s", xml)
     response = make_response(xml)
@@ -6,14 +6,18 @@ from flask import current_app as app
 from auslib.AUS import FORCE_FALLBACK_MAPPING, FORCE_MAIN_MAPPING
 from auslib.global_state import cache
 from auslib.util.autograph import make_hash, sign_hash
-from auslib.web.public.base import AUS, with_transaction
+from auslib.web.public.base import AUS, get_rule_trace, log_rule_trace, with_request_metrics, with_transaction
 
 
+@with_request_metrics("get_update")
 @with_transaction
 def get_update(transaction, **parameters):
     force = parameters.get("force")
     parameters["force"] = {FORCE_MAIN_MAPPING.query_value: FORCE_MAIN_MAPPING, FORCE_FALLBACK_MAPPING.query_value: FORCE_FALLBACK_MAPPING}.get(force)
-    release = AUS.evaluateRules(parameters, transaction=transaction)[0]
+    trace = get_rule_trace()
+    release = AUS.evaluateRules(parameters, transaction=transaction, trace=trace)[0]
+    if trace:
+        log_rule_trace(trace, parameters)
     if not release:
         return Response(status=404)
 
@@ -0,0 +1,10 @@
+from flask import Response
+from flask import current_app as app
+
+from auslib.global_state import metrics
+
+
+def get_metrics():
+    if not app.config.get("METRICS_ENABLED"):
+        return Response(status=404)
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8", headers={"Cache-Control": "no-cache"})
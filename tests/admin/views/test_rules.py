@@ -2712,6 +2712,36 @@ class TestRuleScheduledChanges(ViewTest):
         }
         self.assertEqual(ret.get_json(), expected)
 
+    def testGetScheduledChangeHistoryRevisionsWithCursor(self):
+        ret = self._get("/scheduled_changes/rules/3/revisions", qs={"limit": 1})
+        self.assertEqual(ret.status_code, 200, ret.get_data())
+        first = ret.get_json()
+        self.assertEqual(first["count"], 2)
+        self.assertEqual([r["change_id"] for r in first["revisions"]], [3])
+
+        ret = self._get("/scheduled_changes/rules/3/revisions", qs={"limit": 1, "cursor": first["next_cursor"]})
+        self.assertEqual(ret.status_code, 200, ret.get_data())
+        second = ret.get_json()
+        self.assertEqual(second["count"], 2)
+        self.assertEqual([r["change_id"] for r in second["revisions"]], [2])
+        self.assertNotIn("next_cursor", second)
+
+    def testGetRulesHistoryWithCursor(self):
+        ret = self._get("/rules/history", qs={"limit": 5, "count": "false"})
+        self.assertEqual(ret.status_code, 200, ret.get_data())
+        got = ret.get_json()["Rules scheduled change"]
+        self.assertNotIn("count", got)
+        revisions = got["revisions"]
+        while "next_cursor" in got:
+            ret = self._get("/rules/history", qs={"limit": 5, "count": "false", "cursor": got["next_cursor"]})
+            self.assertEqual(ret.status_code, 200, ret.get_data())
+            got = ret.get_json()["Rules scheduled change"]
+            revisions.extend(got["revisions"])
+
+        everything = self._get("/rules/history", qs={"limit": 100}).get_json()["Rules scheduled change"]
+        self.assertEqual(revisions, everything["revisions"])
+        self.assertEqual(len(revisions), 8)
+
     def testGetRulesHistory(self):
         ret = self._get("/rules/history")
         got = ret.get_json()
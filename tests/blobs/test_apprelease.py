@@ -4,6 +4,7 @@ except ImportError:
     # so you're in python <2.7
     from ordereddict import OrderedDict
 
+import copy
 import logging
 import unittest
 
@@ -25,9 +26,9 @@ from auslib.blobs.apprelease import (
     ReleaseBlobV9,
     UnifiedFileUrlsMixin,
 )
-from auslib.blobs.base import BlobValidationError, createBlob
+from auslib.blobs.base import BlobValidationError, createBlob, escapeAmpersands
 from auslib.errors import BadDataError
-from auslib.global_state import dbo
+from auslib.global_state import cache, dbo
 from auslib.web.public.base import app
 
 from ..fakes import FakeGCSHistory
@@ -116,6 +117,15 @@ class TestReleaseBlobBase(unittest.TestCase):
         blob = SimpleBlob(platforms=dict(c=dict(buildID=9, locales=dict(d=dict()))))
         self.assertRaises(BadDataError, blob.getBuildID, "c", "a")
 
+    def testGetBuildIDIndex(self):
+        blob = SimpleBlob(
+            platforms=dict(
+                a=dict(buildID=1, locales=dict(b=dict(), c=dict(buildID=2))), d=dict(alias="a"), e=dict(locales=dict(f=dict())), g=dict(alias="missing")
+            )
+        )
+        expected = {("a", "b"): 1, ("a", "c"): 2, ("d", "b"): 1, ("d", "c"): 2}
+        self.assertEqual(blob.getBuildIDIndex(), expected)
+
     # XXX: should we support the locale overriding the platform? this should probably be invalid
 
 
@@ -590,6 +600,59 @@ class TestSpecialQueryParams(unittest.TestCase):
         self.assertCountEqual(returned, expected)
         self.assertEqual(returned_footer.strip(), expected_footer.strip())
 
+    def testEscapedInnerXMLForced(self):
+        updateQuery = {
+            "product": "h",
+            "version": "0.5",
+            "buildID": "0",
+            "buildTarget": "p",
+            "locale": "l",
+            "channel": "a",
+            "osVersion": "a",
+            "distribution": "a",
+            "distVersion": "a",
+            "force": FORCE_MAIN_MAPPING,
+        }
+        returned = self.blob.getEscapedInnerXML(updateQuery, "minor", self.whitelistedDomains, self.specialForceHosts)
+        returned = [x.strip() for x in returned]
+        expected = ['<patch type="complete" URL="http://a.com/?foo=a&amp;force=1" hashFunction="sha512" hashValue="1" size="1"/>']
+        self.assertCountEqual(returned, expected)
+
+    def testPatchFragmentsMemoized(self):
+        cache.reset()
+        cache.make_cache("blob", 10, 10)
+        self.addCleanup(cache.reset)
+        updateQuery = {
+            "product": "h",
+            "version": "0.5",
+            "buildID": "0",
+            "buildTarget": "p",
+            "locale": "l",
+            "channel": "a",
+            "osVersion": "a",
+            "distribution": "a",
+            "distVersion": "a",
+            "force": None,
+        }
+        forcedQuery = updateQuery.copy()
+        forcedQuery["force"] = FORCE_MAIN_MAPPING
+        unforced = self.blob.getInnerXML(updateQuery, "minor", self.whitelistedDomains, self.specialForceHosts)
+        memo = self.blob.getMemo("patch_fragments")
+        self.assertEqual(len(memo), 1)
+        # Forcing is applied after the memoized fragments are looked up, so
+        # it must neither add a new entry, nor leak into unforced responses.
+        forced = self.blob.getEscapedInnerXML(forcedQuery, "minor", self.whitelistedDomains, self.specialForceHosts)
+        self.assertEqual(len(memo), 1)
+        self.assertIn("http://a.com/?foo=a&amp;force=1", forced[0])
+        self.assertEqual(self.blob.getInnerXML(updateQuery, "minor", self.whitelistedDomains, self.specialForceHosts), unforced)
+        self.assertNotIn("force", unforced[0])
+        # Memos are never copied along with the blob.
+        self.assertNotIn("_memos", copy.deepcopy(self.blob).__dict__)
+
+    def testEscapeAmpersandsIsIdempotent(self):
+        self.assertEqual(escapeAmpersands("a&b&amp;c"), "a&amp;b&amp;c")
+        self.assertEqual(escapeAmpersands(escapeAmpersands("a&b&amp;c")), "a&amp;b&amp;c")
+
     def testSpecialQueryParamForcedFail(self):
         updateQuery = {
             "product": "h",
@@ -1069,6 +1132,32 @@ class TestSchema2Blob(unittest.TestCase):
         self.assertCountEqual(returned, expected)
         self.assertEqual(returned_footer.strip(), expected_footer.strip())
 
+    def testUpdateLineMemoized(self):
+        cache.reset()
+        cache.make_cache("blob", 10, 10)
+        self.addCleanup(cache.reset)
+        updateQuery = {
+            "product": "k",
+            "version": "35.0",
+            "buildID": "4",
+            "buildTarget": "p",
+            "locale": "l2",
+            "channel": "c1",
+            "osVersion": "a",
+            "distribution": "a",
+            "distVersion": "a",
+            "force": None,
+        }
+        expected = self.blobK._buildUpdateLineXML("p", "l2", "minor")
+        with mock.patch.object(self.blobK, "_buildUpdateLineXML", wraps=self.blobK._buildUpdateLineXML) as build:
+            self.assertEqual(self.blobK.getInnerHeaderXML(updateQuery, "minor", self.whitelistedDomains, self.specialForceHosts), expected)
+            self.assertEqual(self.blobK.getInnerHeaderXML(updateQuery, "minor", self.whitelistedDomains, self.specialForceHosts), expected)
+            self.assertEqual(build.call_count, 1)
+            # Anything that's part of the key gets its own line.
+            major = self.blobK.getInnerHeaderXML(updateQuery, "major", self.whitelistedDomains, self.specialForceHosts)
+            self.assertIn('type="major"', major)
+            self.assertEqual(build.call_count, 2)
+
     def testAllowedDomain(self):
         blob = ReleaseBlobV2(fileUrls=dict(c="http://a.com/a"))
         self.assertFalse(blob.containsForbiddenDomain("j", self.whitelistedDomains))
@@ -1622,6 +1711,48 @@ class TestSchema3Blob(unittest.TestCase):
         self.assertCountEqual(returned, expected)
         self.assertEqual(returned_footer.strip(), expected_footer.strip())
 
+    def _partialQuery(self):
+        return {
+            "product": "f",
+            "version": "22.0",
+            "buildID": "5",
+            "buildTarget": "p",
+            "locale": "l",
+            "channel": "a",
+            "osVersion": "a",
+            "distribution": "a",
+            "distVersion": "a",
+            "force": None,
+        }
+
+    def testFromReleaseMatchedWithoutBuildIDIndex(self):
+        # Without a cache to keep them in, there's no point building buildID indexes.
+        with mock.patch.object(dbo.releases, "getReleaseBuildIDs") as getReleaseBuildIDs:
+            returned = self.blobF3.getInnerXML(self._partialQuery(), "minor", self.whitelistedDomains, self.specialForceHosts)
+            self.assertFalse(getReleaseBuildIDs.called)
+        self.assertIn('<patch type="partial" URL="http://a.com/p1" hashFunction="sha512" hashValue="3" size="2"/>', [x.strip() for x in returned])
+
+    def testFromReleaseMatchedWithBuildIDIndex(self):
+        cache.make_cache("release_buildids", 10, 10)
+        try:
+            with mock.patch.object(dbo.releases, "getReleaseBuildIDs", wraps=dbo.releases.getReleaseBuildIDs) as getReleaseBuildIDs:
+                returned = self.blobF3.getInnerXML(self._partialQuery(), "minor", self.whitelistedDomains, self.specialForceHosts)
+                self.assertTrue(getReleaseBuildIDs.called)
+        finally:
+            cache.reset()
+        self.assertIn('<patch type="partial" URL="http://a.com/p1" hashFunction="sha512" hashValue="3" size="2"/>', [x.strip() for x in returned])
+
+    def testFromReleaseNotCachedAsBlobWithBuildIDIndex(self):
+        cache.make_cache("blob", 10, 10)
+        cache.make_cache("release_buildids", 10, 10)
+        try:
+            returned = self.blobF3.getInnerXML(self._partialQuery(), "minor", self.whitelistedDomains, self.specialForceHosts)
+            self.assertIsNotNone(cache.get("release_buildids", "f1"))
+            self.assertIsNone(cache.get("blob", "f1"))
+        finally:
+            cache.reset()
+        self.assertIn('<patch type="partial" URL="http://a.com/p1" hashFunction="sha512" hashValue="3" size="2"/>', [x.strip() for x in returned])
+
     def testSchema3NoPartial(self):
         updateQuery = {
             "product": "f",
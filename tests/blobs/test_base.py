@@ -1,3 +1,4 @@
+import pickle
 import unittest
 from copy import deepcopy
 
@@ -7,6 +8,7 @@ from hypothesis import HealthCheck, assume, given, settings
 
 from auslib.blobs.base import createBlob, merge_dicts, merge_lists
 from auslib.global_state import cache
+from auslib.util.frozen import FrozenDict, freeze
 
 
 class TestCreateBlob(unittest.TestCase):
@@ -52,6 +54,52 @@ class TestCreateBlob(unittest.TestCase):
             self.assertEqual(yaml_load.call_count, 1)
 
 
+class TestFrozenBlob(unittest.TestCase):
+    def setUp(self):
+        self.blob = createBlob(dict(schema_version=1, name="foo", platforms={"p": {"locales": {"l": {"buildID": "1"}}}}))
+
+    def testFreeze(self):
+        frozen = self.blob.freeze()
+        self.assertEqual(frozen, self.blob)
+        self.assertEqual(type(frozen), type(self.blob))
+        self.assertIsInstance(frozen["platforms"]["p"], FrozenDict)
+        self.assertIs(frozen.freeze(), frozen)
+        self.assertIs(freeze(frozen), frozen)
+        for mutate in (
+            lambda b: b.__setitem__("name", "bar"),
+            lambda b: b.__delitem__("name"),
+            lambda b: b.update(name="bar"),
+            lambda b: b.pop("name"),
+            lambda b: b.setdefault("hashFunction", "sha512"),
+            lambda b: b.clear(),
+            lambda b: b["platforms"]["p"].__setitem__("alias", "q"),
+        ):
+            self.assertRaises(TypeError, mutate, frozen)
+        # Freezing makes a copy, so the original is untouched, and still modifiable.
+        self.blob["name"] = "bar"
+        self.assertEqual(frozen["name"], "foo")
+
+    def testMutableCopy(self):
+        frozen = self.blob.freeze()
+        copy = frozen.mutableCopy()
+        copy["name"] = "bar"
+        self.assertEqual(frozen["name"], "foo")
+        # Nested values are shared with the frozen blob.
+        self.assertIs(copy["platforms"], frozen["platforms"])
+
+    def testDeepcopyIsModifiable(self):
+        copy = deepcopy(self.blob.freeze())
+        copy["platforms"]["p"]["locales"]["l"]["buildID"] = "2"
+        self.assertEqual(type(copy), type(self.blob))
+        self.assertEqual(self.blob["platforms"]["p"]["locales"]["l"]["buildID"], "1")
+
+    def testPickleStaysFrozen(self):
+        unpickled = pickle.loads(pickle.dumps(self.blob.freeze()))
+        self.assertEqual(unpickled, self.blob)
+        self.assertRaises(TypeError, unpickled.__setitem__, "name", "bar")
+        self.assertRaises(TypeError, unpickled["platforms"].__setitem__, "q", {})
+
+
 # Things we consider to be useful values in testing blobs. Basically, these
 # are things would actually show up in real blobs. Nesting is handled
 # further down.
@@ -201,3 +249,11 @@ def test_merge_dicts_unicode_and_str_are_equal():
     expected = {"foo": "bar", "blah": "crap", "abc": "def", "ghi": "jkl"}
     got = merge_dicts(base, left, right)
     assert got == expected
+
+
+def test_merge_dicts_frozen_values_merge_like_plain_ones():
+    base = freeze({"foo": {"a": 1}, "bar": [1]})
+    left = freeze({"foo": {"a": 1, "b": 2}, "bar": [1, 2]})
+    right = {"foo": {"a": 1, "c": 3}, "bar": [1, 3]}
+    got = merge_dicts(base, left, right)
+    assert got == {"foo": {"a": 1, "b": 2, "c": 3}, "bar": [1, 2, 3]}
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import pickle
 import re
 import sys
 import unittest
@@ -30,13 +31,17 @@ from auslib.db import (
     OutdatedDataError,
     PermissionDeniedError,
     ReadOnlyError,
+    Row,
     SignoffRequiredError,
     SignoffsTable,
     TransactionError,
     UpdateMergeError,
     verify_signoffs,
 )
-from auslib.global_state import cache, dbo
+from auslib.global_state import cache, dbo, metrics
+from auslib.util.frozen import freeze
+from auslib.util.ruletrace import RuleTrace
+from auslib.util.timestamp import getMillisecondTimestamp
 
 from .fakes import FakeGCSHistory
 
@@ -128,6 +133,41 @@ class TestVerifySignoffs(unittest.TestCase):
         verify_signoffs(required, signoffs)
 
 
+class TestRow(unittest.TestCase):
+    def setUp(self):
+        self.row = Row({"id": 0, "foo": 1}, (1, "bar"))
+
+    def testDictAccess(self):
+        self.assertEqual(self.row["foo"], "bar")
+        self.assertEqual(self.row.get("foo"), "bar")
+        self.assertEqual(self.row.get("baz", 2), 2)
+        self.assertRaises(KeyError, self.row.__getitem__, "baz")
+        self.assertIn("id", self.row)
+        self.assertEqual(list(self.row), ["id", "foo"])
+        self.assertEqual(list(self.row.items()), [("id", 1), ("foo", "bar")])
+        self.assertEqual(len(self.row), 2)
+        self.assertEqual(dict(self.row), {"id": 1, "foo": "bar"})
+
+    def testEquality(self):
+        self.assertEqual(self.row, {"id": 1, "foo": "bar"})
+        self.assertEqual({"id": 1, "foo": "bar"}, self.row)
+        self.assertEqual(self.row, Row({"id": 0, "foo": 1}, (1, "bar")))
+        self.assertNotEqual(self.row, {"id": 1})
+
+    def testAsDictIsModifiable(self):
+        d = self.row.asDict()
+        d["foo"] = "baz"
+        self.assertEqual(self.row["foo"], "bar")
+
+    def testFreeze(self):
+        self.assertIs(freeze(self.row), self.row)
+        frozen = freeze(Row({"a": 0}, ({"b": 1},)))
+        self.assertRaises(TypeError, frozen["a"].__setitem__, "b", 2)
+
+    def testPickle(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.row)), self.row)
+
+
 class TestAUSTransaction(unittest.TestCase, MemoryDatabaseMixin):
     def setUp(self):
         MemoryDatabaseMixin.setUp(self)
@@ -151,6 +191,18 @@ class TestAUSTransaction(unittest.TestCase, MemoryDatabaseMixin):
         trans = AUSTransaction(self.metadata.bind.connect())
         self.assertRaises(TransactionError, trans.execute, "UPDATE test SET foo=123 WHERE fake=1")
 
+    def testExecuteRecordsMetrics(self):
+        metrics.reset()
+        trans = AUSTransaction(self.metadata.bind.connect())
+        trans.execute(self.table.select())
+        trans.execute(self.table.select())
+        trans.execute(self.table.update(values=dict(foo=66)).where(self.table.c.id == 1))
+        self.assertRaises(TransactionError, trans.execute, "UPDATE test SET foo=123 WHERE fake=1")
+        self.assertEqual(metrics.get_histogram('db_query_seconds{statement="select"}').count, 2)
+        self.assertEqual(metrics.get_histogram('db_query_seconds{statement="update"}').count, 1)
+        self.assertEqual(metrics.get('db_query_errors_total{statement="str"}'), 1)
+        metrics.reset()
+
     def testRollback(self):
         trans = AUSTransaction(self.metadata.bind.connect())
         trans.execute(self.table.update(values=dict(foo=66)).where(self.table.c.id == 1))
@@ -292,6 +344,44 @@ class TestAUSTable(unittest.TestCase, TestTableMixin, MemoryDatabaseMixin):
         # If we can't write to this, an Exception will be raised and the test will fail
         ret["foo"] = 3245
 
+    def testSelectLightweight(self):
+        rows = self.test.select(where=[self.test.id >= 2], lightweight=True)
+        self.assertEqual(rows, [dict(id=2, foo=22, data_version=5), dict(id=3, foo=11, data_version=6)])
+        self.assertIsInstance(rows[0], Row)
+        with self.assertRaises(TypeError):
+            rows[0]["foo"] = 1
+        self.assertEqual(self.test.select(where=[self.test.id > 3], lightweight=True), [])
+
+    def testIterSelect(self):
+        rows = self.test.iterSelect(where=[self.test.id >= 2], batch_size=1)
+        self.assertNotIsInstance(rows, list)
+        self.assertEqual(list(rows), [dict(id=2, foo=22, data_version=5), dict(id=3, foo=11, data_version=6)])
+        self.assertEqual(list(self.test.iterSelect(order_by=[self.test.foo], limit=2)), self.test.select(order_by=[self.test.foo], limit=2))
+        self.assertEqual(list(self.test.iterSelect(where={"id": 4})), [])
+
+    def testIterSelectLightweight(self):
+        rows = list(self.test.iterSelect(lightweight=True, batch_size=2))
+        self.assertEqual(rows, self.test.select())
+        self.assertIsInstance(rows[0], Row)
+
+    def testIterSelectFetchesInBatches(self):
+        with mock.patch("sqlalchemy.engine.ResultProxy.fetchmany", autospec=True, side_effect=lambda result, size: result.fetchall()[:size]) as fetchmany:
+            next(self.test.iterSelect(batch_size=2))
+        fetchmany.assert_called_once_with(mock.ANY, 2)
+
+    def testIterSelectWithTransaction(self):
+        with AUSTransaction(self.test.getEngine()) as trans:
+            self.test.update(where=[self.test.id == 1], what=dict(foo=1), changed_by="bob", old_data_version=4, transaction=trans)
+            self.assertEqual([r["foo"] for r in self.test.iterSelect(transaction=trans)], [1, 22, 11])
+
+    def testIterSelectClosesConnectionWhenClosedEarly(self):
+        with mock.patch("sqlalchemy.engine.base.Connection.close") as close:
+            rows = self.test.iterSelect(batch_size=1)
+            next(rows)
+            self.assertFalse(close.called)
+            rows.close()
+            self.assertTrue(close.called)
+
     def testInsert(self):
         self.test.insert(changed_by="bob", id=5, foo=0)
         ret = self.test.t.select().execute().fetchall()
@@ -523,7 +613,138 @@ class TestHistoryTable(unittest.TestCase, TestTableMixin, MemoryDatabaseMixin):
         self.test.insert(changed_by="george", id=5, foo=0)
         self.assertRaises(ValueError, self.test.history.getChange, data_version=1, column_values={"foo": 5})
 
+    def testHistoryIsInsertedInBatches(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        with mock.patch("time.time", mock.MagicMock(side_effect=[1.0, 2.0, 3.0, 4.0])):
+            with AUSTransaction(self.test.getEngine()) as trans:
+                self.test.insert(changed_by="george", id=5, foo=0, transaction=trans)
+                self.test.insert(changed_by="george", id=6, foo=1, transaction=trans)
+                self.test.update(changed_by="heather", where=[self.test.id == 2], what=dict(foo=99), old_data_version=5, transaction=trans)
+                self.test.delete(changed_by="bobby", where=[self.test.id == 1], old_data_version=4, transaction=trans)
+        # Two inserts into the base table, and one for all of the history.
+        self.assertEqual(metrics.get_histogram('db_query_seconds{statement="insert"}').count, 3)
+        ret = self.test.history.t.select().where(self.test.history.change_id > 23).execute().fetchall()
+        self.assertEqual(
+            ret,
+            [
+                (24, "george", 999, 5, None, None),
+                (25, "george", 1000, 5, 0, 1),
+                (26, "george", 1999, 6, None, None),
+                (27, "george", 2000, 6, 1, 1),
+                (28, "heather", 3000, 2, 99, 6),
+                (29, "bobby", 4000, 1, None, None),
+            ],
+        )
+
+    @mock.patch("time.time", mock.MagicMock(return_value=1.0))
+    def testQueuedHistoryIsVisibleInTransaction(self):
+        with AUSTransaction(self.test.getEngine()) as trans:
+            self.test.update(changed_by="heather", where=[self.test.id == 2], what=dict(foo=99), old_data_version=5, transaction=trans)
+            self.assertEqual(self.test.history.getChange(change_id=24, transaction=trans)["foo"], 99)
+            self.assertEqual(self.test.history.count(transaction=trans), 24)
+
+    @mock.patch("time.time", mock.MagicMock(return_value=1.0))
+    def testQueuedHistoryIsDiscardedOnRollback(self):
+        trans = AUSTransaction(self.test.getEngine())
+        self.test.update(changed_by="heather", where=[self.test.id == 2], what=dict(foo=99), old_data_version=5, transaction=trans)
+        trans.rollback()
+        trans.close()
+        self.assertEqual(self.test.history.count(), 23)
+        self.assertEqual(trans._queued_inserts, {})
+
+    def testGetChangesVersionCatchesLateCommits(self):
+        self.test.history.late_commit_window = 5
+        # Pretend that change 20 hasn't been committed yet.
+        self.test.history.t.delete().where(self.test.history.change_id == 20).execute()
+        self.assertEqual(self.test.history.getChangesVersion(), (23, 4))
+        self.test.history.t.insert().execute(change_id=20, timestamp=20, changed_by="admin", id=4, foo=40, data_version=1)
+        self.assertEqual(self.test.history.getChangesVersion(), (23, 5))
+
     def testGetPointInTime(self):
+        self._checkPointInTime()
+
+    def testGetPointInTimeFromCheckpoints(self):
+        cache.reset()
+        cache.make_cache("history_checkpoints", 10, 3600)
+        self.addCleanup(cache.reset)
+        self.addCleanup(setattr, cache, "make_copies", False)
+        for make_copies in (False, True):
+            cache.make_copies = make_copies
+            for interval in (1, 4, 7, 100):
+                cache.clear("history_checkpoints")
+                self.test.history.checkpoint_interval = interval
+                checkpoints = self.test.history.updateCheckpoints()
+                self.assertEqual([checkpoint[0] for checkpoint in checkpoints], list(range(interval, 24, interval)))
+                self._checkPointInTime()
+
+    def testGetPointInTimeWithoutCheckpointsDoesntMakeThem(self):
+        cache.reset()
+        cache.make_cache("history_checkpoints", 10, 3600)
+        self.addCleanup(cache.reset)
+        self.test.history.checkpoint_interval = 4
+        with mock.patch.object(self.test.history, "_scheduleCheckpointUpdate") as schedule:
+            self._checkPointInTime()
+            self.assertTrue(schedule.called)
+        self.assertIsNone(cache.get("history_checkpoints", self.test.history.t.name))
+
+    def testGetPointInTimeOnlyQueriesChangesAfterCheckpoint(self):
+        cache.reset()
+        cache.make_cache("history_checkpoints", 10, 3600)
+        self.addCleanup(cache.reset)
+        self.test.history.checkpoint_interval = 4
+        self.assertEqual(self.test.history.updateCheckpoints()[-1][0], 20)
+
+        statements = []
+        execute = AUSTransaction.execute
+
+        def recordingExecute(trans, statement, *args, **kwargs):
+            statements.append(str(statement.compile(compile_kwargs={"literal_binds": True})))
+            return execute(trans, statement, *args, **kwargs)
+
+        with mock.patch.object(AUSTransaction, "execute", autospec=True, side_effect=recordingExecute):
+            with mock.patch.object(self.test.history, "_scheduleCheckpointUpdate") as schedule:
+                ret = self.test.history.getPointInTime(40)
+                self.assertFalse(schedule.called)
+        self.assertEqual([(row["id"], row["foo"]) for row in ret], [(1, 33), (2, 22), (3, 11)])
+        self.assertEqual(len(statements), 1)
+        self.assertIn("change_id > 20", statements[0])
+        self.assertNotIn("GROUP BY", statements[0])
+
+    def testCheckpointUpdateIsScheduledInBackground(self):
+        cache.reset()
+        cache.make_cache("history_checkpoints", 10, 3600)
+        self.addCleanup(cache.reset)
+        self.test.history.checkpoint_interval = 4
+        with mock.patch("threading.Thread") as Thread:
+            self.test.history.getPointInTime(40)
+            self.test.history.getPointInTime(40)
+            # Only one update is started at a time, and no more often than checkpoint_delay.
+            self.assertEqual(Thread.call_count, 1)
+            Thread.call_args[1]["target"]()
+        self.assertEqual(cache.get("history_checkpoints", self.test.history.t.name)[-1][0], 20)
+        self.assertTrue(self.test.history._checkpoint_lock.acquire(blocking=False))
+
+    def testGetPointInTimeCheckpointsLeaveOutRecentChanges(self):
+        cache.reset()
+        cache.make_cache("history_checkpoints", 10, 3600)
+        self.addCleanup(cache.reset)
+        self.test.history.checkpoint_interval = 2
+        self.test.history.updateCheckpoints()
+        self.test.update(changed_by="bob", where=[self.test.id == 1], what=dict(foo=34), old_data_version=4)
+        self.test.update(changed_by="bob", where=[self.test.id == 1], what=dict(foo=35), old_data_version=5)
+        self.test.history.updateCheckpoints()
+
+        ret = self.test.history.getPointInTime(getMillisecondTimestamp())
+        self.assertEqual([(row["id"], row["foo"]) for row in ret], [(2, 22), (3, 11), (1, 35)])
+        # The new changes are too recent to be checkpointed, in case there
+        # are transactions with older changes that haven't been committed yet.
+        checkpoints = cache.get("history_checkpoints", self.test.history.t.name)
+        self.assertEqual(checkpoints[-1][0], 22)
+        ret = self.test.history.getPointInTime(40)
+        self.assertEqual([(row["id"], row["foo"]) for row in ret], [(1, 33), (2, 22), (3, 11)])
+
+    def _checkPointInTime(self):
         times_and_results = (
             (
                 10,
@@ -1886,12 +2107,9 @@ class RulesTestMixin(object):
     def _stripNullColumns(self, rules):
         # We know a bunch of columns are going to be empty...easier to strip them out
         # than to be super verbose (also should let this test continue to work even
-        # if the schema changes).
-        for rule in rules:
-            for key in rule.copy().keys():
-                if rule[key] is None:
-                    del rule[key]
-        return rules
+        # if the schema changes). Rules may come from the cache, so we make
+        # new dicts rather than modifying them.
+        return [{key: value for key, value in rule.items() if value is not None} for rule in rules]
 
 
 @pytest.mark.usefixtures("current_db_schema")
@@ -2315,6 +2533,33 @@ class TestRulesSimple(unittest.TestCase, RulesTestMixin, MemoryDatabaseMixin):
         ]
         self.assertEqual(rules, expected)
 
+    def testGetRulesMatchingQueryWithTrace(self):
+        query = dict(
+            product="a",
+            version="5.0",
+            channel="a",
+            buildTarget="d",
+            buildID="",
+            locale="",
+            osVersion="foo 1.2.3",
+            distribution="",
+            distVersion="",
+            headerArchitecture="",
+            force=False,
+            queryVersion=3,
+        )
+        trace = RuleTrace()
+        rules = self.paths.getRulesMatchingQuery(query, fallbackChannel="", trace=trace)
+        self.assertEqual(rules, self.paths.getRulesMatchingQuery(query, fallbackChannel=""))
+        self.assertEqual(trace.matched, len(rules))
+        # Every candidate that didn't match must have been rejected by exactly one stage.
+        self.assertEqual(sum(stats["rejected"] for stats in trace.stages.values()), trace.candidates - trace.matched)
+        self.assertGreater(trace.stages["version"]["evaluated"], 0)
+        self.assertGreater(trace.stages["version"]["rejected"], 0)
+        fields = trace.fields()["rule_trace"]
+        self.assertEqual(fields["matched"], len(rules))
+        self.assertEqual(fields["stages"]["version"]["rejected"], trace.stages["version"]["rejected"])
+
     def testGetRulesMatchingQueryOsVersionSubstring(self):
         rules = self.paths.getRulesMatchingQuery(
             dict(
@@ -3526,6 +3771,129 @@ class TestRulesSpecial(unittest.TestCase, RulesTestMixin, MemoryDatabaseMixin):
         self.assertEqual(rules, [])
 
 
+class RuleIndexMixin(object):
+    """Runs the tests of the class it is mixed into with the rule index enabled,
+    to make sure that it returns the same results as the database queries do."""
+
+    def setUp(self):
+        cache.reset()
+        cache.make_cache("rules_index", 1, 30)
+        super(RuleIndexMixin, self).setUp()
+
+    def tearDown(self):
+        cache.reset()
+        super(RuleIndexMixin, self).tearDown()
+
+
+class TestRulesSimpleWithIndex(RuleIndexMixin, TestRulesSimple):
+    pass
+
+
+class TestJawsRulesWithIndex(RuleIndexMixin, TestJawsRules):
+    pass
+
+
+class TestMig64RulesWithIndex(RuleIndexMixin, TestMig64Rules):
+    pass
+
+
+class TestRulesSpecialWithIndex(RuleIndexMixin, TestRulesSpecial):
+    pass
+
+
+@pytest.mark.usefixtures("current_db_schema")
+class TestRuleIndex(unittest.TestCase, MemoryDatabaseMixin):
+    def setUp(self):
+        MemoryDatabaseMixin.setUp(self)
+        cache.reset()
+        cache.make_copies = False
+        cache.make_cache("rules_index", 1, 30)
+        self.db = AUSDatabase(self.dburi)
+        self.metadata.create_all(self.db.engine)
+        self.rules = self.db.rules
+        self.rules.t.insert().execute(rule_id=1, priority=100, product="a", channel="foo", mapping="a", update_type="minor", data_version=1)
+        self.rules.t.insert().execute(rule_id=2, priority=90, product="a", channel="fo*", mapping="b", update_type="minor", data_version=1)
+        self.rules.t.insert().execute(rule_id=3, priority=200, product="a", channel="bar", mapping="c", update_type="minor", data_version=1)
+        self.rules.t.insert().execute(rule_id=4, priority=50, mapping="d", update_type="minor", data_version=1)
+        self.rules.t.insert().execute(rule_id=5, priority=150, product="a", version="<3.0", mapping="e", update_type="minor", data_version=1)
+        self.rules.history.t.insert().execute(change_id=1, changed_by="bill", timestamp=10, rule_id=5, data_version=1)
+
+    def tearDown(self):
+        cache.reset()
+
+    def _makeQuery(self, **kwargs):
+        query = dict(product="a", version="3.5", channel="foo", buildTarget="d", buildID="1", locale="l", osVersion="", force=False)
+        query.update(kwargs)
+        return query
+
+    def testDisabledWithoutCache(self):
+        cache.reset()
+        self.assertEqual(self.rules.getRuleIndex(), None)
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(), fallbackChannel="foo")["rule_id"], 1)
+
+    def testBestMatch(self):
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(), fallbackChannel="foo")["rule_id"], 1)
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(version="2.0"), fallbackChannel="foo")["rule_id"], 5)
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(channel="foobar"), fallbackChannel="foobar")["rule_id"], 2)
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(channel="bar-cck-x"), fallbackChannel="bar")["rule_id"], 3)
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(product="b"), fallbackChannel="foo")["rule_id"], 4)
+
+    def testNoMatch(self):
+        self.rules.t.delete().where(self.rules.rule_id == 4).execute()
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(product="b"), fallbackChannel="foo"), None)
+
+    def testMatchesDatabase(self):
+        query = self._makeQuery(channel="foo-cck-x")
+        expected = self.rules.getRulesMatchingQuery(query, fallbackChannel="foo")
+        cache.reset()
+        self.assertEqual([r["rule_id"] for r in expected], [1, 2, 4])
+        self.assertEqual(self.rules.getRulesMatchingQuery(query, fallbackChannel="foo"), expected)
+
+    def testCandidatesAreTimedAsTheyreFound(self):
+        trace = RuleTrace()
+        rules = self.rules.getRulesMatchingQuery(self._makeQuery(channel="foo-cck-x"), fallbackChannel="foo", trace=trace)
+        self.assertEqual([r["rule_id"] for r in rules], [1, 2, 4])
+        # Getting each candidate is timed, including the last (failed) attempt.
+        self.assertEqual(trace.stages["candidates"]["evaluated"], trace.candidates + 1)
+
+    def testIndexReusedWhenRulesUnchanged(self):
+        index = self.rules.getRuleIndex()
+        cache.clear("rules_index")
+        self.rules.t.insert().execute(rule_id=6, priority=1000, product="a", mapping="f", update_type="minor", data_version=1)
+        # No history was written, so the index isn't rebuilt.
+        self.assertIs(self.rules.getRuleIndex(), index)
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(), fallbackChannel="foo")["rule_id"], 1)
+
+    def testIndexRebuiltWhenRulesChange(self):
+        index = self.rules.getRuleIndex()
+        self.assertEqual(index.version, (1, 1))
+        self.rules.t.insert().execute(rule_id=6, priority=1000, product="a", mapping="f", update_type="minor", data_version=1)
+        self.rules.history.t.insert().execute(change_id=2, changed_by="bill", timestamp=20, rule_id=6, data_version=1)
+        # Still cached...
+        self.assertIs(self.rules.getRuleIndex(), index)
+        # ...until the cache entry expires.
+        cache.clear("rules_index")
+        new_index = self.rules.getRuleIndex()
+        self.assertIsNot(new_index, index)
+        self.assertEqual(new_index.version, (2, 2))
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(), fallbackChannel="foo")["rule_id"], 6)
+
+    def testIndexRebuiltWhenChangeCommitsAfterAHigherOne(self):
+        # Change 3 commits first, while change 2 is still in progress...
+        self.rules.t.update(values=dict(mapping="g")).where(self.rules.rule_id == 4).execute()
+        self.rules.history.t.insert().execute(change_id=3, changed_by="bill", timestamp=30, rule_id=4, mapping="g", data_version=2)
+        index = self.rules.getRuleIndex()
+        self.assertEqual(index.version, (3, 2))
+        # ...and then change 2 commits, which doesn't change the latest change_id.
+        self.rules.t.insert().execute(rule_id=6, priority=1000, product="a", mapping="f", update_type="minor", data_version=1)
+        self.rules.history.t.insert().execute(change_id=2, changed_by="bill", timestamp=20, rule_id=6, data_version=1)
+        cache.clear("rules_index")
+        new_index = self.rules.getRuleIndex()
+        self.assertIsNot(new_index, index)
+        self.assertEqual(new_index.version, (3, 3))
+        self.assertEqual(self.rules.getBestRuleMatchingQuery(self._makeQuery(), fallbackChannel="foo")["rule_id"], 6)
+
+
 @pytest.mark.usefixtures("current_db_schema")
 class TestReleases(unittest.TestCase, MemoryDatabaseMixin):
     def setUp(self):
@@ -3559,12 +3927,9 @@ class TestReleases(unittest.TestCase, MemoryDatabaseMixin):
     def _stripNullColumns(self, rules):
         # We know a bunch of columns are going to be empty...easier to strip them out
         # than to be super verbose (also should let this test continue to work even
-        # if the schema changes).
-        for rule in rules:
-            for key in rule.copy().keys():
-                if rule[key] is None:
-                    del rule[key]
-        return rules
+        # if the schema changes). Rules may not be modifiable, so we make new
+        # dicts rather than changing them.
+        return [{key: value for key, value in rule.items() if value is not None} for rule in rules]
 
     def testAllTablesCreated(self):
         self.assertTrue(dbo.releases)
@@ -3590,6 +3955,23 @@ class TestReleases(unittest.TestCase, MemoryDatabaseMixin):
     def testGetReleaseBlobNonExistentRelease(self):
         self.assertRaises(KeyError, self.releases.getReleaseBlob, name="z")
 
+    def testGetReleasesByName(self):
+        expected = {
+            "b": dict(name="b", product="b", data=createBlob(dict(name="b", schema_version=1, hashFunction="sha512")), data_version=1),
+            "c": dict(name="c", product="c", data=createBlob(dict(name="c", schema_version=1, hashFunction="sha512")), data_version=1),
+        }
+        self.assertEqual(self.releases.getReleasesByName(["b", "c", "z"]), expected)
+
+    def testGetReleasesByNameNoNames(self):
+        self.assertEqual(self.releases.getReleasesByName([]), {})
+
+    def testGetReleaseBlobs(self):
+        expected = {
+            "b": createBlob(dict(name="b", schema_version=1, hashFunction="sha512")),
+            "c": createBlob(dict(name="c", schema_version=1, hashFunction="sha512")),
+        }
+        self.assertEqual(self.releases.getReleaseBlobs(["b", "c", "z"]), expected)
+
     def testGetReleaseInfoAll(self):
         releases = self.releases.getReleaseInfo()
         expected = [
@@ -4079,6 +4461,115 @@ class TestBlobCaching(unittest.TestCase, MemoryDatabaseMixin):
             # miss, the next three hit, and then the last one miss again.
             self._checkCacheStats(cache.caches["blob_version"], 5, 3, 2)
 
+    def testGetReleasesByNameOnlyFetchesOutdatedData(self):
+        self.releases.getReleaseBlob(name="a")
+        self.releases.getReleaseBlob(name="b")
+        self.releases.t.update(values=dict(data=createBlob(dict(name="b", schema_version=1, hashFunction="sha256")), data_version=2)).where(
+            self.releases.name == "b"
+        ).execute()
+
+        with mock.patch("auslib.db.createBlob", wraps=createBlob) as cb:
+            releases = self.releases.getReleasesByName(["a", "b"])
+            # Only b's data should have been returned from the database.
+            self.assertEqual(cb.call_count, 1)
+
+        self.assertEqual(releases["a"]["data_version"], 1)
+        self.assertEqual(releases["a"]["data"]["hashFunction"], "sha512")
+        self.assertEqual(releases["b"]["data_version"], 2)
+        self.assertEqual(releases["b"]["data"]["hashFunction"], "sha256")
+        # And the caches should be up to date with what was found.
+        self.assertEqual(cache.get("blob_version", "b"), 2)
+        self.assertEqual(cache.get("blob", "b")["data_version"], 2)
+        self.assertEqual(self.releases.getReleaseBlob(name="b")["hashFunction"], "sha256")
+
+    def testGetReleaseBlobDoesntReparseIdenticalData(self):
+        metrics.reset()
+        self.releases.getReleaseBlob(name="b")
+        self.releases.t.update(values=dict(data_version=2)).where(self.releases.name == "b").execute()
+        cache.invalidate("blob_version", "b")
+
+        with mock.patch("auslib.db.createBlob") as cb:
+            blob = self.releases.getReleaseBlob(name="b")
+            self.assertFalse(cb.called)
+
+        self.assertEqual(blob, createBlob(dict(name="b", schema_version=1, hashFunction="sha512")))
+        self.assertEqual(cache.get("blob", "b")["data_version"], 2)
+        self.assertEqual(metrics.get("blob_parses"), 1)
+        self.assertEqual(metrics.get("blob_reparses_avoided"), 1)
+
+    def testGetReleaseBlobReparsesChangedData(self):
+        metrics.reset()
+        self.releases.getReleaseBlob(name="b")
+        self.releases.t.update(values=dict(data=createBlob(dict(name="b", schema_version=1, hashFunction="sha256")), data_version=2)).where(
+            self.releases.name == "b"
+        ).execute()
+        cache.invalidate("blob_version", "b")
+
+        self.assertEqual(self.releases.getReleaseBlob(name="b")["hashFunction"], "sha256")
+        self.assertEqual(metrics.get("blob_parses"), 2)
+        self.assertEqual(metrics.get("blob_reparses_avoided"), 0)
+
+    def testGetReleasesByNameDoesntReparseIdenticalData(self):
+        metrics.reset()
+        self.releases.getReleaseBlob(name="b")
+        self.releases.t.update(values=dict(data_version=2)).where(self.releases.name == "b").execute()
+
+        releases = self.releases.getReleasesByName(["b"])
+        self.assertEqual(releases["b"]["data_version"], 2)
+        self.assertEqual(releases["b"]["data"], createBlob(dict(name="b", schema_version=1, hashFunction="sha512")))
+        self.assertEqual(metrics.get("blob_parses"), 1)
+        self.assertEqual(metrics.get("blob_reparses_avoided"), 1)
+
+    def testGetReleaseBlobsUsesCache(self):
+        self.releases.getReleaseBlob(name="a")
+        self.releases.getReleaseBlob(name="b")
+
+        with mock.patch.object(self.releases, "getReleasesByName", wraps=self.releases.getReleasesByName) as getReleasesByName:
+            blobs = self.releases.getReleaseBlobs(["a", "b"])
+            self.assertFalse(getReleasesByName.called)
+
+        self.assertEqual(sorted(blobs), ["a", "b"])
+
+    def testGetReleaseBlobsFetchesUncachedInOneQuery(self):
+        self.releases.getReleaseBlob(name="a")
+        cache.invalidate("blob_version", "a")
+
+        with mock.patch.object(self.releases, "select", wraps=self.releases.select) as select:
+            blobs = self.releases.getReleaseBlobs(["a", "b"])
+            self.assertEqual(select.call_count, 1)
+
+        self.assertEqual(blobs["a"]["name"], "a")
+        self.assertEqual(blobs["b"]["name"], "b")
+
+    def testGetReleaseBuildIDsUsesOwnCache(self):
+        cache.make_cache("release_buildids", 10, 10)
+        blob = createBlob(dict(name="c", schema_version=1, hashFunction="sha512", platforms=dict(p=dict(buildID="1", locales=dict(m=dict())))))
+        self.releases.t.insert().execute(name="c", product="c", data=blob, data_version=1)
+
+        self.assertEqual(self.releases.getReleaseBuildIDs(name="c"), {("p", "m"): "1"})
+        # The index outlives the blob in the cache, and doesn't need it.
+        cache.invalidate("blob", "c")
+        with mock.patch.object(self.releases, "getReleaseBlob", wraps=self.releases.getReleaseBlob) as getReleaseBlob:
+            self.assertEqual(self.releases.getReleaseBuildIDs(name="c"), {("p", "m"): "1"})
+            self.assertFalse(getReleaseBlob.called)
+
+        # But it's rebuilt once the release has a new data_version.
+        blob["platforms"]["p"]["buildID"] = "2"
+        self.releases.t.update(values=dict(data=blob, data_version=2)).where(self.releases.name == "c").execute()
+        cache.invalidate("blob_version", "c")
+        self.assertEqual(self.releases.getReleaseBuildIDs(name="c"), {("p", "m"): "2"})
+
+        self.assertRaises(KeyError, self.releases.getReleaseBuildIDs, name="z")
+
+    def testGetReleaseBuildIDsDoesntCacheBlob(self):
+        cache.make_cache("release_buildids", 10, 10)
+        blob = createBlob(dict(name="c", schema_version=1, hashFunction="sha512", platforms=dict(p=dict(buildID="1", locales=dict(m=dict())))))
+        self.releases.t.insert().execute(name="c", product="c", data=blob, data_version=1)
+
+        self.assertEqual(self.releases.getReleaseBuildIDs(name="c"), {("p", "m"): "1"})
+        self.assertIsNone(cache.get("blob", "c"))
+        self.assertEqual(cache.get("release_buildids", "c")["data_version"], 1)
+
     def testGetReleasesUsesBlobCache(self):
         with mock.patch("time.time") as t:
             t.return_value = 0
@@ -4214,6 +4705,36 @@ class TestBlobCaching(unittest.TestCase, MemoryDatabaseMixin):
             self._checkCacheStats(cache.caches["blob"], 3, 2, 1)
             self._checkCacheStats(cache.caches["blob_version"], 3, 2, 1)
 
+    def testCachedBlobsAreSharedAndFrozen(self):
+        blob = self.releases.getReleaseBlob(name="a")
+        self.assertIs(self.releases.getReleaseBlob(name="a"), blob)
+        self.assertRaises(TypeError, blob.__setitem__, "name", "b")
+
+    def testAddLocaleToReleaseDoesntModifyCachedBlob(self):
+        old = self.releases.getReleaseBlob(name="b")
+        self.releases.addLocaleToRelease("b", "b", "win", "zu", dict(buildID=123), 1, "bob")
+        self.assertEqual(old, {"schema_version": 1, "name": "b", "hashFunction": "sha512"})
+        self.releases.addLocaleToRelease("b", "b", "win", "af", dict(buildID=123), 2, "bob")
+        new = self.releases.getReleaseBlob(name="b")
+        self.assertEqual(new["platforms"]["win"]["locales"], {"zu": {"buildID": 123}, "af": {"buildID": 123}})
+
+    def testMergedUpdateCachesMergedBlob(self):
+        # The blob at data_version 2 is the ancestor of both of the updates
+        # below, which means it needs to be in the history.
+        self.releases.update(
+            where={"name": "b"}, what={"data": createBlob(dict(name="b", schema_version=1, hashFunction="sha1"))}, changed_by="bob", old_data_version=1
+        )
+        for extra in (dict(detailsUrl="foo"), dict(licenseUrl="bar")):
+            self.releases.update(
+                where={"name": "b"},
+                what={"data": createBlob(dict(name="b", schema_version=1, hashFunction="sha1", **extra))},
+                changed_by="bob",
+                old_data_version=2,
+            )
+        expected = {"name": "b", "schema_version": 1, "hashFunction": "sha1", "detailsUrl": "foo", "licenseUrl": "bar"}
+        self.assertEqual(cache.get("blob", "b")["blob"], expected)
+        self.assertEqual(self.releases.getReleaseBlob(name="b"), expected)
+
 
 @pytest.mark.usefixtures("current_db_schema")
 class TestReleasesAppReleaseBlobs(unittest.TestCase, MemoryDatabaseMixin):
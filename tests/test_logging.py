@@ -3,6 +3,7 @@ import logging
 from io import StringIO
 
 from auslib.log import configure_logging
+from auslib.util.ruletrace import RuleTrace
 
 
 def test_logger(caplog):
@@ -100,3 +101,18 @@ def test_no_message(caplog):
 
     o = json.loads(stream.getvalue())
     assert "message" not in o["Fields"]
+
+
+def test_rule_trace_fields(caplog):
+    stream = StringIO()
+    configure_logging(stream=stream)
+
+    trace = RuleTrace()
+    trace.candidates = 2
+    trace.check("version", lambda: False)
+    logging.info("Rule evaluation trace", extra=trace.fields())
+
+    o = json.loads(stream.getvalue())
+    assert o["Fields"]["rule_trace"]["candidates"] == 2
+    assert o["Fields"]["rule_trace"]["stages"]["version"]["evaluated"] == 1
+    assert o["Fields"]["rule_trace"]["stages"]["version"]["rejected"] == 1
@@ -1,8 +1,13 @@
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import mock
 
-from auslib.util.cache import MaybeCacher
+from auslib.blobs.base import createBlob
+from auslib.util.cache import MaybeCacher, SharedFileCache
 
 
 class TestMaybeCacher(unittest.TestCase):
@@ -16,6 +21,21 @@ class TestMaybeCacher(unittest.TestCase):
             self.assertFalse(lru.put.called)
             self.assertFalse(lru.get.called)
 
+    def testContains(self):
+        cache = MaybeCacher()
+        self.assertFalse("cache1" in cache)
+        cache.make_cache("cache1", 5, 5)
+        self.assertTrue("cache1" in cache)
+
+    def testStats(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 1, 5)
+        cache.put("cache1", "foo", "bar")
+        cache.get("cache1", "foo")
+        cache.get("cache1", "baz")
+        cache.put("cache1", "baz", "bar")
+        self.assertEqual(cache.stats(), {"cache1": {"lookups": 2, "hits": 1, "misses": 1, "evictions": 1, "coalesced": 0, "stale": 0, "early_refreshes": 0}})
+
     def testSimpleCache(self):
         cache = MaybeCacher()
         cache.make_cache("cache1", 5, 5)
@@ -72,3 +92,276 @@ class TestMaybeCacher(unittest.TestCase):
         cache.put("cache1", "foo", obj)
         cached_obj = cache.caches["cache1"].data["foo"]
         self.assertNotEqual(id(obj), id(cached_obj))
+
+    def testMakeCopiesSharesFrozenValues(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5)
+        cache.make_copies = True
+        obj = {"foo": [1, 2, 3]}
+        cache.put("cache1", "foo", obj)
+        obj["foo"].append(4)
+        cached_obj = cache.get("cache1", "foo")
+        self.assertEqual(cached_obj, {"foo": [1, 2, 3]})
+        # Values are frozen on the way into the cache, so they don't need
+        # to be copied on the way out.
+        self.assertIs(cache.get("cache1", "foo"), cached_obj)
+        self.assertRaises(TypeError, cached_obj["foo"].append, 4)
+
+    def testMakeCopiesFreezesValuesFromGetter(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5)
+        cache.make_copies = True
+        value = cache.get("cache1", "foo", lambda: {"foo": "bar"})
+        self.assertIs(cache.get("cache1", "foo"), value)
+        self.assertRaises(TypeError, value.__setitem__, "foo", "baz")
+
+    def testConcurrentMissesShareGetter(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def getter():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "bar"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("cache1", "foo", getter))) for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, ["bar"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get("cache1", "foo"), "bar")
+
+    def testMissRechecksCacheBeforeCallingGetter(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5)
+        cache.put("cache1", "foo", "bar")
+        lru = cache.caches["cache1"]
+        get = lru.get
+        # Somebody else caches the value after we miss, but before our getter would be called.
+        with mock.patch.object(lru, "get", side_effect=[None, get("foo")]):
+            self.assertEqual(cache.get("cache1", "foo", lambda: "new"), "bar")
+        self.assertEqual(cache.stats()["cache1"]["coalesced"], 1)
+
+    def testStaleWhileRevalidate(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5, stale_while_revalidate=10)
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            cache.put("cache1", "foo", "old")
+            self.assertEqual(cache.get("cache1", "foo", lambda: "new"), "old")
+
+            # Expired, but not stale for long enough to have been dropped.
+            # Without a value_getter, there's no way to refresh it.
+            t.return_value = 106
+            self.assertEqual(cache.get("cache1", "foo"), None)
+
+            # While a refresh is in flight, the stale value is served...
+            def refresh():
+                self.assertEqual(cache.get("cache1", "foo", lambda: "other"), "old")
+                return "new"
+
+            self.assertEqual(cache.get("cache1", "foo", refresh), "new")
+            # ...and once it's done, the new one is.
+            self.assertEqual(cache.get("cache1", "foo", lambda: "other"), "new")
+            self.assertEqual(cache.stats()["cache1"]["stale"], 1)
+
+            # Values are dropped altogether once they've been stale for too long.
+            t.return_value = 200
+            self.assertEqual(cache.get("cache1", "foo"), None)
+
+    def testTimeoutJitter(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, timeout_jitter=0.5)
+        with mock.patch("time.time") as t, mock.patch("auslib.util.cache.random.random") as rand:
+            t.return_value = 100
+            rand.return_value = 0.5
+            cache.put("cache1", "foo", "bar")
+            rand.return_value = 0
+            cache.put("cache1", "baz", "bar")
+            # foo's timeout was cut to 7.5 seconds, baz's wasn't cut at all.
+            t.return_value = 108
+            self.assertEqual(cache.get("cache1", "foo"), None)
+            self.assertEqual(cache.get("cache1", "baz"), "bar")
+
+    def testTimeoutJitterMustBeAFraction(self):
+        cache = MaybeCacher()
+        self.assertRaises(ValueError, cache.make_cache, "cache1", 5, 10, timeout_jitter=1)
+
+    def testEarlyRefresh(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, early_refresh=1.0)
+        with mock.patch("time.time") as t, mock.patch("auslib.util.cache.random.random") as rand:
+            t.return_value = 100
+
+            def slowGetter():
+                t.return_value += 1
+                return "old"
+
+            # The value took 1 second to get, and expires at 111.
+            self.assertEqual(cache.get("cache1", "foo", slowGetter), "old")
+
+            # With 9 seconds left, a typical roll doesn't refresh...
+            t.return_value = 102
+            rand.return_value = 0.5
+            self.assertEqual(cache.get("cache1", "foo", lambda: "new"), "old")
+            # ...but with half a second left, it does.
+            t.return_value = 110.5
+            self.assertEqual(cache.get("cache1", "foo", lambda: "new"), "new")
+            self.assertEqual(cache.stats()["cache1"]["early_refreshes"], 1)
+
+    def testEarlyRefreshNotUsedForPutValues(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, early_refresh=1.0)
+        with mock.patch("time.time") as t, mock.patch("auslib.util.cache.random.random") as rand:
+            t.return_value = 100
+            rand.return_value = 0.999999
+            cache.put("cache1", "foo", "old")
+            t.return_value = 109.9
+            self.assertEqual(cache.get("cache1", "foo", lambda: "new"), "old")
+
+    def testStaleWhileRevalidateWithSharedCache(self):
+        shared_dir = tempfile.mkdtemp()
+        try:
+            cache = MaybeCacher()
+            cache.make_cache("cache1", 5, 5, shared_dir=shared_dir, stale_while_revalidate=10)
+            cache.put("cache1", "foo", {"bar": 1})
+            self.assertEqual(cache.get("cache1", "foo"), {"bar": 1})
+        finally:
+            shutil.rmtree(shared_dir)
+
+
+class TestSharedFileCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testMakeSharedCache(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5, shared_dir=self.dir)
+        self.assertIsInstance(cache.caches["cache1"], SharedFileCache)
+        self.assertEqual(cache.caches["cache1"].directory, os.path.join(self.dir, "cache1"))
+
+    def testSharedBetweenCachers(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5, shared_dir=self.dir)
+        cache2 = MaybeCacher()
+        cache2.make_cache("cache1", 5, 5, shared_dir=self.dir)
+        cache.put("cache1", "foo", {"bar": [1, 2]})
+        self.assertEqual(cache2.get("cache1", "foo"), {"bar": [1, 2]})
+        cache2.invalidate("cache1", "foo")
+        self.assertEqual(cache.get("cache1", "foo"), None)
+
+    def testCachesAreSeparate(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5, shared_dir=self.dir)
+        cache.make_cache("cache2", 5, 5, shared_dir=self.dir)
+        cache.put("cache1", "foo", "bar")
+        self.assertEqual(cache.get("cache2", "foo"), None)
+
+    def testValueIsReusedUntilReplaced(self):
+        shared = SharedFileCache(self.dir, 5, 5)
+        shared.put("foo", [1, 2, 3])
+        value = shared.get("foo")
+        self.assertIs(shared.get("foo"), value)
+        other = SharedFileCache(self.dir, 5, 5)
+        other.put("foo", [1, 2, 3])
+        self.assertIsNot(shared.get("foo"), value)
+        self.assertEqual(shared.get("foo"), value)
+
+    def testBlobsSurviveRoundTrip(self):
+        shared = SharedFileCache(self.dir, 5, 5)
+        blob = createBlob(dict(name="foo", schema_version=1, hashFunction="sha512", platforms={}))
+        shared.put("foo", {"data_version": 1, "blob": blob})
+        cached = SharedFileCache(self.dir, 5, 5).get("foo")
+        self.assertEqual(cached["data_version"], 1)
+        self.assertEqual(type(cached["blob"]), type(blob))
+        self.assertEqual(cached["blob"], blob)
+        self.assertEqual(list(cached["blob"].keys()), list(blob.keys()))
+
+    def testExpired(self):
+        shared = SharedFileCache(self.dir, 5, 5)
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            shared.put("foo", "bar")
+            self.assertEqual(shared.get("foo"), "bar")
+            t.return_value = 200
+            self.assertEqual(shared.get("foo"), None)
+        self.assertEqual((shared.lookups, shared.hits, shared.misses), (2, 1, 1))
+
+    def testEviction(self):
+        shared = SharedFileCache(self.dir, 2, 5)
+        with mock.patch("time.time") as t:
+            for i, key in enumerate(("a", "b", "c")):
+                t.return_value = 100 + i
+                shared.put(key, key)
+            self.assertEqual(shared.get("a"), None)
+            self.assertEqual(shared.get("b"), "b")
+            self.assertEqual(shared.get("c"), "c")
+        self.assertEqual(shared.evictions, 1)
+
+    def testEvictsSoonestToExpireFirst(self):
+        shared = SharedFileCache(self.dir, 2, 5)
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            shared.put("a", "a", timeout=50)
+            shared.put("b", "b", timeout=10)
+            shared.put("c", "c", timeout=20)
+            self.assertEqual(shared.get("a"), "a")
+            self.assertEqual(shared.get("b"), None)
+            self.assertEqual(shared.get("c"), "c")
+
+    def testEvictionOnlyScansEveryFewPuts(self):
+        shared = SharedFileCache(self.dir, 20, 5)
+        with mock.patch.object(shared, "_evict", wraps=shared._evict) as evict:
+            for i in range(5):
+                shared.put(i, i)
+            self.assertEqual(evict.call_count, 2)
+
+    def testEvictionIgnoresEntriesRemovedByOthers(self):
+        shared = SharedFileCache(self.dir, 1, 5)
+        shared.put("a", "a")
+        entries = list(shared._iter_entries())
+        shared.invalidate("a")
+        with mock.patch.object(shared, "_iter_entries", return_value=entries + list(shared._iter_entries())):
+            shared._evict()
+        self.assertEqual(shared.evictions, 0)
+
+    def testLocalValuesAreBounded(self):
+        shared = SharedFileCache(self.dir, 10, 5, local_size=2)
+        for key in ("a", "b", "c"):
+            shared.put(key, [key])
+        a = shared.get("a")
+        shared.get("b")
+        self.assertIs(shared.get("a"), a)
+        shared.get("c")
+        self.assertEqual(list(shared._local), ["a", "c"])
+
+    def testDirectoryMustNotBeWritableByOthers(self):
+        os.chmod(self.dir, 0o777)
+        self.assertRaises(ValueError, SharedFileCache, self.dir, 5, 5)
+        os.chmod(self.dir, 0o700)
+        SharedFileCache(self.dir, 5, 5)
+
+    def testDirectoryMustBeOwnedByCurrentUser(self):
+        with mock.patch("os.getuid", return_value=os.getuid() + 1):
+            self.assertRaises(ValueError, SharedFileCache, self.dir, 5, 5)
+
+    def testClear(self):
+        shared = SharedFileCache(self.dir, 5, 5)
+        shared.put("foo", "bar")
+        shared.clear()
+        self.assertEqual(shared.get("foo"), None)
+        self.assertEqual(os.listdir(self.dir), [])
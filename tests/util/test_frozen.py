@@ -0,0 +1,83 @@
+import json
+import pickle
+import unittest
+from copy import copy, deepcopy
+
+from auslib.util.frozen import FrozenDict, FrozenList, freeze
+
+
+class TestFreeze(unittest.TestCase):
+    def setUp(self):
+        self.value = {"foo": [1, {"bar": "baz"}], "n": None, "t": (1, [2])}
+
+    def testFreeze(self):
+        frozen = freeze(self.value)
+        self.assertEqual(frozen, {"foo": [1, {"bar": "baz"}], "n": None, "t": (1, [2])})
+        self.assertIsInstance(frozen, FrozenDict)
+        self.assertIsInstance(frozen["foo"], FrozenList)
+        self.assertIsInstance(frozen["foo"][1], FrozenDict)
+        self.assertIsInstance(frozen["t"][1], FrozenList)
+        # The original is copied, not modified.
+        self.assertEqual(type(self.value["foo"]), list)
+
+    def testFrozenDictCantBeModified(self):
+        frozen = freeze(self.value)
+        for mutate in (
+            lambda d: d.__setitem__("foo", 1),
+            lambda d: d.__delitem__("foo"),
+            lambda d: d.update(foo=1),
+            lambda d: d.pop("foo"),
+            lambda d: d.popitem(),
+            lambda d: d.setdefault("baz", 1),
+            lambda d: d.clear(),
+        ):
+            self.assertRaises(TypeError, mutate, frozen)
+        self.assertEqual(frozen, self.value)
+
+    def testFrozenListCantBeModified(self):
+        frozen = freeze(self.value)["foo"]
+        for mutate in (
+            lambda lst: lst.__setitem__(0, 2),
+            lambda lst: lst.__delitem__(0),
+            lambda lst: lst.__iadd__([2]),
+            lambda lst: lst.append(2),
+            lambda lst: lst.extend([2]),
+            lambda lst: lst.insert(0, 2),
+            lambda lst: lst.pop(),
+            lambda lst: lst.remove(1),
+            lambda lst: lst.reverse(),
+            lambda lst: lst.sort(),
+            lambda lst: lst.clear(),
+        ):
+            self.assertRaises(TypeError, mutate, frozen)
+        self.assertEqual(frozen, [1, {"bar": "baz"}])
+
+    def testFreezingFrozenValuesIsFree(self):
+        frozen = freeze(self.value)
+        self.assertIs(freeze(frozen), frozen)
+        # Frozen parts of new values are shared rather than copied.
+        self.assertIs(freeze({"old": frozen})["old"], frozen)
+
+    def testImmutableValuesArentCopied(self):
+        s = "foo" * 10
+        self.assertIs(freeze(s), s)
+        self.assertIs(freeze(None), None)
+
+    def testCopiesAreModifiable(self):
+        frozen = freeze(self.value)
+        shallow = copy(frozen)
+        shallow["foo"] = 1
+        self.assertEqual(type(shallow), dict)
+        deep = deepcopy(frozen)
+        deep["foo"][1]["bar"] = 1
+        self.assertEqual(type(deep["foo"]), list)
+        self.assertEqual(frozen, self.value)
+
+    def testPickle(self):
+        unpickled = pickle.loads(pickle.dumps(freeze(self.value)))
+        self.assertEqual(unpickled, self.value)
+        self.assertIsInstance(unpickled, FrozenDict)
+        self.assertIsInstance(unpickled["foo"], FrozenList)
+
+    def testJSON(self):
+        self.assertEqual(json.loads(json.dumps(freeze(self.value))), json.loads(json.dumps(self.value)))
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from auslib.util.metrics import Metrics, metric_name
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def testCounters(self):
+        self.metrics.incr("foo")
+        self.metrics.incr("foo", 2)
+        self.assertEqual(self.metrics.get("foo"), 3)
+        self.assertEqual(self.metrics.get("bar"), 0)
+
+    def testMetricName(self):
+        self.assertEqual(metric_name("foo"), "foo")
+        self.assertEqual(metric_name("foo", stage="version", a='"b"'), 'foo{a="\\"b\\"",stage="version"}')
+
+    def testHistogram(self):
+        for value in (0.00005, 0.0003, 0.0003, 2):
+            self.metrics.observe("timing", value, buckets=(0.0001, 0.001, 1))
+        histogram = self.metrics.get_histogram("timing")
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.00065)
+        self.assertEqual(list(histogram.cumulative_counts()), [(0.0001, 1), (0.001, 3), (1, 3), (float("inf"), 4)])
+
+    def testRender(self):
+        self.metrics.incr(metric_name("rejected_total", stage="version"), 2)
+        self.metrics.observe(metric_name("stage_seconds", stage="version"), 0.5, buckets=(0.1, 1))
+        self.metrics.observe("total_seconds", 0.05, buckets=(0.1,))
+        self.assertEqual(
+            self.metrics.render(),
+            """rejected_total{stage="version"} 2
+stage_seconds_bucket{stage="version",le="0.1"} 0
+stage_seconds_bucket{stage="version",le="1"} 1
+stage_seconds_bucket{stage="version",le="+Inf"} 1
+stage_seconds_sum{stage="version"} 0.5
+stage_seconds_count{stage="version"} 1
+total_seconds_bucket{le="0.1"} 1
+total_seconds_bucket{le="+Inf"} 1
+total_seconds_sum 0.05
+total_seconds_count 1
+""",
+        )
+
+    def testReset(self):
+        self.metrics.incr("foo")
+        self.metrics.observe("bar", 1)
+        self.metrics.reset()
+        self.assertEqual(self.metrics.get("foo"), 0)
+        self.assertIsNone(self.metrics.get_histogram("bar"))
+
+
+class TestSharedMetrics(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testAggregatesWorkers(self):
+        worker1 = Metrics()
+        worker1.share(self.dir, worker_id=1)
+        worker2 = Metrics()
+        worker2.share(self.dir, worker_id=2)
+        worker1.incr("foo", 2)
+        worker1.observe("timing", 0.5, buckets=(1,))
+        worker2.incr("foo", 3)
+        worker2.incr("bar")
+        worker2.observe("timing", 2, buckets=(1,))
+        worker2.flush(force=True)
+
+        counters, histograms = worker1.aggregate()
+        self.assertEqual(counters, {"foo": 5, "bar": 1})
+        self.assertEqual(list(histograms["timing"].cumulative_counts()), [(1, 1), (float("inf"), 2)])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["1.json", "2.json"])
+        # The other worker's own values aren't affected.
+        self.assertEqual(worker2.get("foo"), 3)
+
+    def testFlushIsRateLimited(self):
+        metrics = Metrics()
+        metrics.share(self.dir, worker_id=1, flush_interval=60)
+        with mock.patch("time.time") as t:
+            t.return_value = 1000
+            metrics.flush()
+            metrics.incr("foo")
+            t.return_value = 1030
+            metrics.flush()
+            reader = Metrics()
+            reader.share(self.dir, worker_id=2)
+            self.assertNotIn("foo", reader.aggregate()[0])
+            t.return_value = 1060
+            metrics.flush()
+            self.assertEqual(reader.aggregate()[0]["foo"], 1)
+
+    def testCollectors(self):
+        metrics = Metrics()
+        metrics.share(self.dir, worker_id=1)
+        metrics.incr("foo")
+        metrics.add_collector(lambda: {"foo": 2, "bar": 3})
+        self.assertEqual(dict(metrics.aggregate()[0]), {"foo": 3, "bar": 3})
+        self.assertEqual(metrics.get("foo"), 1)
+
+    def testDefaultsToPid(self):
+        metrics = Metrics()
+        metrics.share(self.dir)
+        metrics.flush(force=True)
+        self.assertEqual(os.listdir(self.dir), ["pid-%s.json" % os.getpid()])
+
+    def testDefaultsToUwsgiWorkerId(self):
+        metrics = Metrics()
+        metrics.share(self.dir)
+        with mock.patch("auslib.util.metrics.uwsgi_worker_id", return_value=3):
+            metrics.flush(force=True)
+        self.assertEqual(os.listdir(self.dir), ["worker-3.json"])
+
+    def testRemovesSnapshotsOfDeadProcesses(self):
+        dead = Metrics()
+        dead.share(self.dir)
+        dead.incr("foo")
+        with mock.patch("os.getpid", return_value=999999999):
+            dead.flush(force=True)
+        metrics = Metrics()
+        metrics.share(self.dir)
+        metrics.incr("foo")
+        with mock.patch("auslib.util.metrics._pid_exists", side_effect=lambda pid: pid != 999999999):
+            self.assertEqual(dict(metrics.aggregate()[0]), {"foo": 1})
+        self.assertEqual(os.listdir(self.dir), ["pid-%s.json" % os.getpid()])
+
+    def testIgnoresPartialFiles(self):
+        with open(os.path.join(self.dir, ".tmpfile"), "w") as f:
+            f.write("{")
+        with open(os.path.join(self.dir, "3.json"), "w") as f:
+            f.write("{")
+        metrics = Metrics()
+        metrics.share(self.dir, worker_id=1)
+        metrics.incr("foo")
+        self.assertEqual(dict(metrics.aggregate()[0]), {"foo": 1})
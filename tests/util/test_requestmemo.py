@@ -0,0 +1,83 @@
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+import mock
+
+from auslib.util.metrics import Metrics
+from auslib.util.requestmemo import RequestMemo
+
+
+class TestRequestMemo(unittest.TestCase):
+    def setUp(self):
+        self.memo = RequestMemo()
+
+    def testNoScopeCallsThrough(self):
+        getter = mock.Mock(return_value=1)
+        self.assertEqual(self.memo.get("a", "b", getter), 1)
+        self.assertEqual(self.memo.get("a", "b", getter), 1)
+        self.assertEqual(getter.call_count, 2)
+        self.assertIsNone(self.memo.current)
+
+    def testScopeRemembersValues(self):
+        getter = mock.Mock(return_value=None)
+        with self.memo.scope() as scope:
+            self.assertIs(self.memo.current, scope)
+            self.assertIsNone(self.memo.get("a", "b", getter))
+            self.assertIsNone(self.memo.get("a", "b", getter))
+            self.memo.get("other", "b", getter)
+        self.assertEqual(getter.call_count, 2)
+        self.assertEqual((scope.lookups, scope.hits, scope.misses), (3, 1, 2))
+        self.assertIsNone(self.memo.current)
+
+    def testScopesAreNotShared(self):
+        getter = mock.Mock(return_value=1)
+        with self.memo.scope():
+            self.memo.get("a", "b", getter)
+        with self.memo.scope():
+            self.memo.get("a", "b", getter)
+        self.assertEqual(getter.call_count, 2)
+
+    def testExceptionsAreNotRemembered(self):
+        getter = mock.Mock(side_effect=[KeyError("b"), 1])
+        with self.memo.scope():
+            self.assertRaises(KeyError, self.memo.get, "a", "b", getter)
+            self.assertEqual(self.memo.get("a", "b", getter), 1)
+
+    def testGetMany(self):
+        getter = mock.Mock(side_effect=lambda keys: {k: k.upper() for k in keys if k != "z"})
+        with self.memo.scope() as scope:
+            self.assertEqual(self.memo.get_many("a", ("x", "z"), getter), {"x": "X"})
+            self.assertEqual(self.memo.get_many("a", ("x", "y", "z"), getter), {"x": "X", "y": "Y"})
+        self.assertEqual([c[0][0] for c in getter.call_args_list], [["x", "z"], ["y"]])
+        self.assertEqual((scope.lookups, scope.hits), (5, 2))
+
+    def testCountsAreThreadSafe(self):
+        # Work that a request hands off to other threads shares its scope,
+        # so lookups from all of them must be counted.
+        def lookups(_):
+            for i in range(2000):
+                self.memo.get("a", i % 10, lambda: 1)
+
+        switchinterval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with self.memo.scope() as scope:
+                with ThreadPoolExecutor(max_workers=8) as pool:
+                    futures = [pool.submit(copy_context().run, lookups, i) for i in range(8)]
+                    [future.result() for future in futures]
+        finally:
+            sys.setswitchinterval(switchinterval)
+        self.assertEqual(scope.lookups, 16000)
+        self.assertEqual(scope.hits + scope.misses, 16000)
+
+    def testRecord(self):
+        metrics = Metrics()
+        with self.memo.scope() as scope:
+            self.memo.get("a", "b", lambda: 1)
+            self.memo.get("a", "b", lambda: 1)
+        self.memo.record(scope, metrics)
+        self.assertEqual(metrics.get_histogram("request_memo_lookups").count, 1)
+        self.assertEqual(metrics.get("request_memo_hits_total"), 1)
+        self.assertEqual(metrics.get("request_memo_misses_total"), 1)
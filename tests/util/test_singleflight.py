@@ -0,0 +1,78 @@
+import threading
+import unittest
+
+from auslib.util.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+
+    def testSequentialCallsAreNotShared(self):
+        self.assertEqual(self.flight.do("a", lambda: 1), (1, False))
+        self.assertEqual(self.flight.do("a", lambda: 2), (2, False))
+
+    def testConcurrentCallsAreShared(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "blob"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.flight.do("a", slow)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(self.flight.do("a", slow))) for _ in range(3)]
+        for t in followers:
+            t.start()
+        # Different keys are never shared.
+        self.assertEqual(self.flight.do("b", lambda: "other"), ("other", False))
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("blob", False)] + [("blob", True)] * 3)
+
+    def testExceptionsAreShared(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait()
+            raise KeyError("a")
+
+        errors = []
+
+        def call():
+            try:
+                self.flight.do("a", fail)
+            except KeyError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call)]
+        threads[0].start()
+        started.wait()
+        threads.append(threading.Thread(target=call))
+        threads[1].start()
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(errors), 2)
+        # Nothing is remembered once the call has finished.
+        self.assertEqual(self.flight.do("a", lambda: 1), (1, False))
+
+    def testTryDoDoesntWait(self):
+        def inner():
+            # The outer call for "a" is still in flight.
+            self.assertEqual(self.flight.try_do("a", lambda: 2), (None, False))
+            return 1
+
+        self.assertEqual(self.flight.try_do("a", inner), (1, True))
+        self.assertEqual(self.flight.try_do("a", lambda: 3), (3, True))
@@ -1,7 +1,8 @@
 import unittest
 
 from auslib.errors import BadDataError
-from auslib.util.versions import MozillaVersion
+from auslib.util.comparison import compile_version_comparator, get_op, version_compare
+from auslib.util.versions import LooseVersion, MozillaVersion, PostModernMozillaVersion, version_key
 
 
 class TestMozillaVersions(unittest.TestCase):
@@ -62,3 +63,73 @@ class TestMozillaVersions(unittest.TestCase):
                 else:
                     raise AssertionError(("cmp(%s, %s) " "shouldn't raise BadDataError") % (v1, v2))
             self.assertEqual(res, wanted, "cmp(%s, %s) should be %s, got %s" % (v1, v2, wanted, res))
+
+    def test_interned(self):
+        self.assertIs(MozillaVersion("68.0a1"), MozillaVersion("68.0a1"))
+
+    def test_immutable(self):
+        version = MozillaVersion("68.0")
+        self.assertRaises(AttributeError, setattr, version, "foo", 1)
+        self.assertEqual(hash(version), hash(MozillaVersion("68.0.0")))
+
+    def test_cmp_across_classes(self):
+        # "10.0" is parsed by ModernMozillaVersion because its first digit is 1.
+        self.assertLess(MozillaVersion("3.6.3plugin1"), MozillaVersion("10.0"))
+        self.assertLess(MozillaVersion("10.0"), MozillaVersion("68.0a1"))
+        self.assertEqual(MozillaVersion("1.5.0.12"), MozillaVersion("1.5.12"))
+
+    def test_invalid(self):
+        for version in ("", "68.0b1", "abc", "1.2.3.4.5"):
+            self.assertRaises(BadDataError, MozillaVersion, version)
+        self.assertRaises(ValueError, PostModernMozillaVersion, "68.0b1")
+
+    def test_loose_version(self):
+        version = LooseVersion("1.0.10a")
+        self.assertEqual(version.version, [1, 0, 10, "a"])
+        self.assertEqual(str(version), "1.0.10a")
+        self.assertGreater(version, LooseVersion("1.0.9"))
+        self.assertEqual(LooseVersion("1.0"), LooseVersion("1.0"))
+
+
+class TestVersionKey(unittest.TestCase):
+    versions = ("1.5.0.12", "2.0", "3.5b4", "3.6.3plugin1", "3.6.3", "4.0a1", "4.0b12", "4.0", "10.0a1", "68.0a1", "68.0", "68.0.1", "72.0")
+
+    def testOrderingMatchesMozillaVersion(self):
+        for v1 in self.versions:
+            for v2 in self.versions:
+                for op in ("__lt__", "__eq__", "__gt__"):
+                    self.assertEqual(
+                        getattr(version_key(v1), op)(version_key(v2)), getattr(MozillaVersion(v1), op)(MozillaVersion(v2)), "%s %s %s" % (v1, op, v2)
+                    )
+
+    def testInterned(self):
+        self.assertIs(version_key("68.0a1"), version_key("68.0a1"))
+
+    def testLooseVersion(self):
+        self.assertLess(version_key("1.0.9", LooseVersion), version_key("1.0.10", LooseVersion))
+
+    def testInvalid(self):
+        self.assertRaises(BadDataError, version_key, "1.13++")
+
+
+class TestVersionComparator(unittest.TestCase):
+    def testGetOp(self):
+        for compstr, wanted in (("1.0", "=="), (">=1.0", ">="), (">1.0", ">"), ("<=1.0", "<="), ("<1.0", "<")):
+            self.assertEqual(get_op(compstr)[0].__name__, {"==": "eq", ">=": "ge", ">": "gt", "<=": "le", "<": "lt"}[wanted])
+            self.assertEqual(get_op(compstr)[1], "1.0")
+        self.assertIsNone(get_op("=1.0"))
+
+    def testMultipleComparisons(self):
+        comparator = compile_version_comparator("<60.0,>=68.0a1")
+        self.assertTrue(comparator("52.0"))
+        self.assertTrue(comparator("80.0a1"))
+        self.assertFalse(comparator("62.0"))
+
+    def testMatchesVersionCompare(self):
+        for compstr in ("68.0", ">68.0", ">=68.0a1", "<68.0", "<=68.0a1"):
+            comparator = compile_version_comparator(compstr)
+            for version in ("67.0", "67.0a1", "68.0a1", "68.0", "68.0.1"):
+                self.assertEqual(comparator(version), version_compare(version, compstr), "%s %s" % (version, compstr))
+
+    def testCached(self):
+        self.assertIs(compile_version_comparator(">=68.0a1"), compile_version_comparator(">=68.0a1"))
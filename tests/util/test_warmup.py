@@ -0,0 +1,81 @@
+import unittest
+
+import mock
+import pytest
+
+from auslib.blobs.base import createBlob
+from auslib.global_state import cache, dbo
+from auslib.util.warmup import warm_caches
+
+
+def makeRelease(name, partialFrom=None):
+    locale = {"buildID": "1", "complete": {"filesize": 1, "from": "*", "hashValue": "abc"}}
+    if partialFrom:
+        locale["partial"] = {"filesize": 1, "from": partialFrom, "hashValue": "abc"}
+    return createBlob(dict(name=name, schema_version=1, hashFunction="sha512", platforms={"p": {"locales": {"l": locale}}}))
+
+
+@pytest.mark.usefixtures("current_db_schema")
+class TestWarmCaches(unittest.TestCase):
+    def setUp(self):
+        cache.reset()
+        cache.make_cache("blob", 10, 10)
+        cache.make_cache("blob_version", 10, 10)
+        cache.make_cache("release_buildids", 10, 10)
+        cache.make_cache("rules_index", 1, 10)
+        dbo.setDb("sqlite:///:memory:")
+        self.metadata.create_all(dbo.engine)
+        for name, partialFrom in (("a", "old"), ("b", None), ("c", None), ("old", None), ("unused", None)):
+            dbo.releases.t.insert().execute(name=name, product="a", data=makeRelease(name, partialFrom), data_version=1)
+        dbo.rules.t.insert().execute(rule_id=1, priority=100, backgroundRate=100, mapping="a", fallbackMapping="b", update_type="minor", data_version=1)
+        dbo.rules.t.insert().execute(rule_id=2, priority=90, backgroundRate=100, mapping="c", update_type="minor", data_version=1)
+        dbo.rules.t.insert().execute(rule_id=3, priority=80, backgroundRate=100, mapping="missing", update_type="minor", data_version=1)
+        dbo.rules.t.insert().execute(rule_id=4, priority=70, backgroundRate=100, update_type="minor", data_version=1)
+
+    def tearDown(self):
+        dbo.reset()
+        cache.reset()
+
+    def testWarmCaches(self):
+        summary = warm_caches(60)
+        self.assertEqual({k: v for k, v in summary.items() if k != "seconds"}, {"rules": 4, "releases": 3, "referenced_releases": 1, "complete": True})
+        for name in ("a", "b", "c"):
+            self.assertEqual(cache.get("blob", name)["blob"]["name"], name)
+            self.assertEqual(cache.get("blob_version", name), 1)
+        self.assertIsNone(cache.get("blob", "unused"))
+        # Only the buildIDs of releases that partials reference are needed.
+        self.assertIsNone(cache.get("blob", "old"))
+        self.assertIsNotNone(cache.get("release_buildids", "old"))
+        self.assertIsNotNone(cache.get("rules_index", "rules"))
+
+    def testMaxReleases(self):
+        summary = warm_caches(60, max_releases=2, batch_size=1)
+        self.assertEqual((summary["releases"], summary["complete"]), (2, False))
+        # The highest priority rule's releases come first.
+        self.assertIsNotNone(cache.get("blob", "a"))
+        self.assertIsNotNone(cache.get("blob", "b"))
+        self.assertIsNone(cache.get("blob", "c"))
+        # Referenced releases don't count towards the limit.
+        self.assertEqual(summary["referenced_releases"], 1)
+        self.assertIsNotNone(cache.get("release_buildids", "old"))
+
+    def testReferencedReleasesOnlyLoadBuildIDs(self):
+        with mock.patch.object(dbo.releases, "getReleasesByName", wraps=dbo.releases.getReleasesByName) as getReleasesByName:
+            warm_caches(60)
+        names = set()
+        for call in getReleasesByName.call_args_list:
+            names.update(call[0][0])
+        self.assertEqual(names, {"a", "b", "c", "missing"})
+
+    def testTimeBudget(self):
+        with mock.patch("time.time") as t:
+            t.side_effect = range(0, 1000, 10)
+            summary = warm_caches(15, batch_size=1)
+        self.assertFalse(summary["complete"])
+        self.assertLess(summary["releases"], 4)
+
+    def testNoBlobCache(self):
+        cache.reset()
+        cache.make_cache("rules_index", 1, 10)
+        summary = warm_caches(60)
+        self.assertEqual((summary["rules"], summary["releases"]), (4, 0))
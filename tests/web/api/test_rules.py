@@ -79,3 +79,49 @@ class TestPublicRulesAPI(CommonTestBase):
     def test_get_revisions_400(self):
         ret = self.public_client.get("/api/v1/rules/1/revisions?page=0")
         self.assertEqual(ret.status_code, 400)
+
+    def test_get_revisions_with_cursor(self):
+        ret = self.public_client.get("/api/v1/rules/3/revisions?limit=1")
+        self.assertEqual(ret.status_code, 200, ret.get_data())
+        first = ret.get_json()
+        self.assertEqual(first["count"], 2)
+        self.assertEqual(len(first["rules"]), 1)
+        self.assertIn("next_cursor", first)
+
+        ret = self.public_client.get("/api/v1/rules/3/revisions?limit=1&cursor={}".format(first["next_cursor"]))
+        self.assertEqual(ret.status_code, 200, ret.get_data())
+        second = ret.get_json()
+        # The count from the first page is carried along in the cursor.
+        self.assertEqual(second["count"], 2)
+        self.assertEqual(len(second["rules"]), 1)
+        self.assertNotIn("next_cursor", second)
+
+        # Both revisions have the same timestamp, so they're ordered by change_id.
+        rules = [(rule["mapping"], rule["change_id"]) for rule in first["rules"] + second["rules"]]
+        self.assertEqual(rules, [("z", 2), ("y", 1)])
+
+    def test_get_revisions_cursor_matches_pages(self):
+        by_page = [self.public_client.get("/api/v1/rules/3/revisions?limit=1&page={}".format(page)).get_json() for page in (1, 2)]
+        self.assertEqual(by_page[0]["next_cursor"], self.public_client.get("/api/v1/rules/3/revisions?limit=1").get_json()["next_cursor"])
+        by_cursor = self.public_client.get("/api/v1/rules/3/revisions?limit=1&cursor={}".format(by_page[0]["next_cursor"])).get_json()
+        self.assertEqual(by_cursor["rules"], by_page[1]["rules"])
+
+    def test_get_revisions_without_count(self):
+        ret = self.public_client.get("/api/v1/rules/3/revisions?limit=1&count=false")
+        self.assertEqual(ret.status_code, 200, ret.get_data())
+        got = ret.get_json()
+        self.assertNotIn("count", got)
+        self.assertEqual(len(got["rules"]), 1)
+
+        ret = self.public_client.get("/api/v1/rules/3/revisions?limit=1&count=false&cursor={}".format(got["next_cursor"]))
+        self.assertEqual(ret.status_code, 200, ret.get_data())
+        self.assertNotIn("count", ret.get_json())
+
+    def test_get_revisions_bad_cursor(self):
+        ret = self.public_client.get("/api/v1/rules/3/revisions?cursor=notacursor")
+        self.assertEqual(ret.status_code, 400)
+
+    def test_get_revisions_page_and_cursor(self):
+        cursor = self.public_client.get("/api/v1/rules/3/revisions?limit=1").get_json()["next_cursor"]
+        ret = self.public_client.get("/api/v1/rules/3/revisions?limit=1&page=2&cursor={}".format(cursor))
+        self.assertEqual(ret.status_code, 400)
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import threading
+import unittest
+from tempfile import mkstemp
+
+from auslib.global_state import dbo
+from auslib.web.public.asgi import create_asgi_app
+from auslib.web.public.base import app
+
+from .test_client import ClientTestBase
+
+
+def call(asgi_app, scope, messages=({"type": "http.request", "body": b""},)):
+    received = list(messages)
+    sent = []
+
+    async def receive():
+        if received:
+            return received.pop(0)
+        # Nothing more to receive until the response is sent.
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    return sent
+
+
+def http_scope(path="/update/3/b/1.0/1/p/l/a/a/a/a/update.xml", method="GET", query_string=b""):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "method": method,
+        "http_version": "1.1",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("utf-8"),
+        "root_path": "",
+        "query_string": query_string,
+        "headers": [(b"host", b"aus.example.com")],
+        "server": ("aus.example.com", 8080),
+        "client": ("127.0.0.1", 1234),
+    }
+
+
+def response_body(sent):
+    return b"".join(message.get("body", b"") for message in sent if message["type"] == "http.response.body")
+
+
+class TestCreateAsgiApp(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def wsgi_app(environ, start_response):
+            self.calls.append((environ, threading.current_thread().name))
+            start_response("200 OK", [("Content-Type", "text/xml")])
+            return [b"<updates>", environ["wsgi.input"].read(), b"</updates>"]
+
+        self.app = create_asgi_app(wsgi_app, workers=2)
+
+    def testRequest(self):
+        sent = call(self.app, http_scope(method="POST"), [{"type": "http.request", "body": b"a", "more_body": True}, {"type": "http.request", "body": b"b"}])
+        self.assertEqual(sent[0]["type"], "http.response.start")
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn((b"content-type", b"text/xml"), sent[0]["headers"])
+        self.assertEqual(response_body(sent), b"<updates>ab</updates>")
+        # The WSGI app is called in one of the worker threads, not the event loop's.
+        self.assertNotEqual(self.calls[0][1], threading.current_thread().name)
+
+
+class TestAsgiPublicApp(ClientTestBase):
+    """Makes sure that the public app serves the same responses through the
+    ASGI entry point as it does under WSGI. Requests are handled in worker
+    threads, each with its own connection, so the database can't be an
+    in-memory one."""
+
+    def setUp(self):
+        self.db_fd, self.db_file = mkstemp()
+        self.dburi = "sqlite:///%s" % self.db_file
+        super(TestAsgiPublicApp, self).setUp()
+        self.asgi_app = create_asgi_app(app, workers=2)
+
+    def tearDown(self):
+        dbo.engine.dispose()
+        os.close(self.db_fd)
+        os.remove(self.db_file)
+        super(TestAsgiPublicApp, self).tearDown()
+
+    def testUpdateResponseMatchesWsgi(self):
+        path = "/update/3/b/1.0/1/p/l/a/a/a/a/update.xml"
+        sent = call(self.asgi_app, http_scope(path=path))
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertEqual(response_body(sent), self.client.get(path).get_data())
+        self.assertIn(b"http://a.com/z", response_body(sent))
+
+    def testNotFound(self):
+        sent = call(self.asgi_app, http_scope(path="/json/1/Guardian/1.0/p/a/update.json"))
+        self.assertEqual(sent[0]["status"], 404)
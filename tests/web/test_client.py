@@ -1,6 +1,7 @@
 # coding: latin-1
 import logging
 import os
+import threading
 import unittest
 from tempfile import mkstemp
 from xml.dom import minidom
@@ -13,7 +14,7 @@ from hypothesis.strategies import characters, integers, just, text
 import auslib.web.public.client as client_api
 from auslib.blobs.base import createBlob
 from auslib.errors import BadDataError
-from auslib.global_state import cache, dbo
+from auslib.global_state import cache, dbo, metrics
 from auslib.web.public.base import app
 from auslib.web.public.client import extract_query_version
 
@@ -71,6 +72,7 @@ class ClientTestCommon(unittest.TestCase):
 
 class ClientTestBase(ClientTestCommon):
     maxDiff = 2000
+    dburi = "sqlite:///:memory:"
 
     @classmethod
     def setUpClass(cls):
@@ -101,7 +103,7 @@ class ClientTestBase(ClientTestCommon):
 }
 """
             )
-        dbo.setDb("sqlite:///:memory:")
+        dbo.setDb(self.dburi)
         self.metadata.create_all(dbo.engine)
         dbo.setDomainWhitelist({"a.com": ("b", "c", "e", "distTest")})
         self.client = app.test_client()
@@ -1204,6 +1206,18 @@ class ClientTest(ClientTestBase):
 """,
         )
 
+    def testGetWithResponseProductsMemoizesLookups(self):
+        metrics.reset()
+        with mock.patch.object(dbo.emergencyShutoffs, "_loadShutoffs", wraps=dbo.emergencyShutoffs._loadShutoffs) as loadShutoffs:
+            ret = self.client.get("/update/4/gmp/1.0/1/p/l/a/a/a/a/1/update.xml")
+        self.assertHttpResponse(ret)
+        # Rules are evaluated for the SuperBlob, and again for each of its
+        # response products, but emergency shutoffs are only loaded once.
+        self.assertEqual(loadShutoffs.call_count, 1)
+        self.assertEqual(metrics.get_histogram("request_memo_lookups").count, 1)
+        self.assertGreater(metrics.get("request_memo_hits_total"), 0)
+        metrics.reset()
+
     def testGetWithResponseProductsWithAbsentRule(self):
         ret = self.client.get("/update/4/gmp/1.0/1/q/l/a/a/a/a/1/update.xml")
         self.assertUpdateEqual(
@@ -1756,6 +1770,49 @@ class ClientTestEmergencyShutoff(ClientTestBase):
         ret = self.client.get(update_query)
         self.assertUpdateEqual(ret, self.update_xml)
 
+    def testShutoffSnapshotOnlyReloadedWhenChanged(self):
+        cache.make_cache("updates_disabled", 1, 100)
+        update_query = "/update/3/b/1.0/1/p/l/a-cck-foo/a/a/a/update.xml"
+        shutoffs = dbo.emergencyShutoffs
+        with mock.patch.object(shutoffs, "_loadShutoffs", wraps=shutoffs._loadShutoffs) as load:
+            with mock.patch.object(shutoffs.history, "getChangesVersion", return_value=(1, 1)):
+                self.assertUpdateEqual(self.client.get(update_query), self.update_xml)
+                # Both the channel and fallback channel are checked against a single snapshot.
+                self.assertEqual(load.call_count, 1)
+
+                dbo.emergencyShutoffs.t.insert().execute(product="b", channel="a", data_version=1)
+                # Expiring the cached snapshot makes us check the version,
+                # which hasn't changed, so the table isn't reloaded.
+                cache.clear("updates_disabled")
+                self.assertUpdateEqual(self.client.get(update_query), self.update_xml)
+                self.assertEqual(load.call_count, 1)
+
+            with mock.patch.object(shutoffs.history, "getChangesVersion", return_value=(2, 2)):
+                cache.clear("updates_disabled")
+                self.assertUpdatesAreEmpty(self.client.get(update_query))
+                self.assertEqual(load.call_count, 2)
+
+    def testShutoffVersionChangesWithHistory(self):
+        version = dbo.emergencyShutoffs.history.getChangesVersion()
+        dbo.emergencyShutoffs.insert(changed_by="bill", product="b", channel="a")
+        self.assertNotEqual(dbo.emergencyShutoffs.history.getChangesVersion(), version)
+        self.assertEqual(dbo.emergencyShutoffs.getShutoffs(), frozenset([("b", "a")]))
+
+    def testShutoffSnapshotReloadedWhenTooOld(self):
+        cache.make_cache("updates_disabled", 1, 100)
+        shutoffs = dbo.emergencyShutoffs
+        with mock.patch.object(shutoffs.history, "getChangesVersion", return_value=(1, 1)), mock.patch("time.time") as t:
+            t.return_value = 1000
+            self.assertEqual(shutoffs.getShutoffs(), frozenset())
+            # A change that the version doesn't catch...
+            dbo.emergencyShutoffs.t.insert().execute(product="b", channel="a", data_version=1)
+            cache.clear("updates_disabled")
+            self.assertEqual(shutoffs.getShutoffs(), frozenset())
+            # ...is picked up once the snapshot is old enough.
+            t.return_value = 1000 + shutoffs.snapshot_max_age + 1
+            cache.clear("updates_disabled")
+            self.assertEqual(shutoffs.getShutoffs(), frozenset([("b", "a")]))
+
     def testShutoffUpdatesFallbackChannel(self):
         update_query = "/update/3/b/1.0/1/p/l/a-cck-foo/a/a/a/update.xml"
         ret = self.client.get(update_query)
@@ -1767,6 +1824,204 @@ class ClientTestEmergencyShutoff(ClientTestBase):
         self.assertUpdatesAreEmpty(ret)
 
 
+class ClientTestRuleTrace(ClientTestBase):
+    def setUp(self):
+        super(ClientTestRuleTrace, self).setUp()
+        metrics.reset()
+        app.config["RULE_TRACE_HEADER"] = "X-Balrog-Rule-Trace"
+        app.config["RULE_TRACE_SECRET"] = "sekrit"
+
+    def tearDown(self):
+        app.config.pop("RULE_TRACE_HEADER", None)
+        app.config.pop("RULE_TRACE_SECRET", None)
+        app.config.pop("RULE_TRACE_SAMPLE_RATE", None)
+        metrics.reset()
+        super(ClientTestRuleTrace, self).tearDown()
+
+    def testNotTracedByDefault(self):
+        with mock.patch("auslib.web.public.base.log") as log:
+            ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+        self.assertHttpResponse(ret)
+        log.info.assert_not_called()
+        self.assertEqual(metrics.get("rule_traces_total"), 0)
+
+    def testTracedWithHeader(self):
+        with self.assertLogs("auslib.web.public.base", logging.INFO) as logs:
+            ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml", headers={"X-Balrog-Rule-Trace": "sekrit"})
+        self.assertHttpResponse(ret)
+        self.assertEqual(len(logs.records), 1)
+        record = logs.records[0]
+        self.assertEqual(record.product, "b")
+        self.assertEqual(record.channel, "a")
+        self.assertEqual(record.rule_trace["matched"], 1)
+        self.assertIn("channel", record.rule_trace["stages"])
+        self.assertEqual(metrics.get("rule_traces_total"), 1)
+        self.assertEqual(metrics.get_histogram("rule_trace_seconds").count, 1)
+
+    def testNotTracedWithWrongSecret(self):
+        ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml", headers={"X-Balrog-Rule-Trace": "1"})
+        self.assertHttpResponse(ret)
+        self.assertEqual(metrics.get("rule_traces_total"), 0)
+
+    def testHeaderIgnoredWithoutSecret(self):
+        del app.config["RULE_TRACE_SECRET"]
+        ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml", headers={"X-Balrog-Rule-Trace": "sekrit"})
+        self.assertHttpResponse(ret)
+        self.assertEqual(metrics.get("rule_traces_total"), 0)
+
+    def testTracedBySampling(self):
+        app.config["RULE_TRACE_SAMPLE_RATE"] = 1.0
+        ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+        self.assertHttpResponse(ret)
+        ret = self.client.get("/json/1/Guardian/1.0/p/a/update.json")
+        self.assertEqual(ret.status_code, 404)
+        self.assertEqual(metrics.get("rule_traces_total"), 2)
+
+
+class ClientTestWithResponseCache(ClientTest):
+    """Runs all of the ClientTest tests with the response cache (and the blob
+    caches that it depends on) enabled."""
+
+    def setUp(self):
+        super(ClientTestWithResponseCache, self).setUp()
+        cache.reset()
+        cache.make_copies = False
+        cache.make_cache("blob", 20, 3600)
+        cache.make_cache("blob_version", 20, 3600)
+        cache.make_cache("xml_responses", 20, 3600)
+
+    def tearDown(self):
+        cache.reset()
+        super(ClientTestWithResponseCache, self).tearDown()
+
+    def testResponseIsCached(self):
+        update_query = "/update/3/b/1.0/1/p/l/a/a/a/a/update.xml"
+        ret = self.client.get(update_query)
+        self.assertHttpResponse(ret)
+        with mock.patch("auslib.web.public.client.getResponseXML") as getResponseXML:
+            ret2 = self.client.get(update_query)
+            self.assertFalse(getResponseXML.called)
+        self.assertEqual(ret.get_data(), ret2.get_data())
+        self.assertEqual(cache.caches["xml_responses"].hits, 1)
+
+    def testDifferentQueriesAreCachedSeparately(self):
+        ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+        ret2 = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml?force=1")
+        self.assertNotEqual(ret.get_data(), ret2.get_data())
+        self.assertEqual(cache.caches["xml_responses"].hits, 0)
+
+    def testMainAndFallbackResponsesAreCached(self):
+        main = self.client.get("/update/6/q/1.0/1/p/l/a/a/a/a/1/update.xml?force=1")
+        fallback = self.client.get("/update/6/q/1.0/1/p/l/a/a/a/a/1/update.xml?force=-1")
+        self.assertIn(b"http://a.com/q", main.get_data())
+        self.assertIn(b"http://a.com/fallback", fallback.get_data())
+
+        with mock.patch("auslib.web.public.base.AUS.rand") as rand:
+            rand.return_value = 0
+            # backgroundRate is 0, so regular requests always get the fallback...
+            ret = self.client.get("/update/6/q/1.0/1/p/l/a/a/a/a/1/update.xml")
+            self.assertIn(b"http://a.com/fallback", ret.get_data())
+            # ...until it's raised, when the main release is served instead.
+            dbo.rules.t.update(values=dict(backgroundRate=100, data_version=2)).where(dbo.rules.mapping == "q").execute()
+            ret = self.client.get("/update/6/q/1.0/1/p/l/a/a/a/a/1/update.xml")
+            self.assertIn(b"http://a.com/q", ret.get_data())
+
+    def testChangedBlobInvalidatesResponse(self):
+        update_query = "/update/3/b/1.0/1/p/l/a/a/a/a/update.xml"
+        ret = self.client.get(update_query)
+        self.assertIn(b"http://a.com/z", ret.get_data())
+
+        blob = createBlob(dbo.releases.getReleaseBlob("b"))
+        blob["platforms"]["p"]["locales"]["l"]["complete"]["fileUrl"] = "http://a.com/y"
+        dbo.releases.t.update(values=dict(data=blob, data_version=2)).where(dbo.releases.name == "b").execute()
+        cache.invalidate("blob_version", "b")
+
+        ret = self.client.get(update_query)
+        self.assertIn(b"http://a.com/y", ret.get_data())
+
+    def testResponseIsCachedWhenCacheMakesCopies(self):
+        cache.make_copies = True
+        update_query = "/update/3/b/1.0/1/p/l/a/a/a/a/update.xml"
+        ret = self.client.get(update_query)
+        with mock.patch("auslib.web.public.client.getResponseXML") as getResponseXML:
+            ret2 = self.client.get(update_query)
+            self.assertFalse(getResponseXML.called)
+        self.assertEqual(ret.get_data(), ret2.get_data())
+
+    def testResponseDependenciesDontLoadReferencedReleases(self):
+        release = dbo.releases.getReleaseBlob("b")
+        with mock.patch.object(release, "getReferencedReleases", return_value={"b", "missing"}):
+            with mock.patch.object(dbo.releases, "getReleaseBlob") as getReleaseBlob:
+                dependencies = client_api.getResponseDependencies(release, [{"response_release": release}], None)
+                self.assertFalse(getReleaseBlob.called)
+        self.assertEqual(dependencies, {"b": 1, "missing": None})
+
+    def testResponseDependenciesLookedUpOncePerRequest(self):
+        update_query = "/update/3/b/1.0/1/p/l/a/a/a/a/update.xml?force=1"
+        with mock.patch("auslib.web.public.client.getResponseDependencies", wraps=client_api.getResponseDependencies) as getResponseDependencies:
+            self.client.get(update_query)
+            self.assertEqual(getResponseDependencies.call_count, 1)
+            self.client.get(update_query)
+            self.assertEqual(getResponseDependencies.call_count, 2)
+        self.assertEqual(cache.caches["xml_responses"].hits, 1)
+
+    def testResponseNotUsedWhenUpdatesAreDisabled(self):
+        update_query = "/update/3/b/1.0/1/p/l/a/a/a/a/update.xml"
+        ret = self.client.get(update_query)
+        self.assertIn(b"http://a.com/z", ret.get_data())
+
+        dbo.emergencyShutoffs.t.insert().execute(product="b", channel="a", data_version=1)
+
+        ret = self.client.get(update_query)
+        self.assertUpdatesAreEmpty(ret)
+
+
+class ClientTestWithParallelResponseProducts(ClientTest):
+    """Runs all of the ClientTest tests with SuperBlobs' response products
+    evaluated in worker threads. Each of those uses its own connection, so the
+    database can't be an in-memory one."""
+
+    def setUp(self):
+        self.db_fd, self.db_file = mkstemp()
+        self.dburi = "sqlite:///%s" % self.db_file
+        super(ClientTestWithParallelResponseProducts, self).setUp()
+        app.config["RESPONSE_PRODUCT_WORKERS"] = 4
+
+    def tearDown(self):
+        del app.config["RESPONSE_PRODUCT_WORKERS"]
+        dbo.engine.dispose()
+        os.close(self.db_fd)
+        os.remove(self.db_file)
+        super(ClientTestWithParallelResponseProducts, self).tearDown()
+
+    def testResponseProductsAreEvaluatedInWorkerThreads(self):
+        threads = {}
+        evaluateRules = client_api.AUS.evaluateRules
+
+        def evaluate(updateQuery, *args, **kwargs):
+            threads[updateQuery["product"]] = threading.current_thread().name
+            return evaluateRules(updateQuery, *args, **kwargs)
+
+        with mock.patch.object(client_api.AUS, "evaluateRules", side_effect=evaluate):
+            ret = self.client.get("/update/4/gmp/1.0/1/p/l/a/a/a/a/1/update.xml")
+        self.assertHttpResponse(ret)
+        self.assertEqual(threads["gmp"], threading.current_thread().name)
+        self.assertTrue(threads["response-a"].startswith("response-products"))
+        self.assertTrue(threads["response-b"].startswith("response-products"))
+
+    def testTracedRequestsAreEvaluatedInOrder(self):
+        app.config["RULE_TRACE_HEADER"] = "X-Balrog-Rule-Trace"
+        app.config["RULE_TRACE_SECRET"] = "sekrit"
+        try:
+            with mock.patch.object(client_api, "getResponseProductExecutor") as getResponseProductExecutor:
+                ret = self.client.get("/update/4/gmp/1.0/1/p/l/a/a/a/a/1/update.xml", headers={"X-Balrog-Rule-Trace": "sekrit"})
+        finally:
+            app.config.pop("RULE_TRACE_HEADER", None)
+            app.config.pop("RULE_TRACE_SECRET", None)
+        self.assertHttpResponse(ret)
+        self.assertFalse(getResponseProductExecutor.return_value.submit.called)
+
+
 class ClientTestWithErrorHandlers(ClientTestCommon):
     """Most of the tests are run without the error handler because it gives more
        useful output when things break. However, we still need to test that our
@@ -1,5 +1,8 @@
 import mock
 
+from auslib.global_state import cache, metrics
+from auslib.web.public.base import app
+
 from .test_client import ClientTestBase
 
 
@@ -39,3 +42,37 @@ class TestDockerflowEndpoints(ClientTestBase):
         ret = self.client.get("/__lbheartbeat__")
         self.assertEqual(ret.status_code, 200)
         self.assertEqual(ret.headers["Cache-Control"], "no-cache")
+
+    def testMetricsDisabled(self):
+        ret = self.client.get("/__metrics__")
+        self.assertEqual(ret.status_code, 404)
+
+    def testMetrics(self):
+        metrics.reset()
+        metrics.incr("foo", 3)
+        app.config["METRICS_ENABLED"] = True
+        try:
+            ret = self.client.get("/__metrics__")
+        finally:
+            del app.config["METRICS_ENABLED"]
+            metrics.reset()
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(ret.headers["Cache-Control"], "no-cache")
+        self.assertIn("foo 3\n", ret.get_data(as_text=True))
+
+    def testMetricsIncludeRequestsCachesAndQueries(self):
+        metrics.reset()
+        cache.reset()
+        cache.make_cache("rules", 10, 10)
+        app.config["METRICS_ENABLED"] = True
+        try:
+            self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+            ret = self.client.get("/__metrics__")
+        finally:
+            del app.config["METRICS_ENABLED"]
+            metrics.reset()
+            cache.reset()
+        body = ret.get_data(as_text=True)
+        self.assertIn('request_seconds_count{route="get_update_blob"} 1\n', body)
+        self.assertIn('cache_misses_total{cache="rules"} 1\n', body)
+        self.assertIn('db_query_seconds_count{statement="select"}', body)
@@ -0,0 +1,18 @@
+# An asyncio entry point for the public app, for ASGI servers. eg:
+#   uvicorn --app-dir /app/uwsgi --port $PORT public_asgi:application
+# The app is configured exactly as it is by public.wsgi (which is still the
+# default way to run it, under uwsgi, and what to fall back to), from the
+# same environment variables. Requests are handled in a pool of up to
+# ASYNC_WORKER_THREADS threads per process, each of which may use a database
+# connection, so this should be well below the size of the connection pool.
+import os
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+
+from auslib.web.public.asgi import create_asgi_app
+
+loader = SourceFileLoader("public_wsgi", os.path.join(os.path.dirname(os.path.abspath(__file__)), "public.wsgi"))
+public_wsgi = module_from_spec(spec_from_loader(loader.name, loader))
+loader.exec_module(public_wsgi)
+
+application = create_asgi_app(public_wsgi.application, workers=int(os.environ.get("ASYNC_WORKER_THREADS", 8)))